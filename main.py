@@ -17,9 +17,11 @@ from pydantic import ValidationError
 
 from src.models.functions import make_operation_outcome
 from src.routers import cql_router, forms_router, main_router, nlpql_router, smartchartui, webhook
-from src.routers.forms_router import init_jobs_array
+from src.services.libraryhandler import warm_library_index
+from src.util.cachesync import start_cache_sync, stop_cache_sync
 from src.util.databaseclient import startup_connect
 from src.util.git import clone_repo_to_temp_folder
+from src.util.httpclients import close_async_clients, startup_async_clients
 from src.util.settings import api_docs, deploy_url, docs_prepend_url, knowledgebase_repo_url
 
 title: str = "SmartChart Suite Results Combining (RC) API"
@@ -29,7 +31,11 @@ version: str = "0.13.0"
 # ========================== Lifespan Function ===========================
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """On startup, check for knowledgebase repo variables and if found, update the libraries on CQF Ruler, and check that database contains required tables"""
+    """
+    On startup, check for knowledgebase repo variables and if found, update the libraries on CQF Ruler, check that database contains required tables, open the
+    shared upstream connection pools, start polling for cache invalidations from other processes, and warm the library index. On shutdown, stop polling
+    and close the connection pools.
+    """
     # Check for private key and known hosts in secrets
     # Set these (required for both hook clone and startup clone)
     # setup_keys()
@@ -51,10 +57,15 @@ async def lifespan(app: FastAPI):
         logger.error("There was an issue with your database connection, see below for error:")
         raise ValueError(error)
 
-    init_jobs_array()
+    await startup_async_clients()
+    cache_sync_task = await start_cache_sync()
+    await warm_library_index()
 
     yield
 
+    await stop_cache_sync(cache_sync_task)
+    await close_async_clients()
+
 
 # ================= FastAPI variable ===================================
 if api_docs.lower() == "true":
@@ -1,9 +1,11 @@
 """Forms module for all form/Questionnaire operations called by other files"""
 
+import asyncio
 import csv
+import heapq
 import re
-import time
 import uuid
+from collections.abc import Iterable
 from copy import deepcopy
 from datetime import datetime
 from typing import Literal, overload
@@ -12,12 +14,25 @@ import httpx
 from fhir.resources.R4B.questionnaire import Questionnaire
 from loguru import logger
 
+from src.models.models import LinkingPlan, LinkingPlanQuestion
 from src.services.errorhandler import make_operation_outcome
-from src.util.settings import cqfr4_fhir, httpx_client
+from src.util.cache import TTLCache
+from src.util.cachesync import publish_cache_invalidation
+from src.util.httpclients import get_async_client
+from src.util.settings import cqfr4_fhir, httpx_client, questionnaire_cache_ttl
 from static.diagnostic_questionnaire import diagnostic_questionnaire
 
 jobpackage_server_base = "http://gtri.gatech.edu/fakeFormIg/"
 
+# Keyed by (name, version), where a version of None holds the most recently updated Questionnaire with that name
+questionnaire_cache = TTLCache("questionnaire", ttl=questionnaire_cache_ttl, shared=True)
+# Keyed by (name, version, meta.versionId, meta.lastUpdated), so an updated Questionnaire gets a new plan
+linking_plan_cache = TTLCache("linking_plan", ttl=questionnaire_cache_ttl, shared=True)
+
+cql_task_url = "http://gtri.gatech.edu/fakeFormIg/cqlTask"
+nlpql_task_url = "http://gtri.gatech.edu/fakeFormIg/nlpqlTask"
+cardinality_url = "http://gtri.gatech.edu/fakeFormIg/cardinality"
+
 questionnaire_template = {
     "resourceType": "Questionnaire",
     "meta": {"profile": ["http://gtri.gatech.edu/fakeFormIg/StructureDefinition/smartchart-form"]},
@@ -60,6 +75,7 @@ def save_form_questionnaire(questionnaire_dict: dict):
         return make_operation_outcome("transient", f"Posting Questionnaire to server failed with code {req.status_code}")
 
     resource_id = req.json()["id"]
+    invalidate_cached_questionnaire(questionnaire_dict["name"])
     return make_operation_outcome("informational", f"Resource successfully posted with id {resource_id}", severity="information")
 
 
@@ -79,22 +95,135 @@ def get_form(form_name: str, form_version: str | None = None, return_Questionnai
     if form_name.lower() == "diagnostic":
         return diagnostic_questionnaire
 
+    questionnaire = get_cached_questionnaire(form_name, form_version)
+    if questionnaire is None:
+        req: httpx.Response = httpx_client.get(cqfr4_fhir + questionnaire_search_path(form_name, form_version))
+        questionnaire = questionnaire_from_search_response(req, form_name, form_version)
+        cache_questionnaire(questionnaire, form_version)
+    if return_Questionnaire_class_obj and questionnaire["resourceType"] == "Questionnaire":
+        return Questionnaire.parse_obj(questionnaire)
+    return questionnaire
+
+
+async def get_form_async(form_name: str, form_version: str | None = None) -> dict:
+    """Returns the Questionnaire from CQF Ruler based on form name without blocking the event loop"""
+
+    if form_name.lower() == "diagnostic":
+        return diagnostic_questionnaire
+
+    questionnaire = get_cached_questionnaire(form_name, form_version)
+    if questionnaire is None:
+        req: httpx.Response = await get_async_client("cqf_ruler").get(cqfr4_fhir + questionnaire_search_path(form_name, form_version))
+        questionnaire = questionnaire_from_search_response(req, form_name, form_version)
+        cache_questionnaire(questionnaire, form_version)
+    return questionnaire
+
+
+def get_cached_questionnaire(form_name: str, form_version: str | None) -> dict | None:
+    """Returns a copy of the cached Questionnaire so callers can modify it freely"""
+    questionnaire = questionnaire_cache.get((form_name, form_version))
+    return deepcopy(questionnaire) if questionnaire is not None else None
+
+
+def cache_questionnaire(questionnaire: dict, form_version: str | None) -> None:
+    """Cache a found Questionnaire under the requested version and its own version, OperationOutcomes are not cached"""
+    if questionnaire["resourceType"] != "Questionnaire":
+        return
+    questionnaire_copy = deepcopy(questionnaire)
+    questionnaire_cache.set((questionnaire["name"], form_version), questionnaire_copy)
+    if form_version is None and "version" in questionnaire:
+        questionnaire_cache.set((questionnaire["name"], questionnaire["version"]), questionnaire_copy)
+
+
+def invalidate_cached_questionnaire(form_name: str | None = None) -> None:
+    """Drop every cached version of a Questionnaire, or the whole cache if no name is given. Other processes clear their whole cache on their next sync."""
+    publish_cache_invalidation(questionnaire_cache.name, linking_plan_cache.name)
+    if form_name is None:
+        questionnaire_cache.clear()
+        linking_plan_cache.clear()
+        logger.info("Cleared Questionnaire cache")
+        return
+    removed = questionnaire_cache.invalidate_where(lambda key: key[0] == form_name)
+    linking_plan_cache.invalidate_where(lambda key: key[0] == form_name)
+    logger.info(f"Invalidated {removed} cached version(s) of Questionnaire {form_name}")
+
+
+def get_linking_plan(form: dict) -> LinkingPlan:
+    """Returns the linking plan for a Questionnaire, built on first use and cached per Questionnaire version. Callers must not modify it."""
+    meta: dict = form.get("meta", {})
+    plan_key = (form.get("name"), form.get("version"), meta.get("versionId"), meta.get("lastUpdated"))
+    linking_plan: LinkingPlan | None = linking_plan_cache.get(plan_key) if form.get("name") else None
+    if linking_plan is None:
+        linking_plan = build_linking_plan(form)
+        if form.get("name"):
+            linking_plan_cache.set(plan_key, linking_plan)
+    return linking_plan
+
+
+def build_linking_plan(form: dict) -> LinkingPlan:
+    """Walks the Questionnaire once, reading the cqlTask, nlpqlTask and cardinality extensions of each question"""
+    linking_plan = LinkingPlan()
+    for group in form.get("item", []):
+        for question in group.get("item", []):
+            linking_plan.question_count += 1
+            extensions: dict[str, str] = {extension.get("url"): extension.get("valueString") for extension in question.get("extension", [])}
+            for task_url, plan_questions, questions_by_library in (
+                (cql_task_url, linking_plan.cql_questions, linking_plan.cql_questions_by_library),
+                (nlpql_task_url, linking_plan.nlpql_questions, linking_plan.nlpql_questions_by_library),
+            ):
+                library_task: list[str] = (extensions.get(task_url) or "").split(".")
+                if len(library_task) != 2 or not library_task[0]:
+                    continue
+                plan_question = LinkingPlanQuestion(
+                    position=linking_plan.question_count,
+                    linkId=question["linkId"],
+                    text=question.get("text"),
+                    type=question.get("type"),
+                    library=library_task[0],
+                    task=library_task[1],
+                    cardinality=extensions.get(cardinality_url) or "",
+                )
+                plan_questions.append(plan_question)
+                questions_by_library.setdefault(plan_question.library, []).append(plan_question)
+    return linking_plan
+
+
+def get_library_questions(questions_by_library: dict[str, list[LinkingPlanQuestion]], library_names: Iterable[str]) -> list[LinkingPlanQuestion]:
+    """Questions mapped to the given libraries in a linking plan index, merged back into form order"""
+    library_questions = [questions_by_library[library_name] for library_name in dict.fromkeys(library_names) if library_name in questions_by_library]
+    return list(heapq.merge(*library_questions, key=lambda question: question.position))
+
+
+def get_evaluated_questions(questions_by_library: dict[str, list[LinkingPlanQuestion]], questions: list[LinkingPlanQuestion], library_names: list[str]) -> list[LinkingPlanQuestion]:
+    """
+    Questions to link for the evaluated libraries. Results are matched to questions by task name alone, so when any evaluated library has no questions
+    mapped to its name, e.g. its task prefix in the Questionnaire differs from the server Library.name, every question of the task type is used.
+    """
+    unmapped_library_names = [library_name for library_name in dict.fromkeys(library_names) if library_name not in questions_by_library]
+    if unmapped_library_names:
+        logger.warning(f"No questions are mapped to libraries {unmapped_library_names}, linking every question of their task type against the results")
+        return questions
+    return get_library_questions(questions_by_library, library_names)
+
+
+def questionnaire_search_path(form_name: str, form_version: str | None) -> str:
+    """Search for a specific version of a Questionnaire, or the most recently updated one if no version is given"""
     if form_version:
-        req: httpx.Response = httpx_client.get(cqfr4_fhir + f"Questionnaire?name:exact={form_name}&version={form_version}")
-        if req.status_code != 200:
-            logger.error(f"Getting Questionnaire from server failed with status code {req.status_code}")
-            return make_operation_outcome("transient", f"Getting Questionnaire from server failed with code {req.status_code}")
-    else:
-        req = httpx_client.get(cqfr4_fhir + f"Questionnaire?name:exact={form_name}&_sort=-_lastUpdated")
-        if req.status_code != 200:
-            logger.error(f"Getting Questionnaire from server failed with status code {req.status_code}")
-            return make_operation_outcome("transient", f"Getting Questionnaire from server failed with code {req.status_code}")
+        return f"Questionnaire?name:exact={form_name}&version={form_version}"
+    return f"Questionnaire?name:exact={form_name}&_sort=-_lastUpdated"
+
+
+def questionnaire_from_search_response(req: httpx.Response, form_name: str, form_version: str | None) -> dict:
+    """Pulls the first Questionnaire out of a search response, or returns an OperationOutcome describing why it could not"""
+    if req.status_code != 200:
+        logger.error(f"Getting Questionnaire from server failed with status code {req.status_code}")
+        return make_operation_outcome("transient", f"Getting Questionnaire from server failed with code {req.status_code}")
 
     search_bundle = req.json()
     try:
         questionnaire = search_bundle["entry"][0]["resource"]
         logger.info(f"Found Questionnaire with name {form_name}, version {questionnaire['version']}, and form server ID {questionnaire['id']}")
-        return questionnaire if not return_Questionnaire_class_obj else Questionnaire.parse_obj(questionnaire)
+        return questionnaire
     except (KeyError, IndexError):
         logger.error(f"Questionnaire with name {form_name} and version {form_version} not found") if form_version else logger.error(f"Questionnaire with name {form_name} not found")
         return (
@@ -104,7 +233,7 @@ def get_form(form_name: str, form_version: str | None = None, return_Questionnai
         )
 
 
-def run_diagnostic_questionnaire(run_all_jobs: bool, libs_to_run: list, form: dict) -> dict:
+async def run_diagnostic_questionnaire(run_all_jobs: bool, libs_to_run: list, form: dict) -> dict:
     return_bundle = {"resourceType": "Bundle", "id": str(uuid.uuid4()), "type": "collection", "entry": []}
     return_bundle["entry"].append({"fullUrl": "Patient/0", "resource": {"resourceType": "Patient", "id": "0"}})
     if run_all_jobs:
@@ -115,9 +244,9 @@ def run_diagnostic_questionnaire(run_all_jobs: bool, libs_to_run: list, form: di
     library = libs_to_run[0]
     full_job_list = [item["valueString"] for item in form["extension"][0]["extension"]]
     library_index = full_job_list.index(library)
-    sleep_time = 30  # (library_index + 1) * 30 this is commented out due to blocking method making things go sequentially when this happens
+    sleep_time = 30  # (library_index + 1) * 30 could be used to stagger diagnostic jobs now that the sleep no longer blocks the event loop
     logger.info(f"Running {library.strip('.cql')} and will be sleeping for {sleep_time} seconds")
-    time.sleep(sleep_time)
+    await asyncio.sleep(sleep_time)
 
     obs_id = str(uuid.uuid4())
 
@@ -2,8 +2,11 @@
 
 import asyncio
 import base64
+import json
 import re
+import time
 import uuid
+from collections.abc import Awaitable, Callable
 from copy import deepcopy
 from datetime import datetime, timezone
 from typing import Literal, overload
@@ -14,22 +17,39 @@ from fhir.resources.R4B.operationoutcome import OperationOutcome
 from fhir.resources.R4B.reference import Reference
 from loguru import logger
 
-from src.models.forms import get_form, run_diagnostic_questionnaire
+from src.models.forms import get_evaluated_questions, get_form_async, get_linking_plan, run_diagnostic_questionnaire
 from src.models.models import FlatNLPQLResult, NLPQLTupleResult, StartJobsParameters
+from src.services.documenthandler import fetch_document_references
 from src.services.errorhandler import make_operation_outcome
+from src.services.libraryhandler import cache_nlpql_registration, get_nlpql_registration, invalidate_nlpql_registration, resolve_libraries
+from src.services.scheduler import job_scheduler
+from src.services.tupleparser import TupleParseError, parse_cql_tuples, parse_nlpql_answer_value, parse_nlpql_tuple
+from src.util.httpclients import get_async_client
 from src.util.settings import cqfr4_fhir, deploy_url, external_fhir_server_auth, external_fhir_server_url, httpx_client, nlpaas_url
 
 
-async def run_cql(library_ids: list, parameters_post: dict):
-    transport: httpx.AsyncHTTPTransport = httpx.AsyncHTTPTransport(retries=5)
-    async with httpx.AsyncClient(timeout=300, transport=transport) as client:
-        tasks = [client.post(f"{cqfr4_fhir}Library/{library_id}/$evaluate", json=parameters_post) for library_id in library_ids]
-        responses: list[httpx.Response] = await asyncio.gather(*tasks)
+async def run_cql(library_ids: list, parameters_post: dict, on_response: Callable[[int, httpx.Response], Awaitable[None]] | None = None):
+    """Evaluate every CQL Library concurrently, passing each response to on_response (with its index in library_ids) as soon as it arrives"""
+    client = get_async_client("cqf_ruler")
+
+    async def evaluate(index, library_id):
+        async with job_scheduler.evaluation_slot("cqf_ruler"):
+            response = await client.post(f"{cqfr4_fhir}Library/{library_id}/$evaluate", json=parameters_post)
+        if on_response:
+            await on_response(index, response)
+        return response
+
+    responses: list[httpx.Response] = await asyncio.gather(*[evaluate(index, library_id) for index, library_id in enumerate(library_ids)])
     return responses
 
 
-async def run_nlpql(library_ids: list, patient_id: str, external_fhir_server_url_string: str, external_fhir_server_auth: str):
-    """Create an asynchronous HTTP Request session for evaluating NLPQL Libraries using httpx"""
+async def run_nlpql(
+    library_ids: list, patient_id: str, external_fhir_server_url_string: str, external_fhir_server_auth: str, on_response: Callable[[int, httpx.Response], Awaitable[None]] | None = None
+):
+    """
+    Fetch, register, and execute every NLPQL Library with NLPaaS concurrently, returning the execution responses or the first OperationOutcome. Each
+    execution response is also passed to on_response (with its index in library_ids) as soon as it arrives.
+    """
 
     def build_post_body() -> dict:
         body = {"patient_id": patient_id, "fhir": {"service_url": external_fhir_server_url_string}}
@@ -58,17 +78,49 @@ async def run_nlpql(library_ids: list, patient_id: str, external_fhir_server_url
         job_url = reg_req.json()["location"].lstrip("/")
         return job_url, None
 
-    nlpql_post_body = build_post_body()
-    transport: httpx.AsyncHTTPTransport = httpx.AsyncHTTPTransport(retries=5)
-    async with httpx.AsyncClient(timeout=300, transport=transport) as client:
-        tasks = []
-        for library_id in library_ids:
-            nlpql_plain_text = await get_nlpql_text(client, library_id)
-            job_url, error = await register_nlpql(client, nlpql_plain_text)
+    async def execute(nlpaas_client, job_url) -> httpx.Response:
+        async with job_scheduler.evaluation_slot("nlpaas"):
+            return await nlpaas_client.post(f"{nlpaas_url}{job_url}", json=nlpql_post_body)
+
+    async def register_and_cache(nlpaas_client, library_id, nlpql_plain_text):
+        job_url, error = await register_nlpql(nlpaas_client, nlpql_plain_text)
+        if job_url:
+            cache_nlpql_registration(library_id, nlpql_plain_text, job_url)
+        return job_url, error
+
+    async def fetch_register_and_execute(cqfr4_client, nlpaas_client, index, library_id):
+        """
+        Runs one library end to end so its execution starts as soon as its own registration completes. The Library is always fetched, and a cached
+        registration is reused only when it was made with the same NLPQL.
+        """
+        nlpql_plain_text = await get_nlpql_text(cqfr4_client, library_id)
+        job_url = get_nlpql_registration(library_id, nlpql_plain_text)
+        registration_cached = job_url is not None
+        if registration_cached:
+            logger.info(f"Reusing NLPaaS registration {job_url} for Library/{library_id}")
+        else:
+            job_url, error = await register_and_cache(nlpaas_client, library_id, nlpql_plain_text)
+            if error:
+                return error
+        execute_req = await execute(nlpaas_client, job_url)
+        if registration_cached and execute_req.status_code == 404:
+            logger.warning(f"NLPaaS does not recognize job {job_url} for Library/{library_id}, registering the library again")
+            invalidate_nlpql_registration(library_id)
+            job_url, error = await register_and_cache(nlpaas_client, library_id, nlpql_plain_text)
             if error:
                 return error
-            tasks.append(client.post(f"{nlpaas_url}{job_url}", json=nlpql_post_body))
-        responses = await asyncio.gather(*tasks)
+            execute_req = await execute(nlpaas_client, job_url)
+        if on_response:
+            await on_response(index, execute_req)
+        return execute_req
+
+    nlpql_post_body = build_post_body()
+    cqfr4_client = get_async_client("cqf_ruler")
+    nlpaas_client = get_async_client("nlpaas")
+    responses = await asyncio.gather(*[fetch_register_and_execute(cqfr4_client, nlpaas_client, index, library_id) for index, library_id in enumerate(library_ids)])
+    for response in responses:
+        if isinstance(response, dict):
+            return response
     return responses
 
 
@@ -211,437 +263,424 @@ def check_results(results: list[dict]):
     return None
 
 
-def create_linked_results(results_in: list, form_name: str, patient_id: str):
-    """Creates the registry bundle from CQL and NLPQL results"""
+async def get_patient_resource(patient_id: str) -> dict:
+    """Reads the Patient from the external FHIR server, for Bundles without CQL results to take it from"""
+    external_fhir_headers = {"Authorization": external_fhir_server_auth} if external_fhir_server_auth else None
+    return (await get_async_client("external_fhir").get(external_fhir_server_url + f"Patient/{patient_id}", headers=external_fhir_headers)).json()
 
-    # Get form (using get_form from this API)
-    form = get_form(form_name=form_name, form_version=None, return_Questionnaire_class_obj=False)
+
+def merge_linked_bundles(bundles: list[dict]) -> dict:
+    """Combines linked Bundles into one, keeping the first entry for each fullUrl such as the Patient every Bundle starts with"""
+    bundle_entries = []
+    bundle_full_urls: set[str] = set()
+    for bundle in bundles:
+        for entry in bundle["entry"]:
+            if "fullUrl" in entry:
+                if entry["fullUrl"] in bundle_full_urls:
+                    continue
+                bundle_full_urls.add(entry["fullUrl"])
+            bundle_entries.append(entry)
+    return {"resourceType": "Bundle", "id": str(uuid.uuid4()), "type": "collection", "entry": bundle_entries, "total": len(bundle_entries)}
+
+
+async def create_linked_results(results_in: list, form_name: str, patient_id: str, form: dict | None = None, patient_resource: dict | None = None):
+    """Creates the registry bundle from CQL and NLPQL results. patient_resource is used for NLPQL-only results instead of reading the Patient again."""
+
+    # Get form (using get_form_async from this API) unless the caller already has it
+    if form is None:
+        form = await get_form_async(form_name=form_name, form_version=None)
     results_cql = results_in[0]
     results_nlpql = results_in[1]
 
     return_bundle_cql = {}
     return_bundle_nlpql = {}
-    target_library: str = ""
+    # fullUrls already in the CQL Bundle, kept up to date as entries are added so membership checks do not rebuild a list of every entry
+    bundle_full_urls: set[str] = set()
 
     if results_cql:
         bundle_entries = []
-        result_length = len(results_cql)
-        if result_length == 1:
-            result = results_cql[0]
-            target_library = result["libraryName"]
-
         results: dict[str, str | dict] = flatten_results(results_cql, result_type="cql")
         logger.info("Flattened CQL Results into the dictionary")
         logger.debug(results)
 
         try:
-            patient_resource = results["Patient"] if isinstance(results["Patient"], dict) else {}
-            patient_bundle_entry: dict[str, str | dict] = {"fullUrl": f"Patient/{patient_id}", "resource": patient_resource}
+            cql_patient_resource = results["Patient"] if isinstance(results["Patient"], dict) else {}
+            patient_bundle_entry: dict[str, str | dict] = {"fullUrl": f"Patient/{patient_id}", "resource": cql_patient_resource}
             bundle_entries.append(patient_bundle_entry)
+            bundle_full_urls.add(patient_bundle_entry["fullUrl"])  # type: ignore
         except KeyError:
             logger.error("Patient resource not found in results, results from CQF Ruler are logged below")
             logger.error(results)
             return make_operation_outcome("not-found", "Patient resource not found in results from CQF Ruler, see logs for more details")
 
-        # For each group of questions in the form
-        total_item_count = 0
-        for group in form["item"]:
-            total_item_count += len(group["item"])
-        current_item_count = 0
-
-        for group in form["item"]:
-            # For each question in the group in the form
-            for question in group["item"]:
-                current_item_count += 1
-                link_id = question["linkId"]
-                question_text = question["text"]
-                logger.info(f"Working on question {link_id} - {current_item_count}/{total_item_count} ({current_item_count / total_item_count * 100:0.2f}%)")
-                library_task: str = ""
-                cardinality: str = ""
-                # If the question has these extensions, get their values, if not, keep going
-                try:
-                    for extension in question["extension"]:
-                        if extension["url"] == "http://gtri.gatech.edu/fakeFormIg/cqlTask":
-                            library_task = extension["valueString"]
-                        if extension["url"] == "http://gtri.gatech.edu/fakeFormIg/cardinality":
-                            cardinality = extension["valueString"]
-                    library, task = library_task.split(".")
-                    logger.debug(f"CQL Processing: Using library {library} and task {task} for this question")
-                except (KeyError, ValueError):
-                    logger.info("No CQL Task found for this question, moving onto next question")
-                    continue
-
-                if result_length == 1 and library != target_library:
-                    continue
+        # Only the questions mapped to the evaluated libraries, from the linking plan cached for this Questionnaire version
+        linking_plan = get_linking_plan(form)
+        cql_questions = get_evaluated_questions(linking_plan.cql_questions_by_library, linking_plan.cql_questions, [result["libraryName"] for result in results_cql])
+        for current_item_count, question in enumerate(cql_questions, start=1):
+            link_id = question.linkId
+            question_text = question.text
+            library, task, cardinality = question.library, question.task, question.cardinality
+            logger.info(f"Working on question {link_id} - {current_item_count}/{len(cql_questions)} ({current_item_count / len(cql_questions) * 100:0.2f}%)")
+            logger.debug(f"CQL Processing: Using library {library} and task {task} for this question")
+
+            # Create answer observation for this question
+            answer_obs_uuid = str(uuid.uuid4())
+            answer_obs = {
+                "resourceType": "Observation",
+                "id": answer_obs_uuid,
+                "identifier": [{"system": deploy_url, "value": f"Observation/{answer_obs_uuid}"}],
+                "status": "final",
+                "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
+                "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id, "display": question_text}]},
+                "effectiveDateTime": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "subject": {"reference": f"Patient/{patient_id}"},
+                "focus": [],
+            }
+            answer_obs = Observation(**answer_obs)
 
-                # Create answer observation for this question
-                answer_obs_uuid = str(uuid.uuid4())
-                answer_obs = {
-                    "resourceType": "Observation",
-                    "id": answer_obs_uuid,
-                    "identifier": [{"system": deploy_url, "value": f"Observation/{answer_obs_uuid}"}],
-                    "status": "final",
-                    "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
-                    "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id, "display": question_text}]},
-                    "effectiveDateTime": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
-                    "subject": {"reference": f"Patient/{patient_id}"},
-                    "focus": [],
-                }
-                answer_obs = Observation(**answer_obs)
-
-                # Find the result in the CQL library run that corresponds to what the question has defined in its cqlTask extension
-                # target_result = None
-                single_return_value = None
-                supporting_resources: list[dict] = []
-                empty_single_return = False
-                tuple_flag = False
-                tuple_string = ""
+            # Find the result in the CQL library run that corresponds to what the question has defined in its cqlTask extension
+            # target_result = None
+            single_return_value = None
+            supporting_resources: list[dict] = []
+            empty_single_return = False
+            tuple_flag = False
 
-                try:
-                    value_return = results[task]
-                except KeyError:
-                    logger.error(
-                        f"The task {task} was not found in the library {library}, please ensure your CQL or NLPQL is returning a result for this. Moving onto the next question to handle processsing timeouts."
-                    )
-                    continue
-                try:
-                    if isinstance(value_return, dict) and value_return["resourceType"] == "Bundle":
-                        supporting_resources = value_return["entry"]
-                        # single_resource_flag = False
-                        logger.info(f"Found task {task} and supporting resources")
-                    else:
-                        # resource_type = value_return['resourceType']
-                        # single_resource_flag = True
-                        single_return_value = value_return
-                        logger.info(f"Found task {task} result")
-                except (KeyError, TypeError):
+            try:
+                value_return = results[task]
+            except KeyError:
+                logger.error(
+                    f"The task {task} was not found in the library {library}, please ensure your CQL or NLPQL is returning a result for this. Moving onto the next question to handle processsing timeouts."
+                )
+                continue
+            try:
+                if isinstance(value_return, dict) and value_return["resourceType"] == "Bundle":
+                    supporting_resources = value_return["entry"]
+                    # single_resource_flag = False
+                    logger.info(f"Found task {task} and supporting resources")
+                else:
+                    # resource_type = value_return['resourceType']
+                    # single_resource_flag = True
                     single_return_value = value_return
-                    logger.debug(f"Found single return value {single_return_value}")
-
-                if task + "_evidence" in results:  # Support for if theres a string response as well as supporting resources
-                    supporting_resources = results[task + "_evidence"]["entry"] if isinstance(results[task + "_evidence"], dict) else None  # type: ignore
-
-                if single_return_value in ["[]", "null"]:
-                    empty_single_return = True
-                    logger.info("Empty single return")
-                if not single_return_value:
-                    empty_single_return = True
-                if isinstance(single_return_value, str) and single_return_value[0:6] == "[Tuple":
-                    tuple_flag = True
-                    logger.info("Found Tuple in results")
-                if supporting_resources:
-                    answer_obs_focus_list = []
-                    for resource in supporting_resources:
-                        try:
-                            answer_obs_focus_list.append(Reference.model_construct(reference=resource["fullUrl"]))
-                        except KeyError:
-                            pass
-                    answer_obs.focus = answer_obs_focus_list
-                if empty_single_return and not supporting_resources:
-                    continue
+                    logger.info(f"Found task {task} result")
+            except (KeyError, TypeError):
+                single_return_value = value_return
+                logger.debug(f"Found single return value {single_return_value}")
+
+            if task + "_evidence" in results:  # Support for if theres a string response as well as supporting resources
+                supporting_resources = results[task + "_evidence"]["entry"] if isinstance(results[task + "_evidence"], dict) else None  # type: ignore
+
+            if single_return_value in ["[]", "null"]:
+                empty_single_return = True
+                logger.info("Empty single return")
+            if not single_return_value:
+                empty_single_return = True
+            if isinstance(single_return_value, str) and single_return_value[0:6] == "[Tuple":
+                tuple_flag = True
+                logger.info("Found Tuple in results")
+            if supporting_resources:
+                answer_obs_focus_list = []
+                for resource in supporting_resources:
+                    try:
+                        answer_obs_focus_list.append(Reference.model_construct(reference=resource["fullUrl"]))
+                    except KeyError:
+                        pass
+                answer_obs.focus = answer_obs_focus_list
+            if empty_single_return and not supporting_resources:
+                continue
 
-                answer_obs = answer_obs.model_dump()
-                if isinstance(answer_obs["effectiveDateTime"], datetime):
-                    answer_obs["effectiveDateTime"] = answer_obs["effectiveDateTime"].strftime("%Y-%m-%dT%H:%M:%SZ")
-                try:
-                    if answer_obs["focus"] == []:
-                        logger.debug("Answer Observation does not have a focus, deleting field")
-                        del answer_obs["focus"]
-                except KeyError:
-                    pass
-
-                # If cardinality is a series, does the standard return body format
-                if cardinality == "series" and not tuple_flag:
-                    # Construct final answer object bundle before result bundle insertion
-                    answer_obs_bundle_item = {"fullUrl": "Observation/" + answer_obs_uuid, "resource": answer_obs}
+            answer_obs = answer_obs.model_dump()
+            if isinstance(answer_obs["effectiveDateTime"], datetime):
+                answer_obs["effectiveDateTime"] = answer_obs["effectiveDateTime"].strftime("%Y-%m-%dT%H:%M:%SZ")
+            try:
+                if answer_obs["focus"] == []:
+                    logger.debug("Answer Observation does not have a focus, deleting field")
+                    del answer_obs["focus"]
+            except KeyError:
+                pass
 
-                # If cardinality is a single, does a modified return body to have the value in multiple places
-                else:
-                    single_answer = single_return_value
-                    logger.debug(f"Single Answer: {single_answer}")
-
-                    # value_key = 'value'+single_return_type
-                    if tuple_flag is False:
-                        answer_obs["valueString"] = single_answer
-                        answer_obs_bundle_item = {"fullUrl": "Observation/" + answer_obs_uuid, "resource": answer_obs}
-                    elif tuple_flag and isinstance(single_answer, str):
-                        tuple_string = single_answer.strip("[]")
-                        tuple_string = tuple_string.split("Tuple ")
-                        tuple_string.remove("")
-                        tuple_dict_list = []
-                        for item in tuple_string:
-                            new_item = item.strip(", ")
-                            new_item = new_item.replace("\n", "").strip("{ }").replace('"', "")
-                            new_item_list = new_item.split("\t")
-                            new_item_list.remove("")
-                            test_dict = {}
-                            for new_item in new_item_list:
-                                new_item_split = new_item.split(": ")
-                                key = new_item_split[0]
-                                value = ": ".join(new_item_split[1:])
-                                test_dict[key] = value
-                            tuple_dict_list.append(test_dict)
-                        tuple_observations = []
-                        for answer_tuple in tuple_dict_list:
-                            answer_value_split = answer_tuple["answerValue"].split("^")
-                            if answer_value_split[0] == "null":
-                                logger.warning("Found a null in tuple results, please investigate for possible data error")
-                                continue
-                            logger.debug(f"Tuple found: {answer_value_split}")
-                            if "." in answer_tuple["fhirField"]:
-                                supporting_resource_type = answer_tuple["fhirField"].split(".")[0]
-                            else:
-                                supporting_resource_type_map = {"dosage": "MedicationStatement", "value": "Observation", "onset": "Condition", "code": "Observation", "Procedure.code": "Procedure"}
-                                try:
-                                    supporting_resource_type = supporting_resource_type_map[answer_tuple["fhirField"]]
-                                except KeyError:
-                                    return make_operation_outcome(
-                                        "not-found",
-                                        ("The fhirField thats being returned in the CQL is not a supported the supporting resource type, this needs to be updated as more resources are added"),
-                                    )
-
-                            value_type = answer_tuple["valueType"]
-                            temp_uuid = str(uuid.uuid4())
-                            supporting_resource_id = answer_tuple["fhirResourceId"].split("/")[-3] if "_history" in answer_tuple["fhirResourceId"] else answer_tuple["fhirResourceId"].split("/")[-1]
-
-                            if len(answer_value_split) >= 3:
-                                effective_datetime = answer_value_split[0]
-                                if len(effective_datetime) == 19:  # case when UTC but no Z
-                                    effective_datetime += "Z"
-                            else:
-                                effective_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-                            temp_answer_obs = {
-                                "resourceType": "Observation",
-                                "id": temp_uuid,
-                                "identifier": [{"system": deploy_url, "value": f"Observation/{answer_obs_uuid}"}],
-                                "status": "final",
-                                "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
-                                "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id}]},
+            # If cardinality is a series, does the standard return body format
+            if cardinality == "series" and not tuple_flag:
+                # Construct final answer object bundle before result bundle insertion
+                answer_obs_bundle_item = {"fullUrl": "Observation/" + answer_obs_uuid, "resource": answer_obs}
+
+            # If cardinality is a single, does a modified return body to have the value in multiple places
+            else:
+                single_answer = single_return_value
+                logger.debug(f"Single Answer: {single_answer}")
+
+                # value_key = 'value'+single_return_type
+                if tuple_flag is False:
+                    answer_obs["valueString"] = single_answer
+                    answer_obs_bundle_item = {"fullUrl": "Observation/" + answer_obs_uuid, "resource": answer_obs}
+                elif tuple_flag and isinstance(single_answer, str):
+                    answer_tuples, tuple_errors = parse_cql_tuples(single_answer)
+                    for tuple_error in tuple_errors:
+                        logger.error(f"Skipping a tuple result of question {link_id} for task {task} that could not be parsed: {tuple_error}")
+                    tuple_observations = []
+                    for answer_tuple in answer_tuples:
+                        answer_value_split = answer_tuple.answer_value_parts
+                        if answer_value_split[0] == "null":
+                            logger.warning("Found a null in tuple results, please investigate for possible data error")
+                            continue
+                        logger.debug(f"Tuple found: {answer_value_split}")
+                        if "." in answer_tuple.fhirField:
+                            supporting_resource_type = answer_tuple.fhirField.split(".")[0]
+                        else:
+                            supporting_resource_type_map = {"dosage": "MedicationStatement", "value": "Observation", "onset": "Condition", "code": "Observation", "Procedure.code": "Procedure"}
+                            try:
+                                supporting_resource_type = supporting_resource_type_map[answer_tuple.fhirField]
+                            except KeyError:
+                                return make_operation_outcome(
+                                    "not-found",
+                                    ("The fhirField thats being returned in the CQL is not a supported the supporting resource type, this needs to be updated as more resources are added"),
+                                )
+
+                        value_type = answer_tuple.valueType
+                        temp_uuid = str(uuid.uuid4())
+                        supporting_resource_id = answer_tuple.supporting_resource_id
+
+                        if len(answer_value_split) >= 3:
+                            effective_datetime = answer_value_split[0]
+                            if len(effective_datetime) == 19:  # case when UTC but no Z
+                                effective_datetime += "Z"
+                        else:
+                            effective_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+                        temp_answer_obs = {
+                            "resourceType": "Observation",
+                            "id": temp_uuid,
+                            "identifier": [{"system": deploy_url, "value": f"Observation/{answer_obs_uuid}"}],
+                            "status": "final",
+                            "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
+                            "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id}]},
+                            "effectiveDateTime": effective_datetime,
+                            "subject": {"reference": f"Patient/{patient_id}"},
+                            "focus": [{"reference": supporting_resource_type + "/" + supporting_resource_id}],
+                            "note": [{"text": answer_tuple.sourceNote}],
+                            "valueString": answer_tuple.answerValue,
+                        }
+                        temp_answer_obs_entry = {"fullUrl": f"Observation/{temp_uuid}", "resource": temp_answer_obs}
+                        tuple_observations.append(temp_answer_obs_entry)
+
+                        # Create focus reference from data
+                        if supporting_resource_type == "MedicationStatement":
+                            supporting_resource = {
+                                "resourceType": "MedicationStatement",
+                                "id": supporting_resource_id,
+                                "identifier": [
+                                    {
+                                        "system": deploy_url,
+                                        "value": "MedicationStatement/" + supporting_resource_id,
+                                    }
+                                ],
+                                "status": "active",
+                                "medicationCodeableConcept": {
+                                    "coding": [
+                                        {
+                                            "system": answer_value_split[1],
+                                            "code": answer_value_split[2],
+                                            "display": answer_value_split[3],
+                                        }
+                                    ]
+                                },
                                 "effectiveDateTime": effective_datetime,
                                 "subject": {"reference": f"Patient/{patient_id}"},
-                                "focus": [{"reference": supporting_resource_type + "/" + supporting_resource_id}],
-                                "note": [{"text": answer_tuple["sourceNote"]}],
-                                "valueString": answer_tuple["answerValue"],
+                                "dosage": [{"doseAndRate": [{"doseQuantity": {"value": answer_value_split[4], "unit": answer_value_split[5]}}]}],
                             }
-                            temp_answer_obs_entry = {"fullUrl": f"Observation/{temp_uuid}", "resource": temp_answer_obs}
-                            tuple_observations.append(temp_answer_obs_entry)
-
-                            # Create focus reference from data
-                            if supporting_resource_type == "MedicationStatement":
-                                supporting_resource = {
-                                    "resourceType": "MedicationStatement",
-                                    "id": supporting_resource_id,
-                                    "identifier": [
+                            # try:
+                            #     if external_fhir_server_auth:
+                            #         supporting_resource_req = session.get(external_fhir_server_url+"MedicationStatement/"+supporting_resource_id,
+                            #                                                          headers={'Authorization': external_fhir_server_auth})
+                            #         supporting_resource = supporting_resource_req.json()
+                            #     else:
+                            #         supporting_resource_req  = session.get(external_fhir_server_url+"MedicationStatement/"+supporting_resource_id)
+                            #         supporting_resource = supporting_resource_req.json()
+                            # except json.JSONDecodeError:
+                            #     logger.debug(f'Trying to find supporting resource with id MedicationStatement/{supporting_resource_id} '
+                            #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
+                            supporting_resource_bundle_entry = {"fullUrl": "MedicationStatement/" + supporting_resource["id"], "resource": supporting_resource}
+                        elif supporting_resource_type == "MedicationRequest":
+                            supporting_resource = {
+                                "resourceType": "MedicationRequest",
+                                "id": supporting_resource_id,
+                                "identifier": [
+                                    {
+                                        "system": deploy_url,
+                                        "value": "MedicationRequest/" + supporting_resource_id,
+                                    }
+                                ],
+                                "status": "active",
+                                "intent": "order",
+                                "medicationCodeableConcept": {
+                                    "coding": [
                                         {
-                                            "system": deploy_url,
-                                            "value": "MedicationStatement/" + supporting_resource_id,
+                                            "system": answer_value_split[1],
+                                            "code": answer_value_split[2],
+                                            "display": answer_value_split[3],
                                         }
-                                    ],
-                                    "status": "active",
-                                    "medicationCodeableConcept": {
-                                        "coding": [
-                                            {
-                                                "system": answer_value_split[1],
-                                                "code": answer_value_split[2],
-                                                "display": answer_value_split[3],
-                                            }
-                                        ]
-                                    },
-                                    "effectiveDateTime": effective_datetime,
-                                    "subject": {"reference": f"Patient/{patient_id}"},
-                                    "dosage": [{"doseAndRate": [{"doseQuantity": {"value": answer_value_split[4], "unit": answer_value_split[5]}}]}],
-                                }
-                                # try:
-                                #     if external_fhir_server_auth:
-                                #         supporting_resource_req = session.get(external_fhir_server_url+"MedicationStatement/"+supporting_resource_id,
-                                #                                                          headers={'Authorization': external_fhir_server_auth})
-                                #         supporting_resource = supporting_resource_req.json()
-                                #     else:
-                                #         supporting_resource_req  = session.get(external_fhir_server_url+"MedicationStatement/"+supporting_resource_id)
-                                #         supporting_resource = supporting_resource_req.json()
-                                # except json.JSONDecodeError:
-                                #     logger.debug(f'Trying to find supporting resource with id MedicationStatement/{supporting_resource_id} '
-                                #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
-                                supporting_resource_bundle_entry = {"fullUrl": "MedicationStatement/" + supporting_resource["id"], "resource": supporting_resource}
-                            elif supporting_resource_type == "MedicationRequest":
-                                supporting_resource = {
-                                    "resourceType": "MedicationRequest",
-                                    "id": supporting_resource_id,
-                                    "identifier": [
-                                        {
-                                            "system": deploy_url,
-                                            "value": "MedicationRequest/" + supporting_resource_id,
-                                        }
-                                    ],
-                                    "status": "active",
-                                    "intent": "order",
-                                    "medicationCodeableConcept": {
-                                        "coding": [
-                                            {
-                                                "system": answer_value_split[1],
-                                                "code": answer_value_split[2],
-                                                "display": answer_value_split[3],
-                                            }
-                                        ]
-                                    },
-                                    "authoredOn": effective_datetime,
-                                    "subject": {"reference": f"Patient/{patient_id}"},
-                                    "dosageInstruction": [{"doseAndRate": [{"doseQuantity": {"value": answer_value_split[4], "unit": answer_value_split[5]}}]}],
-                                }
-                                # try:
-                                #     if external_fhir_server_auth:
-                                #         supporting_resource_req = session.get(external_fhir_server_url+"MedicationRequest/"+supporting_resource_id,
-                                #                                                          headers={'Authorization': external_fhir_server_auth})
-                                #         supporting_resource = supporting_resource_req.json()
-                                #     else:
-                                #         supporting_resource_req  = session.get(external_fhir_server_url+"MedicationRequest/"+supporting_resource_id)
-                                #         supporting_resource = supporting_resource_req.json()
-                                # except json.JSONDecodeError:
-                                #     logger.debug(f'Trying to find supporting resource with id MedicationRequest/{supporting_resource_id} '
-                                #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
-                                supporting_resource_bundle_entry = {"fullUrl": "MedicationRequest/" + supporting_resource["id"], "resource": supporting_resource}
-                            elif supporting_resource_type == "Observation":
-                                supporting_resource = {
-                                    "resourceType": "Observation",
-                                    "id": supporting_resource_id,
-                                    "identifier": [
+                                    ]
+                                },
+                                "authoredOn": effective_datetime,
+                                "subject": {"reference": f"Patient/{patient_id}"},
+                                "dosageInstruction": [{"doseAndRate": [{"doseQuantity": {"value": answer_value_split[4], "unit": answer_value_split[5]}}]}],
+                            }
+                            # try:
+                            #     if external_fhir_server_auth:
+                            #         supporting_resource_req = session.get(external_fhir_server_url+"MedicationRequest/"+supporting_resource_id,
+                            #                                                          headers={'Authorization': external_fhir_server_auth})
+                            #         supporting_resource = supporting_resource_req.json()
+                            #     else:
+                            #         supporting_resource_req  = session.get(external_fhir_server_url+"MedicationRequest/"+supporting_resource_id)
+                            #         supporting_resource = supporting_resource_req.json()
+                            # except json.JSONDecodeError:
+                            #     logger.debug(f'Trying to find supporting resource with id MedicationRequest/{supporting_resource_id} '
+                            #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
+                            supporting_resource_bundle_entry = {"fullUrl": "MedicationRequest/" + supporting_resource["id"], "resource": supporting_resource}
+                        elif supporting_resource_type == "Observation":
+                            supporting_resource = {
+                                "resourceType": "Observation",
+                                "id": supporting_resource_id,
+                                "identifier": [
+                                    {
+                                        "system": deploy_url,
+                                        "value": "Observation/" + supporting_resource_id,
+                                    }
+                                ],
+                                "status": "final",
+                                "code": {
+                                    "coding": [
                                         {
-                                            "system": deploy_url,
-                                            "value": "Observation/" + supporting_resource_id,
+                                            "system": answer_value_split[1],
+                                            "code": answer_value_split[2],
+                                            "display": answer_value_split[3],
                                         }
-                                    ],
-                                    "status": "final",
-                                    "code": {
-                                        "coding": [
-                                            {
-                                                "system": answer_value_split[1],
-                                                "code": answer_value_split[2],
-                                                "display": answer_value_split[3],
-                                            }
-                                        ]
-                                    },
-                                    "effectiveDateTime": effective_datetime,
-                                    "subject": {"reference": f"Patient/{patient_id}"},
-                                }
-
-                                match value_type:
-                                    case "Quantity":
-                                        if len(answer_value_split) == 6:
-                                            supporting_resource["valueQuantity"] = {"value": answer_value_split[4], "unit": answer_value_split[5]}
-                                        else:
-                                            supporting_resource["valueQuantity"] = {"value": answer_value_split[4]}
-                                    case "String":
-                                        supporting_resource["valueString"] = answer_value_split[4]
-                                    case "Ratio":
-                                        ratio_numerator, ratio_denominator = answer_value_split[4].split(":")
-                                        supporting_resource["valueRatio"] = {"numerator": {"value": ratio_numerator}, "denominator": {"value": ratio_denominator}}
-                                    case "CodeableConcept":
-                                        supporting_resource["valueCodeableConcept"] = {"coding": [{"system": answer_value_split[4], "code": answer_value_split[5], "display": answer_value_split[6]}]}
-                                    case "Integer":
-                                        supporting_resource["valueInteger"] = int(answer_value_split[4])
-                                    case _:
-                                        supporting_resource["valueString"] = f"value[x] type of {value_type} not being handled in RC-API or CQL"
-
-                                # try:
-                                #     if external_fhir_server_auth:
-                                #         supporting_resource_req = session.get(external_fhir_server_url+"Observation/"+supporting_resource_id,
-                                #                                                          headers={'Authorization': external_fhir_server_auth})
-                                #         supporting_resource = supporting_resource_req.json()
-                                #     else:
-                                #         supporting_resource_req  = session.get(external_fhir_server_url+"Observation/"+supporting_resource_id)
-                                #         supporting_resource = supporting_resource_req.json()
-                                # except json.JSONDecodeError:
-                                #     logger.debug(f'Trying to find supporting resource with id Observation/{supporting_resource_id} '
-                                #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
-                                supporting_resource_bundle_entry = {"fullUrl": "Observation/" + supporting_resource["id"], "resource": supporting_resource}
-                            elif supporting_resource_type == "Condition":
-                                supporting_resource = {
-                                    "resourceType": "Condition",
-                                    "id": supporting_resource_id,
-                                    "identifier": [
+                                    ]
+                                },
+                                "effectiveDateTime": effective_datetime,
+                                "subject": {"reference": f"Patient/{patient_id}"},
+                            }
+
+                            match value_type:
+                                case "Quantity":
+                                    if len(answer_value_split) == 6:
+                                        supporting_resource["valueQuantity"] = {"value": answer_value_split[4], "unit": answer_value_split[5]}
+                                    else:
+                                        supporting_resource["valueQuantity"] = {"value": answer_value_split[4]}
+                                case "String":
+                                    supporting_resource["valueString"] = answer_value_split[4]
+                                case "Ratio":
+                                    ratio_numerator, ratio_denominator = answer_value_split[4].split(":")
+                                    supporting_resource["valueRatio"] = {"numerator": {"value": ratio_numerator}, "denominator": {"value": ratio_denominator}}
+                                case "CodeableConcept":
+                                    supporting_resource["valueCodeableConcept"] = {"coding": [{"system": answer_value_split[4], "code": answer_value_split[5], "display": answer_value_split[6]}]}
+                                case "Integer":
+                                    supporting_resource["valueInteger"] = int(answer_value_split[4])
+                                case _:
+                                    supporting_resource["valueString"] = f"value[x] type of {value_type} not being handled in RC-API or CQL"
+
+                            # try:
+                            #     if external_fhir_server_auth:
+                            #         supporting_resource_req = session.get(external_fhir_server_url+"Observation/"+supporting_resource_id,
+                            #                                                          headers={'Authorization': external_fhir_server_auth})
+                            #         supporting_resource = supporting_resource_req.json()
+                            #     else:
+                            #         supporting_resource_req  = session.get(external_fhir_server_url+"Observation/"+supporting_resource_id)
+                            #         supporting_resource = supporting_resource_req.json()
+                            # except json.JSONDecodeError:
+                            #     logger.debug(f'Trying to find supporting resource with id Observation/{supporting_resource_id} '
+                            #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
+                            supporting_resource_bundle_entry = {"fullUrl": "Observation/" + supporting_resource["id"], "resource": supporting_resource}
+                        elif supporting_resource_type == "Condition":
+                            supporting_resource = {
+                                "resourceType": "Condition",
+                                "id": supporting_resource_id,
+                                "identifier": [
+                                    {
+                                        "system": deploy_url,
+                                        "value": "Condition/" + supporting_resource_id,
+                                    }
+                                ],
+                                "code": {
+                                    "coding": [
                                         {
-                                            "system": deploy_url,
-                                            "value": "Condition/" + supporting_resource_id,
+                                            "system": answer_value_split[1],
+                                            "code": answer_value_split[2],
+                                            "display": answer_value_split[3],
                                         }
-                                    ],
-                                    "code": {
-                                        "coding": [
-                                            {
-                                                "system": answer_value_split[1],
-                                                "code": answer_value_split[2],
-                                                "display": answer_value_split[3],
-                                            }
-                                        ]
-                                    },
-                                    "onsetDateTime": effective_datetime,
-                                    "subject": {"reference": f"Patient/{patient_id}"},
-                                }
-                                # try:
-                                #     if external_fhir_server_auth:
-                                #         supporting_resource_req = session.get(external_fhir_server_url+"Condition/"+supporting_resource_id,
-                                #                                                          headers={'Authorization': external_fhir_server_auth})
-                                #         supporting_resource = supporting_resource_req.json()
-                                #     else:
-                                #         supporting_resource_req  = session.get(external_fhir_server_url+"Condition/"+supporting_resource_id)
-                                #         supporting_resource = supporting_resource_req.json()
-                                # except json.JSONDecodeError:
-                                #     logger.debug(f'Trying to find supporting resource with id Condition/{supporting_resource_id} '
-                                #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
-                                supporting_resource_bundle_entry = {"fullUrl": "Condition/" + supporting_resource["id"], "resource": supporting_resource}
-                            elif supporting_resource_type == "Procedure":
-                                supporting_resource = {
-                                    "resourceType": "Procedure",
-                                    "id": supporting_resource_id,
-                                    "identifier": [
+                                    ]
+                                },
+                                "onsetDateTime": effective_datetime,
+                                "subject": {"reference": f"Patient/{patient_id}"},
+                            }
+                            # try:
+                            #     if external_fhir_server_auth:
+                            #         supporting_resource_req = session.get(external_fhir_server_url+"Condition/"+supporting_resource_id,
+                            #                                                          headers={'Authorization': external_fhir_server_auth})
+                            #         supporting_resource = supporting_resource_req.json()
+                            #     else:
+                            #         supporting_resource_req  = session.get(external_fhir_server_url+"Condition/"+supporting_resource_id)
+                            #         supporting_resource = supporting_resource_req.json()
+                            # except json.JSONDecodeError:
+                            #     logger.debug(f'Trying to find supporting resource with id Condition/{supporting_resource_id} '
+                            #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
+                            supporting_resource_bundle_entry = {"fullUrl": "Condition/" + supporting_resource["id"], "resource": supporting_resource}
+                        elif supporting_resource_type == "Procedure":
+                            supporting_resource = {
+                                "resourceType": "Procedure",
+                                "id": supporting_resource_id,
+                                "identifier": [
+                                    {
+                                        "system": deploy_url,
+                                        "value": "Procedure/" + supporting_resource_id,
+                                    }
+                                ],
+                                "code": {
+                                    "coding": [
                                         {
-                                            "system": deploy_url,
-                                            "value": "Procedure/" + supporting_resource_id,
+                                            "system": answer_value_split[1],
+                                            "code": answer_value_split[2],
+                                            "display": answer_value_split[3],
                                         }
-                                    ],
-                                    "code": {
-                                        "coding": [
-                                            {
-                                                "system": answer_value_split[1],
-                                                "code": answer_value_split[2],
-                                                "display": answer_value_split[3],
-                                            }
-                                        ]
-                                    },
-                                    "performedDateTime": effective_datetime,
-                                    "subject": {"reference": f"Patient/{patient_id}"},
-                                }
-                                # try:
-                                #     if external_fhir_server_auth:
-                                #         supporting_resource_req = session.get(external_fhir_server_url+"Procedure/"+supporting_resource_id,
-                                #                                                          headers={'Authorization': external_fhir_server_auth})
-                                #         supporting_resource = supporting_resource_req.json()
-                                #     else:
-                                #         supporting_resource_req  = session.get(external_fhir_server_url+"Procedure/"+supporting_resource_id)
-                                #         supporting_resource = supporting_resource_req.json()
-                                # except json.JSONDecodeError:
-                                #     logger.debug(f'Trying to find supporting resource with id Procedure/{asupporting_resource_id} '
-                                #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
-                                supporting_resource_bundle_entry = {"fullUrl": "Procedure/" + supporting_resource["id"], "resource": supporting_resource}
-
-                            else:
-                                supporting_resource_bundle_entry = {}
-
-                            tuple_observations.append(supporting_resource_bundle_entry)
-
-                if not tuple_flag and not any(key in answer_obs_bundle_item["resource"] for key in ["focus", "valueString"]):
-                    continue
+                                    ]
+                                },
+                                "performedDateTime": effective_datetime,
+                                "subject": {"reference": f"Patient/{patient_id}"},
+                            }
+                            # try:
+                            #     if external_fhir_server_auth:
+                            #         supporting_resource_req = session.get(external_fhir_server_url+"Procedure/"+supporting_resource_id,
+                            #                                                          headers={'Authorization': external_fhir_server_auth})
+                            #         supporting_resource = supporting_resource_req.json()
+                            #     else:
+                            #         supporting_resource_req  = session.get(external_fhir_server_url+"Procedure/"+supporting_resource_id)
+                            #         supporting_resource = supporting_resource_req.json()
+                            # except json.JSONDecodeError:
+                            #     logger.debug(f'Trying to find supporting resource with id Procedure/{asupporting_resource_id} '
+                            #                  f'failed with status code {supporting_resource_req.status_code}') #type: ignore
+                            supporting_resource_bundle_entry = {"fullUrl": "Procedure/" + supporting_resource["id"], "resource": supporting_resource}
 
-                # Add items to return bundle entry list
-                if not tuple_flag:
-                    if "valueString" in answer_obs_bundle_item["resource"] and not answer_obs_bundle_item["resource"]["valueString"]:
-                        del answer_obs_bundle_item["resource"]["valueString"]
-                    if answer_obs_bundle_item["fullUrl"] not in [item["fullUrl"] for item in bundle_entries]:
-                        bundle_entries.append(answer_obs_bundle_item)
-                else:
-                    bundle_entries.extend(tuple_observations)
-                if supporting_resources is not None:
-                    existing_bundle_urls: list[str] = [item["fullUrl"] for item in bundle_entries]
-                    bundle_entries.extend([res for res in supporting_resources if res["fullUrl"] not in existing_bundle_urls])
+                        else:
+                            supporting_resource_bundle_entry = {}
+
+                        tuple_observations.append(supporting_resource_bundle_entry)
+
+            if not tuple_flag and not any(key in answer_obs_bundle_item["resource"] for key in ["focus", "valueString"]):
+                continue
+
+            # Add items to return bundle entry list
+            if not tuple_flag:
+                if "valueString" in answer_obs_bundle_item["resource"] and not answer_obs_bundle_item["resource"]["valueString"]:
+                    del answer_obs_bundle_item["resource"]["valueString"]
+                if answer_obs_bundle_item["fullUrl"] not in bundle_full_urls:
+                    bundle_entries.append(answer_obs_bundle_item)
+                    bundle_full_urls.add(answer_obs_bundle_item["fullUrl"])
+            else:
+                bundle_entries.extend(tuple_observations)
+                bundle_full_urls.update(entry["fullUrl"] for entry in tuple_observations if "fullUrl" in entry)
+            if supporting_resources is not None:
+                for supporting_resource in supporting_resources:
+                    if supporting_resource["fullUrl"] not in bundle_full_urls:
+                        bundle_entries.append(supporting_resource)
+                        bundle_full_urls.add(supporting_resource["fullUrl"])
 
         return_bundle_id = str(uuid.uuid4())
         return_bundle = {"resourceType": "Bundle", "id": return_bundle_id, "type": "collection", "entry": bundle_entries}
@@ -661,11 +700,6 @@ def create_linked_results(results_in: list, form_name: str, patient_id: str):
 
     if results_nlpql:
         bundle_entries = []
-        result_length = len(results_nlpql)
-        if result_length == 1:
-            result = results_nlpql[0]
-            target_library = result["libraryName"]
-
         patient_resource_id = results_nlpql[0]["patientId"]
 
         flat_nlp_results: dict[str, list[FlatNLPQLResult]] = flatten_results(results_nlpql, result_type="nlpql")
@@ -673,205 +707,169 @@ def create_linked_results(results_in: list, form_name: str, patient_id: str):
         logger.debug(flat_nlp_results)
 
         if not results_cql:  # If there are only NLPQL results, there needs to be a Patient resource in the Bundle
-            if external_fhir_server_auth:
-                patient_resource: dict = httpx_client.get(external_fhir_server_url + f"Patient/{patient_id}", headers={"Authorization": external_fhir_server_auth}).json()
-            else:
-                patient_resource = httpx_client.get(external_fhir_server_url + f"Patient/{patient_id}").json()
+            if patient_resource is None:
+                patient_resource = await get_patient_resource(patient_id)
             patient_bundle_entry = {"fullUrl": f"Patient/{patient_id}", "resource": patient_resource}
             bundle_entries.append(patient_bundle_entry)
 
-        # For each group of questions in the form
-        total_item_count = 0
-        for group in form["item"]:
-            total_item_count += len(group["item"])
-
-        current_item_count = 0
-        supporting_nlp_resource_ids = []
-        for group in form["item"]:
-            # For each question in the group in the form
-            for question in group["item"]:
-                current_item_count += 1
-                link_id = question["linkId"]
-                question_text = question["text"]
-                logger.info(f"Working on question {link_id} - {current_item_count}/{total_item_count} ({current_item_count / total_item_count * 100:0.2f}%)")
-                library_task = "."
-                # If the question has these extensions, get their values, if not, keep going
-                try:
-                    for extension in question["extension"]:
-                        if extension["url"] == "http://gtri.gatech.edu/fakeFormIg/nlpqlTask":
-                            library_task = extension["valueString"]
-                        if extension["url"] == "http://gtri.gatech.edu/fakeFormIg/cardinality":
-                            cardinality = extension["valueString"]
-                    library, task = library_task.split(".")
-                except KeyError:
-                    logger.debug("This question did not have a task extension, moving onto next question")
+        # Fetch every DocumentReference the results point to up front instead of one at a time while walking the questions
+        document_references = await fetch_document_references(result.report_id for task_results in flat_nlp_results.values() for result in task_results if result.tuple and result.report_id)
+
+        supporting_nlp_resource_ids: set[str] = set()
+        # (question, report id, normalized answer) of every answer Observation so far, so repeated NLP hits on the same report are linked once
+        nlpql_answer_keys: set[tuple[str, str | None, str]] = set()
+        # Only the questions mapped to the evaluated libraries, from the linking plan cached for this Questionnaire version
+        linking_plan = get_linking_plan(form)
+        nlpql_questions = get_evaluated_questions(linking_plan.nlpql_questions_by_library, linking_plan.nlpql_questions, [result["libraryName"] for result in results_nlpql])
+        for current_item_count, question in enumerate(nlpql_questions, start=1):
+            link_id = question.linkId
+            question_text = question.text
+            library, task = question.library, question.task
+            logger.info(f"Working on question {link_id} - {current_item_count}/{len(nlpql_questions)} ({current_item_count / len(nlpql_questions) * 100:0.2f}%)")
+            logger.debug(f"NLPQL Processing: Using library {library} and task {task} for this question")
+
+            try:
+                task_result: list[FlatNLPQLResult] = flat_nlp_results[task]
+            except KeyError:
+                logger.info(f"There were no results for NLPQL task {task}, moving onto next question")
+                continue
+
+            answer_obs_template = {
+                "resourceType": "Observation",
+                "status": "final",
+                "identifier": [{"system": deploy_url, "value": "Observation/"}],
+                "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
+                "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id, "display": question_text}]},
+                "focus": [],
+                "subject": {"reference": f"Patient/{patient_resource_id}"},
+            }
+            answer_obs_template = Observation(**answer_obs_template)
+
+            doc_ref_template = {"resourceType": "DocumentReference", "status": "current", "type": {}, "subject": {"reference": f"Patient/{patient_resource_id}"}, "content": []}
+
+            tuple_observations = []
+            supporting_doc_refs = []
+            for result in task_result:
+                if result.sentence and result.report_text and result.sentence.lower() not in re.sub(r"\n+", " ", result.report_text.lower()):
                     continue
-                if library == "":
-                    logger.debug("No NLQPL Task found for this question, moving onto next question")
+                temp_answer_obs = answer_obs_template.model_copy(deep=True)
+                temp_answer_obs_uuid = str(uuid.uuid4())
+                temp_answer_obs.id = temp_answer_obs_uuid
+                temp_answer_obs.identifier[0].value = f"Observation/{temp_answer_obs_uuid}"  # type: ignore
+
+                tuple_str: str | None = result.tuple
+                if not tuple_str:
+                    logger.debug("No tuple result in this NLPQL result, moving to next result in list for task")
                     continue
-                logger.debug(f"NLPQL Processing: Using library {library} and task {task} for this question")
+                logger.debug(f"Found tuple in NLPQL results: {tuple_str}")
 
                 try:
-                    task_result: list[FlatNLPQLResult] = flat_nlp_results[task]
-                except KeyError:
-                    logger.info(f"There were no results for NLPQL task {task}, moving onto next question")
+                    tuple_dict = parse_nlpql_tuple(tuple_str)
+
+                    tuple_result = NLPQLTupleResult(
+                        sourceNote=tuple_dict["sourceNote"],
+                        answerValue=parse_nlpql_answer_value(tuple_dict["answerValue"]),
+                        answerType=tuple_dict["answerType"],
+                    )
+                    tuple_result.sourceNote = tuple_result.sourceNote.strip()
+                except TupleParseError as e:
+                    logger.error(f"Skipping malformed tuple for task {task} in report {result.report_id}: {e}")
+                    continue
+                except Exception as e:
+                    logger.exception(f"Exception while reading tuple for task {task} in report {result.report_id}: {e!r}")
                     continue
 
-                answer_obs_template = {
-                    "resourceType": "Observation",
-                    "status": "final",
-                    "identifier": [{"system": deploy_url, "value": "Observation/"}],
-                    "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "survey", "display": "Survey"}]}],
-                    "code": {"coding": [{"system": f"urn:gtri:heat:form:{form_name}", "code": link_id, "display": question_text}]},
-                    "focus": [],
-                    "subject": {"reference": f"Patient/{patient_resource_id}"},
-                }
-                answer_obs_template = Observation(**answer_obs_template)
-
-                doc_ref_template = {"resourceType": "DocumentReference", "status": "current", "type": {}, "subject": {"reference": f"Patient/{patient_resource_id}"}, "content": []}
-
-                tuple_observations = []
-                supporting_doc_refs = []
-                for result in task_result:
-                    if result.sentence and result.report_text and result.sentence.lower() not in re.sub(r"\n+", " ", result.report_text.lower()):
-                        continue
-                    temp_answer_obs = answer_obs_template.model_copy(deep=True)
-                    temp_answer_obs_uuid = str(uuid.uuid4())
-                    temp_answer_obs.id = temp_answer_obs_uuid
-                    temp_answer_obs.identifier[0].value = f"Observation/{temp_answer_obs_uuid}"  # type: ignore
-
-                    tuple_str: str | None = result.tuple
-                    if not tuple_str:
-                        logger.debug("No tuple result in this NLPQL result, moving to next result in list for task")
-                        continue
-                    logger.debug(f"Found tuple in NLPQL results: {tuple_str}")
+                temp_answer_obs.focus = [Reference.model_construct(reference=f"DocumentReference/{result.report_id}")]
 
+                report_date = result.report_date if result.report_date else datetime.today().strftime("%Y-%m-%d")
+                if len(report_date) > 10:
+                    # Sometimes NLPaaS returns a full timestamp, handle up to seconds. Strip Z if present, or ignore it.
+                    clean_date = report_date.replace("Z", "")
+                    # Try parsing as ISO format or just fallback to string if it fails
                     try:
-                        tuple_dict = eval(f"{{{tuple_str}}}")
-
-                        tuple_result = NLPQLTupleResult(
-                            sourceNote=tuple_dict["sourceNote"],
-                            answerValue=(eval(tuple_dict["answerValue"]) if "{" in tuple_dict["answerValue"] else tuple_dict["answerValue"]),
-                            answerType=tuple_dict["answerType"],
-                        )
-                        tuple_result.sourceNote = tuple_result.sourceNote.strip()
-                    except Exception as e:
-                        logger.exception(f"Exception during tuple eval: {e}")
-                        continue
-
-                    temp_answer_obs.focus = [Reference.model_construct(reference=f"DocumentReference/{result.report_id}")]
-
-                    report_date = result.report_date if result.report_date else datetime.today().strftime("%Y-%m-%d")
-                    if len(report_date) > 10:
-                        # Sometimes NLPaaS returns a full timestamp, handle up to seconds. Strip Z if present, or ignore it.
-                        clean_date = report_date.replace("Z", "")
-                        # Try parsing as ISO format or just fallback to string if it fails
-                        try:
-                            temp_answer_obs.effectiveDateTime = datetime.strptime(clean_date[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
-                        except ValueError:
-                            temp_answer_obs.effectiveDateTime = datetime.strptime(clean_date[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                    else:
-                        temp_answer_obs.effectiveDateTime = datetime.strptime(report_date[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+                        temp_answer_obs.effectiveDateTime = datetime.strptime(clean_date[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+                    except ValueError:
+                        temp_answer_obs.effectiveDateTime = datetime.strptime(clean_date[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
+                else:
+                    temp_answer_obs.effectiveDateTime = datetime.strptime(report_date[:10], "%Y-%m-%d").replace(tzinfo=timezone.utc)
 
-                    if tuple_result.answerType:  # Check to make sure the answer value isnt an empty dictionary
-                        temp_answer_obs.component = make_obs_component_for_nlp_result(tuple_result=tuple_result, result_type=tuple_result.answerType)
-                    else:
-                        continue
-
-                    # Check if an existing match exists to remove duplicates
-                    is_duplicate = False
-                    for obs in tuple_observations:
-                        if all(key in obs for key in ["focus", "valueString"]) and (
-                            obs["focus"] == [{"reference": f"DocumentReference/{result.report_id}"}] and obs["valueString"].lower() == tuple_dict["answerValue"].lower()
-                        ):
-                            is_duplicate = True
-
-                    if not is_duplicate:
-                        temp_answer_obs_dict = temp_answer_obs.model_dump()
-                        if isinstance(temp_answer_obs_dict["effectiveDateTime"], datetime):
-                            temp_answer_obs_dict["effectiveDateTime"] = temp_answer_obs_dict["effectiveDateTime"].strftime("%Y-%m-%dT%H:%M:%SZ")
-                        tuple_observations.append(temp_answer_obs_dict)
-
-                    # Queries for original DocumentReference, adds it to the supporting resources if its not already there or creating a DocumentReference with data from the NLPaaS Return
-                    if result.report_id in supporting_nlp_resource_ids:  # Indicates a DocumentReference is already in there
-                        logger.debug(f"Report id {result.report_id} already in supporting references, moving on")
-                        continue
-                    logger.debug(f"Report id {result.report_id} not in supporting resources yet")
+                if tuple_result.answerType:  # Check to make sure the answer value isnt an empty dictionary
+                    temp_answer_obs.component = make_obs_component_for_nlp_result(tuple_result=tuple_result, result_type=tuple_result.answerType)
+                else:
+                    continue
 
-                    try:
-                        if external_fhir_server_auth and result.report_id:
-                            supporting_resource_req: httpx.Response = httpx_client.get(
-                                external_fhir_server_url + "DocumentReference/" + result.report_id, headers={"Authorization": external_fhir_server_auth}
-                            )
-                        elif result.report_id:
-                            supporting_resource_req = httpx_client.get(external_fhir_server_url + "DocumentReference/" + result.report_id)
-                        else:
-                            raise Exception
-                        supporting_resource_obj = supporting_resource_req.json()
-                        supporting_resource_obj["content"] = [
-                            content for content in supporting_resource_obj["content"] if "contentType" in content["attachment"] and content["attachment"]["contentType"] == "text/plain"
-                        ]
-                        supporting_resource: dict = supporting_resource_req.json()
-                    except Exception as exc:
-                        logger.debug(f"Ran into exception {exc}")
-                        logger.debug(
-                            f"Trying to find supporting resource with id DocumentReference/{result.report_id} "
-                            f"failed with status code {supporting_resource_req.status_code}, continuing to create one for the Bundle"
-                        )
-
-                        temp_doc_ref = deepcopy(doc_ref_template)
-                        temp_doc_ref["id"] = result.report_id
-                        temp_doc_ref["date"] = result.report_date if result.report_date else datetime.now().isoformat()
-                        temp_doc_ref["identifier"] = [
-                            {
-                                "system": deploy_url,
-                                "value": "DocumentReference/" + result.report_id if result.report_id else "0",
-                            }
-                        ]
-                        report_type_map = {
-                            "Radiology Note": {"system": "http://loinc.org", "code": "75490-3", "display": "Radiology Note"},
-                            "Discharge summary": {"system": "http://loinc.org", "code": "18842-5", "display": "Discharge summary"},
-                            "Hospital Note": {"system": "http://loinc.org", "code": "34112-3", "display": "Hospital Note"},
-                            "Pathology consult note": {"system": "http://loinc.org", "code": "60570-9", "display": "Pathology Consult note"},
-                            "Ancillary eye tests Narrative": {"system": "http://loinc.org", "code": "70946-9", "display": "Ancillary eye tests Narrative"},
-                            "Nursing notes": {"system": "http://loinc.org", "code": "46208-5", "display": "Nursing notes"},
-                            "Note": {"system": "http://loinc.org", "code": "34109-9", "display": "Note"},
+                # Skip answers already linked for this question from the same report
+                answer_key = (link_id, result.report_id, normalize_answer_value(tuple_result.answerValue))
+                if answer_key not in nlpql_answer_keys:
+                    nlpql_answer_keys.add(answer_key)
+                    temp_answer_obs_dict = temp_answer_obs.model_dump()
+                    if isinstance(temp_answer_obs_dict["effectiveDateTime"], datetime):
+                        temp_answer_obs_dict["effectiveDateTime"] = temp_answer_obs_dict["effectiveDateTime"].strftime("%Y-%m-%dT%H:%M:%SZ")
+                    tuple_observations.append(temp_answer_obs_dict)
+
+                # Queries for original DocumentReference, adds it to the supporting resources if its not already there or creating a DocumentReference with data from the NLPaaS Return
+                if result.report_id in supporting_nlp_resource_ids:  # Indicates a DocumentReference is already in there
+                    logger.debug(f"Report id {result.report_id} already in supporting references, moving on")
+                    continue
+                logger.debug(f"Report id {result.report_id} not in supporting resources yet")
+
+                supporting_resource: dict | None = document_references.get(result.report_id) if result.report_id else None
+                if supporting_resource is None:
+                    logger.debug(f"Supporting resource with id DocumentReference/{result.report_id} was not found, continuing to create one for the Bundle")
+
+                    temp_doc_ref = deepcopy(doc_ref_template)
+                    temp_doc_ref["id"] = result.report_id
+                    temp_doc_ref["date"] = result.report_date if result.report_date else datetime.now().isoformat()
+                    temp_doc_ref["identifier"] = [
+                        {
+                            "system": deploy_url,
+                            "value": "DocumentReference/" + result.report_id if result.report_id else "0",
                         }
+                    ]
+                    report_type_map = {
+                        "Radiology Note": {"system": "http://loinc.org", "code": "75490-3", "display": "Radiology Note"},
+                        "Discharge summary": {"system": "http://loinc.org", "code": "18842-5", "display": "Discharge summary"},
+                        "Hospital Note": {"system": "http://loinc.org", "code": "34112-3", "display": "Hospital Note"},
+                        "Pathology consult note": {"system": "http://loinc.org", "code": "60570-9", "display": "Pathology Consult note"},
+                        "Ancillary eye tests Narrative": {"system": "http://loinc.org", "code": "70946-9", "display": "Ancillary eye tests Narrative"},
+                        "Nursing notes": {"system": "http://loinc.org", "code": "46208-5", "display": "Nursing notes"},
+                        "Note": {"system": "http://loinc.org", "code": "34109-9", "display": "Note"},
+                    }
 
-                        temp_doc_ref["type"]["coding"] = [report_type_map[result.report_type] if result.report_type and result.report_type in report_type_map else report_type_map["Note"]]
+                    temp_doc_ref["type"]["coding"] = [report_type_map[result.report_type] if result.report_type and result.report_type in report_type_map else report_type_map["Note"]]
 
-                        doc_bytes = result.report_text.encode("utf-8") if result.report_text else "No Document Text Available".encode("utf-8")
-                        base64_bytes = base64.b64encode(doc_bytes)
-                        base64_doc = base64_bytes.decode("utf-8")
+                    doc_bytes = result.report_text.encode("utf-8") if result.report_text else "No Document Text Available".encode("utf-8")
+                    base64_bytes = base64.b64encode(doc_bytes)
+                    base64_doc = base64_bytes.decode("utf-8")
 
-                        temp_doc_ref["content"] = [{"attachment": {"contentType": "text/plain", "language": "en-US", "data": base64_doc}}]
+                    temp_doc_ref["content"] = [{"attachment": {"contentType": "text/plain", "language": "en-US", "data": base64_doc}}]
 
-                        if len(temp_doc_ref["date"]) == 10:  # Handles just date and no time for validation
-                            temp_doc_ref["date"] = datetime.strptime(temp_doc_ref["date"], "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ")
-                        else:
-                            temp_doc_ref["date"] = datetime.strptime(temp_doc_ref["date"], "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%dT%H:%M:%SZ")
+                    if len(temp_doc_ref["date"]) == 10:  # Handles just date and no time for validation
+                        temp_doc_ref["date"] = datetime.strptime(temp_doc_ref["date"], "%Y-%m-%d").strftime("%Y-%m-%dT%H:%M:%SZ")
+                    else:
+                        temp_doc_ref["date"] = datetime.strptime(temp_doc_ref["date"], "%Y-%m-%dT%H:%M:%S").strftime("%Y-%m-%dT%H:%M:%SZ")
 
-                        if isinstance(temp_doc_ref["date"], datetime):
-                            temp_doc_ref["date"] = temp_doc_ref["date"].strftime("%Y-%m-%dT%H:%M:%SZ")
+                    if isinstance(temp_doc_ref["date"], datetime):
+                        temp_doc_ref["date"] = temp_doc_ref["date"].strftime("%Y-%m-%dT%H:%M:%SZ")
 
-                        supporting_resource = temp_doc_ref
+                    supporting_resource = temp_doc_ref
 
-                    supporting_doc_refs.append(supporting_resource)
-                    supporting_nlp_resource_ids.append(supporting_resource["id"])
+                supporting_doc_refs.append(supporting_resource)
+                supporting_nlp_resource_ids.add(supporting_resource["id"])
 
-                for tuple_observation in tuple_observations:
-                    tuple_bundle_entry = {"fullUrl": f"Observation/{tuple_observation['id']}", "resource": tuple_observation}
-                    bundle_entries.append(tuple_bundle_entry)
+            for tuple_observation in tuple_observations:
+                tuple_bundle_entry = {"fullUrl": f"Observation/{tuple_observation['id']}", "resource": tuple_observation}
+                bundle_entries.append(tuple_bundle_entry)
 
-                for doc_ref in supporting_doc_refs:
-                    doc_bundle_entry = {"fullUrl": f"DocumentReference/{doc_ref['id']}", "resource": doc_ref}
-                    bundle_entries.append(doc_bundle_entry)
+            for doc_ref in supporting_doc_refs:
+                doc_bundle_entry = {"fullUrl": f"DocumentReference/{doc_ref['id']}", "resource": doc_ref}
+                bundle_entries.append(doc_bundle_entry)
 
         return_bundle_nlpql = {"resourceType": "Bundle", "id": str(uuid.uuid4()), "type": "collection", "entry": bundle_entries}
 
     if return_bundle_cql and return_bundle_nlpql:
         return_bundle = return_bundle_cql
-        return_bundle["entry"].extend(return_bundle_nlpql["entry"])
+        return_bundle["entry"].extend(entry for entry in return_bundle_nlpql["entry"] if entry["fullUrl"] not in bundle_full_urls)
     elif return_bundle_cql:
         return_bundle = return_bundle_cql
     elif return_bundle_nlpql:
@@ -884,74 +882,11 @@ def create_linked_results(results_in: list, form_name: str, patient_id: str):
     return return_bundle
 
 
-def validate_cql(code: str):
-    """Validates CQL using CQF Ruler before persisting as a Library resource"""
-    escaped_string_code = code.replace('"', '"')
-    cql_operation_data = {
-        "resourceType": "Parameters",
-        "parameter": [{"name": "patientId", "valueString": "1"}, {"name": "context", "valueString": "Patient"}, {"name": "code", "valueString": escaped_string_code}],
-    }
-    req: httpx.Response = httpx_client.post(cqfr4_fhir + "$cql", json=cql_operation_data)
-    if req.status_code != 200:
-        logger.error(f"Trying to validate the CQL before creating library failed with status code {req.status_code}")
-        return make_operation_outcome("transient", f"Trying to validate the CQL before creating library failed with status code {req.status_code}")
-    validation_results = req.json()
-    first_full_url = validation_results["entry"][0]["fullUrl"]
-    if first_full_url == "Error":
-        logger.error("There were errors in CQL validation. Compiling errors into an OperationOutcome")
-        num_errors = len(validation_results["entry"])
-        diagnostics_list = []
-        combined_oo = {"resourceType": "OperationOutcome", "issue": []}
-        for i in range(0, num_errors):
-            diagnostics = ": ".join([item["name"] + " " + item["valueString"] for item in validation_results["entry"][i]["resource"]["parameter"]])
-            diagnostics_list.append(diagnostics)
-        for diagnostic in diagnostics_list:
-            oo_item = {
-                "severity": "error",
-                "code": "invalid",
-                "diagnostics": diagnostic,
-            }
-            combined_oo["issue"].append(oo_item)
-        logger.error(f"There were a total of {num_errors} errors. The OperationOutcome will be returned to the client as well as logged below.")
-        logger.error(combined_oo)
-        return combined_oo
-    else:
-        logger.info("CQL successfully validated!")
-        return True
-
-
-def validate_nlpql(code_in: str):
-    """Validates NLPQL using NLPaaS before persisting in CQF Ruler as a Library resource"""
-    code = code_in.encode(encoding="utf-8")
-    try:
-        req: httpx.Response = httpx_client.post(nlpaas_url + "job/validate_nlpql", content=code, headers={"Content-Type": "text/plain"})
-    except ConnectionError as error:
-        logger.error(f"Error when trying to connect to NLPaaS {error}")
-        return make_operation_outcome("transient", "Error when connecting to NLPaaS, see full error in logs. This normally happens due to a DNS name issue.")
-
-    if req.status_code != 200:
-        logger.error(f"Trying to validate NLPQL against NLPAAS failed with status code {req.status_code}")
-        return make_operation_outcome("transient", f"Trying to validate NLPQL against NLPAAS failed with status code {req.status_code}")
-    validation_results = req.json()
-    try:
-        valid = validation_results["valid"]
-    except KeyError:
-        logger.error("valid key not found in NLPAAS validation results, see NLPAAS response below to investigate any errors.")
-        logger.error(validation_results)
-        return make_operation_outcome("transient", "Valid key not found in the NLPAAS validation results, see logs for full dump of NLPAAS validation response.")
-    if valid:
-        return True
-    else:
-        try:
-            return make_operation_outcome("invalid", validation_results["reason"])
-        except KeyError:
-            logger.error("NLPQL validation did not succeed but there was no reason given in the response. See dump below of NLPAAS response.")
-            logger.error(validation_results)
-            return make_operation_outcome("invalid", "Validation results were invalid but the reason was not given, see logs for full dump of NLPAAS response.")
-
-
-async def start_jobs(post_body: StartJobsParameters) -> dict:
-    """Start jobs for both sync and async"""
+async def start_jobs(post_body: StartJobsParameters, on_library_result: Callable[[str, dict], Awaitable[None]] | None = None) -> dict:
+    """
+    Start jobs for both sync and async. When on_library_result is given, each library's results are linked on their own as soon as its response arrives
+    and passed to it with the library name, so async jobs can show partial results before the full Bundle is returned.
+    """
     # Make list of parameters
     body_json = post_body.model_dump()
     parameters = body_json["parameter"]
@@ -997,20 +932,16 @@ async def start_jobs(post_body: StartJobsParameters) -> dict:
         logger.info(f"No form version given, will be using newest created Questionnaire matching {form_name}")
 
     # Pull Questionnaire resource ID from CQF Ruler
-    questionnaire = get_form(form_name=form_name, form_version=form_version, return_Questionnaire_class_obj=False)
+    questionnaire = await get_form_async(form_name=form_name, form_version=form_version)
     if questionnaire["resourceType"] == "OperationOutcome":
         return questionnaire
 
     if form_name.lower() == "diagnostic":
-        return run_diagnostic_questionnaire(run_all_jobs, libraries_to_run, questionnaire)
+        return await run_diagnostic_questionnaire(run_all_jobs, libraries_to_run, questionnaire)
 
-    cql_flag = False
-    nlpql_flag = False
     if run_all_jobs:
         cql_libraries_to_run: list[str] = []
         nlpql_libraries_to_run: list[str] = []
-        cql_library_server_ids: list[str] = []
-        nlpql_library_server_ids: list[str] = []
 
         cql_libraries_to_run_extension: dict = questionnaire["extension"][0]["extension"]
         for extension in cql_libraries_to_run_extension:
@@ -1026,96 +957,27 @@ async def start_jobs(post_body: StartJobsParameters) -> dict:
             logger.info("No NLPQL Libraries found, moving on")
 
         libraries_to_run = cql_libraries_to_run + nlpql_libraries_to_run
-
-        cql_libraries_to_run = []
-        nlpql_libraries_to_run = []
-
-        for library_name_full in libraries_to_run:
-            library_name, library_name_ext = library_name_full.split(".")
-            req: httpx.Response = httpx_client.get(cqfr4_fhir + f"Library?name={library_name}&content-type=text/{library_name_ext}")
-            if req.status_code != 200:
-                logger.error(f"Getting library from server failed with status code {req.status_code}")
-                return make_operation_outcome("transient", f"Getting library from server failed with status code {req.status_code}")
-
-            search_bundle = req.json()
-            try:
-                library_server_id = search_bundle["entry"][0]["resource"]["id"]
-                logger.info(f"Found {library_name_ext.upper()} Library with name {library_name} and server id {library_server_id}")
-                try:
-                    library_type = search_bundle["entry"][0]["resource"]["content"][0]["contentType"]
-                except KeyError:
-                    return make_operation_outcome(
-                        "invalid",
-                        (
-                            f"Library with name {library_name} does not contain a content type in content[0].contentType. "
-                            "Because of this, the API is unable to process the library. Please update the Library to include a content type."
-                        ),
-                    )
-                if library_type == "text/nlpql":
-                    nlpql_flag = True
-                    nlpql_library_server_ids.append(library_server_id)
-                    nlpql_libraries_to_run.append(library_name)
-                elif library_type == "text/cql":
-                    cql_flag = True
-                    cql_library_server_ids.append(library_server_id)
-                    cql_libraries_to_run.append(library_name)
-                else:
-                    logger.error(f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
-                    return make_operation_outcome("invalid", f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
-            except KeyError:
-                logger.error(f"Library with name {library_name} not found")
-                return make_operation_outcome("not-found", f"Library with name {library_name} not found")
-
-    if not run_all_jobs:
-        # Pull CQL library resource ID from CQF Ruler
-        library_name_ext_split = library.split(".")
-        if len(library_name_ext_split) == 2:
-            library_name = library_name_ext_split[0]
-            library_type = library_name_ext_split[1]
-        else:
-            library_name = library
-            library_type = "cql"
-
-        req = httpx_client.get(cqfr4_fhir + f"Library?name={library_name}&content-type=text/{library_type.lower()}")
-        if req.status_code != 200:
-            logger.error(f"Getting library from server failed with status code {req.status_code}")
-            return make_operation_outcome("transient", f"Getting library from server failed with status code {req.status_code}")
-
-        search_bundle = req.json()
-        try:
-            library_server_id = search_bundle["entry"][0]["resource"]["id"]
-
-            logger.info(f"Found Library with name {library} and server id {library_server_id}")
-            try:
-                library_type = search_bundle["entry"][0]["resource"]["content"][0]["contentType"]
-            except KeyError:
-                return make_operation_outcome(
-                    "invalid",
-                    (
-                        f"Library with name {library_name} does not contain a content type in content[0].contentType. "
-                        "Because of this, the API is unable to process the library. Please update the Library to include a content type."
-                    ),
-                )
-            if library_type == "text/nlpql":
-                nlpql_flag = True
-                nlpql_library_server_ids = [library_server_id]
-                nlpql_libraries_to_run = search_bundle["entry"][0]["resource"]["name"]
-            elif library_type == "text/cql":
-                cql_flag = True
-                cql_library_server_ids = [library_server_id]
-                cql_libraries_to_run = search_bundle["entry"][0]["resource"]["name"]
-            else:
-                logger.error(f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
-                return make_operation_outcome("invalid", f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
-        except KeyError:
-            logger.error(f"Library with name {library} not found")
-            return make_operation_outcome("not-found", f"Library with name {library} not found")
+    else:
+        # A job without an extension (or with extra periods in the name) is treated as a CQL library
+        libraries_to_run = [library if len(library.split(".")) == 2 else f"{library}.cql"]
+
+    # Pull library resource IDs from CQF Ruler
+    resolution_start = time.perf_counter()
+    resolved_libraries = await resolve_libraries(libraries_to_run)
+    logger.info(f"Library resolution for {len(libraries_to_run)} libraries took {time.perf_counter() - resolution_start:0.3f}s")
+    if isinstance(resolved_libraries, dict):
+        return resolved_libraries
+
+    cql_libraries_to_run = [resolved["name"] for resolved in resolved_libraries if resolved["contentType"] == "text/cql"]
+    cql_library_server_ids = [resolved["id"] for resolved in resolved_libraries if resolved["contentType"] == "text/cql"]
+    nlpql_libraries_to_run = [resolved["name"] for resolved in resolved_libraries if resolved["contentType"] == "text/nlpql"]
+    nlpql_library_server_ids = [resolved["id"] for resolved in resolved_libraries if resolved["contentType"] == "text/nlpql"]
+    cql_flag = bool(cql_library_server_ids)
+    nlpql_flag = bool(nlpql_library_server_ids)
 
     if has_patient_identifier:
-        if external_fhir_server_auth:
-            req = httpx_client.get(external_fhir_server_url + f"/Patient?identifier={patient_identifier}", headers={"Authorization": external_fhir_server_auth})
-        else:
-            req = httpx_client.get(external_fhir_server_url + f"/Patient?identifier={patient_identifier}")
+        external_fhir_headers = {"Authorization": external_fhir_server_auth} if external_fhir_server_auth else None
+        req = await get_async_client("external_fhir").get(external_fhir_server_url + f"/Patient?identifier={patient_identifier}", headers=external_fhir_headers)
         if req.status_code != 200:
             logger.error(f"Getting Patient from server failed with status code {req.status_code}")
             return make_operation_outcome("transient", f"Getting Patient from server failed with status code {req.status_code}")
@@ -1153,17 +1015,47 @@ async def start_jobs(post_body: StartJobsParameters) -> dict:
     if external_fhir_server_auth:
         parameters_post["parameter"][2]["resource"]["header"] = [f"Authorization: {external_fhir_server_auth}"]
 
+    # Linked Bundle of each library passed to on_library_result, merged into the job's Bundle instead of linking every result again
+    library_bundles: dict[str, dict] = {}
+    # Read of the Patient shared by every NLPQL-only Bundle of the job
+    patient_fetches: dict[str, asyncio.Task] = {}
+
+    async def get_job_patient_resource() -> dict:
+        if patient_id not in patient_fetches:
+            patient_fetches[patient_id] = asyncio.ensure_future(get_patient_resource(patient_id))
+        return await patient_fetches[patient_id]
+
+    async def link_library_response(library_name: str, result_type: Literal["cql", "nlpql"], response: httpx.Response):
+        """Links the results of a single library and hands them to on_library_result, failures here never fail the job itself"""
+        try:
+            if result_type == "cql":
+                results_in = [await handle_cql_asyncs([response], [library_name], patient_id), []]
+                library_bundle = await create_linked_results(results_in, form_name, patient_id, form=questionnaire)
+            else:
+                results_in = [[], await handle_nlpql_asyncs([response], [library_name], patient_id)]
+                library_bundle = await create_linked_results(results_in, form_name, patient_id, form=questionnaire, patient_resource=await get_job_patient_resource())
+            library_bundles[f"{library_name}.{result_type}"] = library_bundle
+            await on_library_result(f"{library_name}.{result_type}", library_bundle)  # type: ignore
+        except Exception:
+            logger.exception(f"Could not record partial results for {library_name}.{result_type}")
+
+    async def on_cql_response(index: int, response: httpx.Response):
+        await link_library_response(cql_libraries_to_run[index], "cql", response)
+
+    async def on_nlpql_response(index: int, response: httpx.Response):
+        await link_library_response(nlpql_libraries_to_run[index], "nlpql", response)
+
     # Pass library id to be evaluated, gets back a future object that represent the pending status of the POST
     cql_task = None
     nlpql_task = None
 
     if cql_flag:
         logger.info("Start submitting CQL jobs")
-        cql_task = run_cql(cql_library_server_ids, parameters_post)
+        cql_task = run_cql(cql_library_server_ids, parameters_post, on_cql_response if on_library_result else None)
 
     if nlpql_flag and nlpaas_url != "False":
         logger.info("Start submitting NLPQL jobs")
-        nlpql_task = run_nlpql(nlpql_library_server_ids, patient_id, external_fhir_server_url, external_fhir_server_auth)
+        nlpql_task = run_nlpql(nlpql_library_server_ids, patient_id, external_fhir_server_url, external_fhir_server_auth, on_nlpql_response if on_library_result else None)
 
     tasks_to_await = []
     if cql_task:
@@ -1192,7 +1084,7 @@ async def start_jobs(post_body: StartJobsParameters) -> dict:
     elif cql_flag:
         libraries_to_run = [cql_libraries_to_run]  # type: ignore
     elif nlpql_flag and nlpaas_url != "False":
-        libraries_to_run = [[nlpql_libraries_to_run]]  # type: ignore
+        libraries_to_run = [nlpql_libraries_to_run]  # type: ignore
 
     # Passes future to get the results from it, will wait until all are processed until returning results
     logger.info("Start getting job results")
@@ -1214,9 +1106,16 @@ async def start_jobs(post_body: StartJobsParameters) -> dict:
     else:
         logger.info("No errors returned from backend services, continuing to link results")
 
-    # Creates the registry bundle format
-    logger.info("Start linking results")
-    bundled_results = create_linked_results([results_cql, results_nlpql], form_name, patient_id)
+    # Creates the registry bundle format, from the Bundles already linked for each library when every library linked
+    library_keys = [f"{library_name}.cql" for library_name in (cql_libraries_to_run if cql_task else [])]
+    library_keys += [f"{library_name}.nlpql" for library_name in (nlpql_libraries_to_run if nlpql_task else [])]
+    if library_keys and all(library_bundles.get(key, {}).get("resourceType") == "Bundle" for key in library_keys):
+        logger.info(f"Merging the linked results of {len(library_keys)} libraries")
+        bundled_results = merge_linked_bundles([library_bundles[key] for key in library_keys])
+    else:
+        logger.info("Start linking results")
+        patient_resource = await get_job_patient_resource() if results_nlpql and not results_cql else None
+        bundled_results = await create_linked_results([results_cql, results_nlpql], form_name, patient_id, form=questionnaire, patient_resource=patient_resource)
     if bundled_results["resourceType"] == "OperationOutcome":
         logger.error(bundled_results["issue"][0]["diagnostics"])
     else:
@@ -1293,6 +1192,13 @@ def get_param_index(parameter_list: list, param_name: str) -> int:
     return parameter_list.index([param for param in parameter_list if param.name == param_name][0])
 
 
+def normalize_answer_value(answer_value: str | dict) -> str:
+    """Case and whitespace insensitive form of an NLP answer, used to find duplicate answers"""
+    if isinstance(answer_value, dict):
+        return json.dumps(answer_value, sort_keys=True, default=str).lower()
+    return " ".join(answer_value.split()).lower()
+
+
 def make_obs_component_for_nlp_result(tuple_result: NLPQLTupleResult, result_type: str) -> list:
     if result_type.lower() not in ["generic", "providerassertion", "sectionfindertask", "openaitask"]:
         logger.warning(f"Received NLP result type of {result_type}, this type is currently not specifically handled in the Answer Observation component making, please add this type to support.")
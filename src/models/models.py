@@ -145,3 +145,42 @@ class NLPQLTupleResult(BaseModel):
     sourceNote: str
     answerValue: str | dict
     answerType: str
+
+
+class LinkingPlanQuestion(BaseModel):
+    position: int
+    linkId: str
+    text: str | None = None
+    type: str | None = None
+    library: str
+    task: str
+    cardinality: str = ""
+
+
+class LinkingPlan(BaseModel):
+    """Questions answered by a CQL or NLPQL task in form order, with each library's questions indexed by library name"""
+
+    question_count: int = 0
+    cql_questions: list[LinkingPlanQuestion] = []
+    nlpql_questions: list[LinkingPlanQuestion] = []
+    cql_questions_by_library: dict[str, list[LinkingPlanQuestion]] = {}
+    nlpql_questions_by_library: dict[str, list[LinkingPlanQuestion]] = {}
+
+
+class CQLTupleResult(BaseModel):
+    fhirResourceId: str
+    fhirField: str
+    valueType: str
+    answerValue: str
+    sourceNote: str
+
+    @property
+    def answer_value_parts(self) -> list[str]:
+        """answerValue split on ^, e.g. date^system^code^display^value^unit"""
+        return self.answerValue.split("^")
+
+    @property
+    def supporting_resource_id(self) -> str:
+        """Resource id from fhirResourceId, which may be a versioned reference ending in /_history/{version}"""
+        reference_parts = self.fhirResourceId.split("/")
+        return reference_parts[-3] if "_history" in self.fhirResourceId else reference_parts[-1]
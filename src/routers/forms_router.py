@@ -1,5 +1,6 @@
 """Routing file for form-related operations."""
 
+import asyncio
 import os
 import uuid
 from datetime import datetime
@@ -7,34 +8,18 @@ from datetime import datetime
 import httpx
 from fastapi import APIRouter, BackgroundTasks, Body
 from fastapi.responses import JSONResponse
-from fastapi_utils.tasks import repeat_every
 from loguru import logger
 
-from src.models.forms import convert_jobpackage_csv_to_questionnaire, get_form, save_form_questionnaire
+from src.models.forms import convert_jobpackage_csv_to_questionnaire, get_form, invalidate_cached_questionnaire, save_form_questionnaire
 from src.models.functions import get_param_index, make_operation_outcome, start_jobs
-from src.models.models import JobCompletedParameter, ParametersJob, StartJobsParameters
-from src.util.settings import cqfr4_fhir, httpx_client
+from src.models.models import ParametersJob, StartJobsParameters
+from src.services.jobqueue import make_queue_row
+from src.services.jobstate import add_to_jobs, get_all_form_jobs, get_job_with_cache, library_result_recorder, update_job_to_complete
+from src.services.scheduler import job_scheduler
+from src.util.settings import cqfr4_fhir, httpx_client, job_execution_mode
 
 router = APIRouter()
 
-jobs: dict[str, ParametersJob] = {}
-
-
-def init_jobs_array() -> None:
-    global jobs
-    del jobs
-    jobs = {}  # noqa: F841
-    logger.info("Initialized jobs array")
-
-
-@repeat_every(seconds=60 * 60 * 24, logger=logger)  # type: ignore
-def clear_jobs_array() -> None:
-    logger.info("Clearing jobs array...")
-    global jobs
-    del jobs
-    jobs = {}  # noqa: F841
-    logger.info("Finished clearing jobs!")
-
 
 @router.get("/forms", response_model=dict)
 def get_list_of_forms():
@@ -76,68 +61,72 @@ async def start_jobs_header_function(post_body: StartJobsParameters, background_
         new_job.parameter[starttime_param_index].valueDateTime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         tmp_job_id = new_job.parameter[uid_param_index].valueString
         assert tmp_job_id
+        # In queue mode the job and its queue row are stored in one transaction, so a job is never left inProgress without a worker to run it
+        queue_rows = [make_queue_row(tmp_job_id, post_body)] if job_execution_mode == "queue" else None
+        if not add_form_job(new_job, tmp_job_id, post_body, queue_rows):
+            return JSONResponse(make_operation_outcome("processing", "The job was unable to be added to the database, please see logs for further information."), 500)
         logger.info(f"Created new job with jobId {tmp_job_id}")
-        jobs[tmp_job_id] = new_job
-        logger.info("Added to jobs array")
-        background_tasks.add_task(start_async_jobs, post_body, tmp_job_id)
-        logger.info("Added background task")
+        if job_execution_mode != "queue":
+            background_tasks.add_task(start_async_jobs, post_body, tmp_job_id)
+            logger.info("Added background task")
         return JSONResponse(content=new_job.model_dump(exclude_none=True), headers={"Location": f"/forms/status/{tmp_job_id}"})
 
     return await start_jobs(post_body)
 
 
-async def start_async_jobs(post_body: StartJobsParameters, uid: str) -> None:
-    """Start job asychronously"""
-    job_result = await start_jobs(post_body)
-    if uid not in jobs:
-        new_job = ParametersJob()
-        uid_param_index: int = get_param_index(parameter_list=new_job.parameter, param_name="jobId")
-        starttime_param_index: int = get_param_index(parameter_list=new_job.parameter, param_name="jobStartDateTime")
-        new_job.parameter[uid_param_index].valueString = uid
-        new_job.parameter[starttime_param_index].valueDateTime = "9999-12-31T00:00:00Z"
-        jobs[uid] = new_job
+def add_form_job(new_job: ParametersJob, job_id: str, post_body: StartJobsParameters, queue_rows: list[dict] | None = None) -> bool:
+    """Store an async job in the jobs table so its status can be polled from any API worker, and its job_queue row in queue mode"""
+    start_parameters: dict = {param["name"]: param.get("valueString") for param in post_body.model_dump()["parameter"]}
+    patient_id_type = "patientId" if "patientId" in start_parameters else "patientIdentifier"
+    starttime_param_index = get_param_index(parameter_list=new_job.parameter, param_name="jobStartDateTime")
+    job_added = add_to_jobs(
+        new_job_body=new_job,
+        job_id=job_id,
+        patient_id_type=patient_id_type,
+        patient_id=start_parameters.get(patient_id_type) or "",
+        job_package=start_parameters.get("jobPackage") or "",
+        job_package_job=start_parameters.get("job") or "all",
+        parent_batch_job_id=None,
+        job_start_datetime=new_job.parameter[starttime_param_index].valueDateTime,
+        job_status="inProgress",
+        queue_rows=queue_rows,
+    )
+    return job_added
 
-    tmp_job_obj = jobs[uid]
-
-    status_param_index: int = get_param_index(parameter_list=tmp_job_obj.parameter, param_name="jobStatus")
-    result_param_index: int = get_param_index(parameter_list=tmp_job_obj.parameter, param_name="result")
-
-    jobs[uid].parameter[result_param_index].resource = job_result
-    jobs[uid].parameter[status_param_index].valueString = "complete"
-
-    jobs[uid].parameter.append(JobCompletedParameter(valueDateTime=datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")))
 
+async def start_async_jobs(post_body: StartJobsParameters, uid: str) -> None:
+    """Start job asychronously, completing the job row with an OperationOutcome if the job fails so it is never left inProgress"""
+    try:
+        async with job_scheduler.job_slot():
+            job_result = await start_jobs(post_body, on_library_result=library_result_recorder(uid))
+    except Exception as error:
+        logger.exception(f"Job {uid} failed")
+        job_result = make_operation_outcome("exception", f"Job failed: {error}")
+    await asyncio.to_thread(update_job_to_complete, uid, job_result)
     logger.info(f"Job id {uid} complete and results are available at /forms/status/{uid}")
 
 
 @router.get("/forms/status/all")
 def return_all_jobs():
     """Return all job statuses"""
-    return jobs
+    return get_all_form_jobs()
 
 
 @router.get("/forms/status/{uid}")
 def get_job_status(uid: str):
     """Return the status of a specific job"""
-    try:
-        try:
-            job_status_obj = jobs[uid]
-            result_param_index: int = get_param_index(parameter_list=job_status_obj.parameter, param_name="result")
-            job_results = job_status_obj.parameter[result_param_index].resource
-            job_results_severity = job_results["issue"][0]["severity"] if job_results else "unknown"
-            job_results_code = job_results["issue"][0]["code"] if job_results else "unknown"
-            if job_results_code == "not-found":
-                return JSONResponse(status_code=404, content=job_results)
-            if job_results_severity == "error":
-                return JSONResponse(status_code=500, content=job_results)
-            else:
-                return jobs[uid]
-        except KeyError:
-            return jobs[uid].model_dump(exclude_none=True)
-    except KeyError:
+    job = get_job_with_cache(uid)
+    if job is None:
         return JSONResponse(
             content=make_operation_outcome("code-invalid", f"The {uid} job id was not found as an async job. Please try running the jobPackage again with a new job id."), status_code=404
         )
+    job_results: dict | None = next((param.get("resource") for param in job["parameter"] if param["name"] == "result"), None)
+    if job_results and job_results.get("resourceType") == "OperationOutcome":
+        if job_results["issue"][0]["code"] == "not-found":
+            return JSONResponse(status_code=404, content=job_results)
+        if job_results["issue"][0]["severity"] == "error":
+            return JSONResponse(status_code=500, content=job_results)
+    return job
 
 
 @router.put("/forms/{form_name}")
@@ -162,6 +151,7 @@ def update_form(form_name: str, new_questions: dict):
         logger.error(f"Putting Questionnaire from server failed with status code {req.status_code}")
         return make_operation_outcome("transient", f"Putting Questionnaire from server failed with status code {req.status_code}")
 
+    invalidate_cached_questionnaire(form_name)
     return make_operation_outcome("informational", f"Questionnaire {form_name} successfully put on server with resource_id {resource_id}", severity="information")
 
 
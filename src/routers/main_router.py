@@ -3,7 +3,10 @@
 from fastapi import APIRouter
 
 from src.models.functions import get_health_of_stack, make_operation_outcome
-from src.util.settings import ConfigEndpointModel, config_endpoint
+from src.services.jobqueue import get_queue_depth
+from src.services.scheduler import job_scheduler
+from src.util.cache import get_cache_stats
+from src.util.settings import ConfigEndpointModel, config_endpoint, job_execution_mode
 
 router = APIRouter()
 
@@ -23,3 +26,12 @@ def health_check() -> dict:
 @router.get("/config", response_model_exclude_none=True)
 def return_config() -> ConfigEndpointModel | dict:
     return config_endpoint
+
+
+@router.get("/metrics")
+def metrics() -> dict:
+    """In-process cache counters and job scheduler queue depths for this worker, plus the durable job queue depth when jobs run in worker processes"""
+    metrics = {"caches": get_cache_stats(), "scheduler": job_scheduler.stats()}
+    if job_execution_mode == "queue":
+        metrics["jobQueue"] = get_queue_depth()
+    return metrics
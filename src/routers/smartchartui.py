@@ -1,14 +1,14 @@
+import asyncio
+import itertools
 import json
 import os
 import uuid
-from copy import deepcopy
+from collections.abc import AsyncIterator, Iterable, Iterator
 from datetime import datetime
+from urllib.parse import urlencode
 
-from fastapi import APIRouter, BackgroundTasks
-from fastapi.responses import JSONResponse
-from fhir.resources.R4B.bundle import Bundle
-from fhir.resources.R4B.list import List
-from fhir.resources.R4B.operationoutcome import OperationOutcome
+from fastapi import APIRouter, BackgroundTasks, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from fhir.resources.R4B.parameters import Parameters
 from fhir.resources.R4B.patient import Patient
 from loguru import logger
@@ -19,9 +19,12 @@ from src.models.functions import get_param_index, make_operation_outcome, start_
 from src.models.models import ParametersJob, StartJobsParameters
 from src.responsemodels.prettyjson import PrettyJSONResponse
 from src.services.jobhandler import get_job_list_from_form, get_value_from_parameter, update_patient_resource_in_parameters
-from src.services.jobstate import add_to_batch_jobs, add_to_jobs, delete_batch_job, get_all_batch_jobs, get_batch_job, get_child_job_statuses, get_job, update_job_to_complete
+from src.services.jobqueue import make_queue_row
+from src.services.jobstate import add_to_batch_jobs, delete_batch_job, get_batch_job, get_batch_jobs_with_counts, get_child_jobs, get_job, library_result_recorder, make_job_row, update_job_to_complete
+from src.services.patienthandler import fetch_patient, fetch_patients, purge_patient_cache, resolve_patient_references
+from src.services.scheduler import job_scheduler
 from src.util.fhirclient import FhirClient
-from src.util.settings import httpx_client
+from src.util.settings import job_execution_mode, patient_fetch_concurrency
 
 external_fhir_client = FhirClient(os.getenv("EXTERNAL_FHIR_SERVER_URL"))
 internal_fhir_client = FhirClient(os.getenv("CQF_RULER_R4"))
@@ -30,12 +33,21 @@ smartchart_router = APIRouter()
 
 
 @smartchart_router.get("/smartchartui/Patient/{patient_id}", response_class=PrettyJSONResponse)
-def read_patient(patient_id: str) -> dict:
-    """Read a Patient resource from the external FHIR Server (e.g. Epic)"""
+async def read_patient(patient_id: str):
+    """Read a Patient resource from the external FHIR Server (e.g. Epic), through the Patient cache"""
     if "/" in patient_id:
         patient_id = extract_patient_id(patient_id)
-    response = external_fhir_client.readResource("Patient", patient_id)
-    return response.json()
+    patient = await fetch_patient(patient_id)
+    if patient is None:
+        return JSONResponse(make_operation_outcome("not-found", f"Patient/{patient_id} was not found on or could not be read from the external FHIR server"), 404)
+    return patient
+
+
+@smartchart_router.delete("/smartchartui/Patient/cache")
+def purge_patient_cache_endpoint(patient_id: str | None = None):
+    """Remove one Patient, or every Patient when no patient_id is given, from the Patient cache"""
+    removed_count = purge_patient_cache(extract_patient_id(patient_id) if patient_id else None)
+    return JSONResponse(make_operation_outcome("deleted", f"Removed {removed_count} Patient(s) from the Patient cache", "information"))
 
 
 def extract_patient_id(patient_id: str):
@@ -59,26 +71,59 @@ def search_patient(identifier: str | None = None, name: str | None = None, birth
 
 
 @smartchart_router.get("/smartchartui/group")
-def search_group():
+async def search_group(_format: str = "json"):
     """
     Search for all Group resources on the internal SmartChart FHIR server (ex: SmartChart Suite CQF Ruler) with an implicit include. The include
     is handled in this API due to that the Patient resources which are members of the Group exist on a second server.
+
+    Members are resolved concurrently through the Patient cache and each Group is streamed, followed by its Patients, as soon as its members are
+    resolved. _format=ndjson returns one resource per line instead of a JSON list. Members that could not be resolved are reported in a trailing
+    OperationOutcome.
     """
     logger.info(f"Looking for groups on server {internal_fhir_client.server_base}")
-    resource_list: list = internal_fhir_client.searchResource(resource_type="Group", flatten=True)
-    group_list: list = deepcopy(resource_list)
-    output_list: list = []
-    for group in group_list:
-        output_list.append(group)
-        for member in group["member"]:
-            patient_reference: str = member["entity"]["reference"]
-            try:
-                patient_resource: dict = httpx_client.get(patient_reference).json()
-                output_list.append(patient_resource)
-            except Exception:
-                logger.error(f"There was an issue collecting the Patient resource from the following URL: {patient_reference}")
-    logger.info(f"Returning {len(group_list)} Group(s) with a total of {len(output_list) - len(group_list)} Patient(s)")
-    return output_list
+    group_list: list = await asyncio.to_thread(internal_fhir_client.searchResource, resource_type="Group", flatten=True)
+    if _format == "ndjson":
+        return StreamingResponse(stream_group_resources(group_list, ndjson=True), media_type="application/x-ndjson")
+    return StreamingResponse(stream_group_resources(group_list, ndjson=False), media_type="application/json")
+
+
+def get_group_member_references(group: dict) -> list[str]:
+    return [member["entity"]["reference"] for member in group.get("member", []) if member.get("entity", {}).get("reference")]
+
+
+async def stream_group_resources(group_list: list[dict], ndjson: bool) -> AsyncIterator[bytes]:
+    """Serializes each Group followed by its member Patients, in Group order, while the members of later Groups are still being resolved"""
+    semaphore = asyncio.Semaphore(patient_fetch_concurrency)
+    member_tasks = [asyncio.create_task(resolve_patient_references(get_group_member_references(group), semaphore)) for group in group_list]
+    resource_count = 0
+    unresolved_references: list[str] = []
+    try:
+        if not ndjson:
+            yield b"["
+        for group, member_task in zip(group_list, member_tasks):
+            patients, unresolved = await member_task
+            unresolved_references.extend(unresolved)
+            members = [patients[reference] for reference in get_group_member_references(group) if reference in patients]
+            for resource in [group, *members]:
+                yield encode_group_resource(resource, resource_count, ndjson)
+                resource_count += 1
+        logger.info(f"Returning {len(group_list)} Group(s) with a total of {resource_count - len(group_list)} Patient(s)")
+        if unresolved_references:
+            logger.error(f"There was an issue collecting the Patient resources for the following references: {unresolved_references}")
+            outcome = make_operation_outcome("incomplete", f"{len(unresolved_references)} Group member(s) could not be resolved: {', '.join(unresolved_references)}", "warning")
+            yield encode_group_resource(outcome, resource_count, ndjson)
+        if not ndjson:
+            yield b"]"
+    finally:
+        for member_task in member_tasks:
+            member_task.cancel()
+
+
+def encode_group_resource(resource: dict, resource_index: int, ndjson: bool) -> bytes:
+    encoded_resource = json.dumps(resource, ensure_ascii=False, default=str).encode("utf-8")
+    if ndjson:
+        return encoded_resource + b"\n"
+    return (b", " if resource_index else b"") + encoded_resource
 
 
 # TODO: Does this need to exist? Duplciates get form from routers.py. Need to consider if there is another way data may be returned.
@@ -100,127 +145,115 @@ def get_job_request(id: str, include_patient: bool = False, response_class=Prett
 
 
 @smartchart_router.get("/smartchartui/batchjob")
-def get_all_batch_jobs_request(include_patient: bool = False):
-    requested_batch_jobs = get_all_batch_jobs()
-    batch_jobs_as_resources = []
+async def get_all_batch_jobs_request(include_patient: bool = False, count: int | None = Query(None, alias="_count", ge=1), cursor: str | None = None):
+    """Batch jobs with their status and child job counts. With _count, pages are linked by a Link rel="next" header carrying the next cursor."""
+    requested_batch_jobs = await asyncio.to_thread(get_batch_jobs_with_counts, count + 1 if count else None, cursor)
+    headers = {}
+    if count and len(requested_batch_jobs) > count:
+        requested_batch_jobs = requested_batch_jobs[:count]
+        next_query = urlencode({"_count": count, "cursor": requested_batch_jobs[-1][0], "include_patient": str(include_patient).lower()})
+        headers["Link"] = f'</smartchartui/batchjob?{next_query}>; rel="next"'
+
+    # Every Patient on the page is read in one pass, cached Patients first and the rest in batched searches
+    patients: dict[str, dict] = {}
     if include_patient:
-        for batch_job in requested_batch_jobs:
-            batch_job_resource = Parameters(**batch_job)
-            patient_id = get_value_from_parameter(batch_job_resource, "patientId", use_iteration_strategy=True, value_key="valueString")
+        patients = await fetch_patients(get_batch_job_patient_id(batch_job) for _, batch_job, _, _ in requested_batch_jobs)
+
+    batch_jobs_as_resources = []
+    for _, batch_job, completed_count, total_count in requested_batch_jobs:
+        if include_patient:
+            patient_id = get_batch_job_patient_id(batch_job)
             if not patient_id:
                 continue
-            patient_resource = Patient(**read_patient(patient_id))
-            batch_job_resource = update_patient_resource_in_parameters(batch_job_resource, patient_resource)
-            batch_jobs_as_resources.append(batch_job_resource.model_dump())
-    else:
-        batch_jobs_as_resources = requested_batch_jobs
-    return [add_status_to_batch_job(batch_job) for batch_job in batch_jobs_as_resources]
+            if patient_id in patients:
+                batch_job_resource = update_patient_resource_in_parameters(Parameters(**batch_job), Patient(**patients[patient_id]))
+                batch_job = batch_job_resource.model_dump(mode="json")
+        batch_jobs_as_resources.append(add_status_to_batch_job(batch_job, completed_count, total_count))
+    return JSONResponse(batch_jobs_as_resources, headers=headers)
 
 
 @smartchart_router.get("/smartchartui/batchjob/{id}")
-def get_batch_job_request(id: str, include_patient: bool = False, response_class=PrettyJSONResponse):
-    requested_batch_job: dict | None = get_batch_job(id)
+async def get_batch_job_request(id: str, include_patient: bool = False, response_class=PrettyJSONResponse):
+    requested_batch_job: dict | None = await asyncio.to_thread(get_batch_job, id)
     if not requested_batch_job:
         return JSONResponse(make_operation_outcome("not-found", f"Batch Job ID {id} was not found in the database"), 404)
     if include_patient:
-        batch_job_resource = Parameters(**requested_batch_job)
-        patient_id = get_value_from_parameter(batch_job_resource, "patientId", use_iteration_strategy=True, value_key="valueString")
+        patient_id = get_batch_job_patient_id(requested_batch_job)
         if not patient_id:
             return {}
-        patient_resource = Patient(**read_patient(patient_id))
-        batch_job_resource = update_patient_resource_in_parameters(batch_job_resource, patient_resource)
-        requested_batch_job = batch_job_resource.model_dump()
+        patient = await fetch_patient(patient_id)
+        if patient is not None:
+            batch_job_resource = update_patient_resource_in_parameters(Parameters(**requested_batch_job), Patient(**patient))
+            requested_batch_job = batch_job_resource.model_dump(mode="json")
     return requested_batch_job
 
 
+def get_batch_job_patient_id(batch_job: dict) -> str | None:
+    patient_id = next((param.get("valueString") for param in batch_job["parameter"] if param["name"] == "patientId"), None)
+    return extract_patient_id(patient_id) if patient_id else None
+
+
 @smartchart_router.delete("/smartchartui/batchjob/{id}")
 def delete_batch_job_endpoint(id: str):
     return delete_batch_job(id)
 
 
 @smartchart_router.get("/smartchartui/results/{id}")
-def get_batch_job_results(id: str):
-    """Fetches compiled results as a FHIR Bundle for a given job."""
+async def get_batch_job_results(id: str):
+    """Fetches compiled results as a FHIR Bundle for a given job, streamed out one entry at a time."""
 
-    requested_batch_job = get_batch_job(id)
+    requested_batch_job = await asyncio.to_thread(get_batch_job, id)
     if not requested_batch_job:
         return JSONResponse(make_operation_outcome("not-found", f"Batch Job ID {id} was not found in the database"), 404)
 
-    batch_job_resource = Parameters(**requested_batch_job)
-
     # TODO: Swap the list structure in batch jobs to a parameters.parts structure with name = job, and use it to tie together things here to generate the components properly.
     # TODO: Per above, temp handling given an all statuses complete.
-    # 1. Get child job IDs.
-    child_job_list_resource: List = get_value_from_parameter(batch_job_resource, "childJobs", use_iteration_strategy=True, value_key="resource")
-    child_job_list_dict = child_job_list_resource.model_dump()
-    child_job_list_dict_entries = child_job_list_dict["entry"]
-    child_job_ids: list = [entry["item"]["display"] for entry in child_job_list_dict_entries]
-
-    # 2. For each child job ID
-    #   a. read from DB.
-    #   b. extract status parameter
-    #   c. Add status parameter along with job
-    #   b. extract results parameter (results bundle)
-    #   c. compile results bundle into single list, removing duplicates.
-    status_list: list = []
-    result_list: list = []
+    # 1. Get child job IDs, then read every child job with one query.
+    child_job_list = [param["resource"] for param in requested_batch_job["parameter"] if param["name"] == "childJobs"][0]
+    child_job_ids: list[str] = [entry["item"]["display"] for entry in child_job_list.get("entry", [])]
+    child_jobs = await asyncio.to_thread(get_child_jobs, id)
+
+    # 2. For each child job, collect its status and the resources in its results bundle, removing duplicates by resourceType/id.
+    status_list: list[str] = []
+    result_resources: dict[str, dict] = {}
     for job_id in child_job_ids:
-        logger.info(f"Reading job {job_id} from Database.")
-        job = get_job(job_id)
-        if job is not None:
-            try:
-                job_parameters_resource = Parameters(**job)
-                status_list.append(get_value_from_parameter(job_parameters_resource, "jobStatus", use_iteration_strategy=True, value_key="valueString"))
-                result: Bundle = get_value_from_parameter(job_parameters_resource, "result", use_iteration_strategy=True, value_key="resource")
-                if result.entry:
-                    for entry in result.entry:
-                        result_list.append(entry.resource.model_dump_json()) if entry.resource else None
-                else:
-                    result_list = []
-            except BaseException as e:
-                if isinstance(result, OperationOutcome):
-                    logger.error("OperationOutcome found in job results, reporting diagnostics strings:")
-                    for issue in result.issue:
-                        logger.error("    " + issue.diagnostics) if issue.diagnostics else None
-                else:
-                    logger.error(e)
-                logger.error(f"Error parsing job: {job_id}")
-        else:
+        job = child_jobs.get(job_id)
+        if job is None:
             status_list.append("inProgress")
-        result_list = list(dict.fromkeys(result_list))
+            continue
+        job_parameters = {param["name"]: param for param in job["parameter"]}
+        status_list.append(job_parameters.get("jobStatus", {}).get("valueString") or "inProgress")
+        result: dict = job_parameters.get("result", {}).get("resource") or {}
+        if result.get("resourceType") == "OperationOutcome":
+            logger.error(f"OperationOutcome found in results of job {job_id}, reporting diagnostics strings:")
+            for issue in result.get("issue", []):
+                logger.error("    " + issue["diagnostics"]) if issue.get("diagnostics") else None
+            continue
+        for entry in result.get("entry", []):
+            resource = entry.get("resource")
+            if resource:
+                result_resources.setdefault(f"{resource['resourceType']}/{resource.get('id')}", resource)
 
     # 3. Create status observation based on TODOs above
     #   a. Set Observation.status per condotions of all child job.
     #   b. Once TODOs addressed, add components with job/status pairs for individual handling.
-
-    status_list_bool = [status == "complete" for status in status_list]
-    overall_status_bool = all(status_list_bool)
-    overall_status: str = ""
-    if overall_status_bool:
-        overall_status = "complete"
-    else:
-        overall_status = "preliminary"
+    overall_status = "complete" if all(status == "complete" for status in status_list) else "preliminary"
     status_counter = f"{len([status for status in status_list if status == 'complete'])}/{len(child_job_ids)}"
     status_observation = create_results_status_observation(overall_status, status_counter)
 
-    # 4. Create collection bundle wrapper.
-    #   a. Insert status observation into first entry of collection bundle wrapper.
-    #   b. Call data source and get Patinet and insert into entries of collection bundle wrapper.
-    #   c. Insert all other resources not of type Patient into the entries of collection bundle wrapper.
-    # bundle = Bundle(**create_results_bundle(status_observation, result_list))
-    bundle = create_results_bundle(status_observation, result_list)
-
-    # 5. Return bundle to user.
-    return PrettyJSONResponse(bundle)
+    # 4. Stream the collection bundle: the status observation first, then the Patient read from the data source, then all other resources.
+    patient_key = next((key for key in result_resources if key.startswith("Patient/")), None)
+    patient = await fetch_patient(result_resources[patient_key]["id"]) if patient_key else None
+    return StreamingResponse(stream_results_bundle(status_observation, patient, result_resources), media_type="application/json")
 
 
 @smartchart_router.post("/smartchartui/batchjob", response_class=PrettyJSONResponse)
-def post_batch_job(post_body: StartBatchJobsParameters, background_tasks: BackgroundTasks, include_patient: bool = False):
-    return start_batch_job(post_body, background_tasks, include_patient)
+async def post_batch_job(post_body: StartBatchJobsParameters, background_tasks: BackgroundTasks, include_patient: bool = False):
+    return await start_batch_job(post_body, background_tasks, include_patient)
 
 
 # TODO: Remove after refactoring more into the jobhandler and jobstate files?
-def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patient: bool):
+async def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patient: bool):
     # Pull "metadata" from the post_body sent by the client.
     form_name: str = get_value_from_parameter(post_body, "jobPackage")
     patient_id = get_value_from_parameter(post_body, "patientId")
@@ -240,7 +273,7 @@ def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patien
     new_batch_job.parameter[job_package_param_index].valueString = form_name
 
     # Get the form based on the form_name in the post-body jobPackage parameter, then extract a list of all jobs.
-    form = get_form(form_name=form_name, form_version=None, return_Questionnaire_class_obj=False)
+    form = await asyncio.to_thread(get_form, form_name=form_name, form_version=None, return_Questionnaire_class_obj=False)
     job_list: list[str] = get_job_list_from_form(form)
 
     # Build a temporary list of start job post bodies, one for each job from the job_list identified.
@@ -261,12 +294,13 @@ def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patien
         child_job_ids.append(job_id)
         child_jobs_to_run.append({"new_job": new_job, "job_id": job_id, "parent_batch_job_id": new_batch_job_batch_id, "start_body": start_body})
 
-    background_tasks.add_task(run_all_child_jobs_concurrently, child_jobs_to_run)
-
     list_resource = create_list_resource(child_job_ids)
     new_batch_job.parameter[child_jobs_param_index].resource = list_resource
 
-    added: bool = add_to_batch_jobs(new_batch_job, new_batch_job.parameter[batch_id_param_index].valueString)
+    # The batch row, every child job row, and in queue mode their queue rows are written in one transaction before the response is returned
+    child_job_rows = [make_child_job_row(**job) for job in child_jobs_to_run]
+    queue_rows = [make_queue_row(job["job_id"], job["start_body"]) for job in child_jobs_to_run] if job_execution_mode == "queue" else None
+    added: bool = await asyncio.to_thread(add_to_batch_jobs, new_batch_job, new_batch_job.parameter[batch_id_param_index].valueString, child_job_rows, queue_rows)
 
     if not added:
         return JSONResponse(
@@ -278,12 +312,15 @@ def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patien
             500,
         )
 
+    if job_execution_mode != "queue":
+        background_tasks.add_task(run_all_child_jobs_concurrently, child_jobs_to_run)
+
     batch_job_resource = Parameters(**new_batch_job.model_dump())
 
     if include_patient:
-        patient_id = get_value_from_parameter(batch_job_resource, "patientId", use_iteration_strategy=True, value_key="valueString")
-        patient_resource = Patient(**read_patient(patient_id))
-        batch_job_resource = update_patient_resource_in_parameters(batch_job_resource, patient_resource)
+        patient = await fetch_patient(get_value_from_parameter(batch_job_resource, "patientId", use_iteration_strategy=True, value_key="valueString"))
+        if patient is not None:
+            batch_job_resource = update_patient_resource_in_parameters(batch_job_resource, Patient(**patient))
         batch_job_resource = batch_job_resource.model_dump(exclude_none=True)
 
     if isinstance(batch_job_resource, Parameters):
@@ -296,13 +333,22 @@ def start_batch_job(post_body, background_tasks: BackgroundTasks, include_patien
 
 
 async def run_all_child_jobs_concurrently(child_jobs: list[dict]):
-    import asyncio
-
+    """Queue every child job with the job scheduler, which limits how many run at once across all batches"""
     tasks = [run_child_job(job["new_job"], job["job_id"], job["parent_batch_job_id"], job["start_body"]) for job in child_jobs]
     await asyncio.gather(*tasks)
 
 
 async def run_child_job(new_job: ParametersJob, job_id: str, parent_batch_job_id: str, start_body: StartJobsParameters):
+    try:
+        async with job_scheduler.job_slot():
+            job_result = await start_jobs(start_body, on_library_result=library_result_recorder(job_id))
+    except Exception as error:
+        logger.exception(f"Child job {job_id} of batch job {parent_batch_job_id} failed")
+        job_result = make_operation_outcome("exception", f"Job failed: {error}")
+    await asyncio.to_thread(update_job_to_complete, job_id, job_result)
+
+
+def make_child_job_row(new_job: ParametersJob, job_id: str, parent_batch_job_id: str, start_body: StartJobsParameters) -> dict:
     tmp_job_obj = new_job
     starttime_param_index = new_job.parameter.index([param for param in new_job.parameter if param.name == "jobStartDateTime"][0])
     tmp_job_obj.parameter[starttime_param_index].valueDateTime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -311,7 +357,7 @@ async def run_child_job(new_job: ParametersJob, job_id: str, parent_batch_job_id
     patient_id = [item["valueString"] for item in start_body_dump["parameter"] if item["name"] == patient_id_key][0]
     job_package = [item["valueString"] for item in start_body_dump["parameter"] if item["name"] == "jobPackage"][0]
     job_package_job = [item["valueString"] for item in start_body_dump["parameter"] if item["name"] == "job"][0]
-    job_added_bool = add_to_jobs(
+    return make_job_row(
         new_job_body=new_job,
         job_id=job_id,
         patient_id_type=patient_id_key,
@@ -322,12 +368,6 @@ async def run_child_job(new_job: ParametersJob, job_id: str, parent_batch_job_id
         job_start_datetime=tmp_job_obj.parameter[starttime_param_index].valueDateTime,
         job_status="inProgress",
     )
-    if job_added_bool:
-        logger.info(f"Created new job with jobId {job_id}")
-    else:
-        logger.error(f"Error creating job with jobId {job_id}")
-    job_result = await start_jobs(start_body)
-    update_job_to_complete(job_id, job_result)
 
 
 def temp_start_job_body(patient_id: str, job_package: str, job: str):
@@ -360,27 +400,23 @@ def create_results_status_observation(status: str, status_count: str):
     }
 
 
-def create_results_bundle(status_observation, results_list: list):
-    patient_id: str = ""
-    for res in results_list:
-        if isinstance(res, str):
-            res = json.loads(res)
-        if res["resourceType"] == "Patient":
-            patient_id = res["id"]
-    if patient_id:
-        true_patient: dict = external_fhir_client.readResource("Patient", patient_id).json()
-        return_entries = [create_bundle_entry(resource) for resource in results_list if not create_bundle_entry(resource)["fullUrl"].startswith("Patient")]
-        return_entries.insert(0, create_bundle_entry(status_observation))
-        return_entries.insert(1, create_bundle_entry(true_patient))
-        return {
-            "resourceType": "Bundle",
-            "type": "collection",
-            "total": len(results_list),
-            "entry": return_entries,
-        }
-    else:
-        results_list.insert(0, status_observation)
-        return {"resourceType": "Bundle", "type": "collection", "total": len(results_list), "entry": [create_bundle_entry(resource) for resource in results_list]}
+def stream_results_bundle(status_observation: dict, patient: dict | None, result_resources: dict[str, dict]) -> Iterator[bytes]:
+    """
+    Serializes the results collection Bundle entry by entry. When the Patient could be read from the data source it replaces the Patients in the
+    results and follows the status observation.
+    """
+    resources: Iterable[dict] = result_resources.values()
+    leading_resources = [status_observation]
+    if patient:
+        leading_resources.append(patient)
+        resources = (resource for key, resource in result_resources.items() if not key.startswith("Patient/"))
+
+    yield b'{"resourceType": "Bundle", "type": "collection", "entry": ['
+    total = 0
+    for resource in itertools.chain(leading_resources, resources):
+        yield (", " if total else "").encode("utf-8") + json.dumps(create_bundle_entry(resource), ensure_ascii=False, default=str).encode("utf-8")
+        total += 1
+    yield f'], "total": {total}}}'.encode("utf-8")
 
 
 def create_bundle_entry(resource: dict):
@@ -389,13 +425,13 @@ def create_bundle_entry(resource: dict):
     return {"fullUrl": f"{resource['resourceType']}/{resource['id']}", "resource": resource}
 
 
-def add_status_to_batch_job(batch_job: dict) -> dict:
+def add_status_to_batch_job(batch_job: dict, completed_count: int, total_count: int) -> dict:
     new_params: list[dict] = batch_job["parameter"]
-    batch_job_id = new_params[get_param_index(new_params, "batchId")]["valueString"]
 
-    child_job_statuses = get_child_job_statuses(batch_job_id=batch_job_id)
-    complete_bool = all([value == "complete" for value in child_job_statuses.values()])
+    complete_bool = completed_count == total_count
     new_params.insert(4, {"name": "batchJobStatus", "valueString": "complete" if complete_bool else "inProgress"})
+    new_params.insert(5, {"name": "completedJobCount", "valueInteger": completed_count})
+    new_params.insert(6, {"name": "totalJobCount", "valueInteger": total_count})
     batch_job["parameter"] = new_params
 
     return batch_job
@@ -1,8 +1,11 @@
 """Webhook for Knowledge Base Integration"""
 
+import asyncio
+
 from fastapi import APIRouter, Request
 from loguru import logger
 
+from src.models.forms import invalidate_cached_questionnaire
 from src.util.git import clone_repo_to_temp_folder
 
 router = APIRouter()
@@ -18,5 +21,6 @@ async def webhook(request: Request):
     logger.info(f"CLONE URL: {clone_url}")
     logger.info(f"SSH URL: {ssh_url}")
     clone_repo_to_temp_folder(ssh_url)
+    await asyncio.to_thread(invalidate_cached_questionnaire)
     # TODO: Add Error Handling
     return "Acknowledged"
@@ -0,0 +1,105 @@
+"""Module for fetching the DocumentReferences that NLPQL results point back to"""
+
+import asyncio
+from collections.abc import Iterable
+from copy import deepcopy
+
+import httpx
+from loguru import logger
+
+from src.util.cache import LRUCache
+from src.util.httpclients import get_async_client
+from src.util.settings import (
+    document_cache_max_bytes,
+    document_cache_ttl,
+    document_fetch_concurrency,
+    document_fetch_timeout,
+    external_fhir_server_auth,
+    external_fhir_server_url,
+)
+
+# DocumentReferences already filtered to text/plain content, keyed by (server url, id) and shared by every job in this worker
+document_reference_cache = LRUCache("document_reference", ttl=document_cache_ttl, max_bytes=document_cache_max_bytes)
+# Fetches in progress, keyed like the cache, so concurrent jobs that miss the cache for the same DocumentReference wait on one request
+pending_document_fetches: dict[tuple[str, str], asyncio.Future] = {}
+
+
+async def fetch_document_references(report_ids: Iterable[str]) -> dict[str, dict]:
+    """
+    Fetch every distinct DocumentReference concurrently from the external FHIR server, keyed by id. Only text/plain content is kept. Ids that could not
+    be fetched are left out so the caller can fall back to the report text returned by NLPaaS. DocumentReferences fetched by earlier jobs are served from
+    the document reference cache, and ones another job is already fetching are awaited instead of requested again.
+    """
+    distinct_report_ids = sorted({report_id for report_id in report_ids if report_id})
+    document_references: dict[str, dict] = {}
+    for report_id in distinct_report_ids:
+        cached_document = document_reference_cache.get((external_fhir_server_url, report_id))
+        if cached_document is not None:
+            document_references[report_id] = deepcopy(cached_document)
+    report_ids_to_fetch = [report_id for report_id in distinct_report_ids if report_id not in document_references]
+    if not report_ids_to_fetch:
+        return document_references
+
+    semaphore = asyncio.Semaphore(document_fetch_concurrency)
+    documents = await asyncio.gather(*[fetch_shared_document_reference(report_id, semaphore) for report_id in report_ids_to_fetch])
+    fetched_count = 0
+    for report_id, document in zip(report_ids_to_fetch, documents):
+        if document is None:
+            continue
+        document_references[report_id] = document
+        fetched_count += 1
+    logger.info(f"Fetched {fetched_count}/{len(report_ids_to_fetch)} DocumentReferences from the external FHIR server, {len(distinct_report_ids) - len(report_ids_to_fetch)} were already cached")
+    return document_references
+
+
+async def fetch_shared_document_reference(report_id: str, semaphore: asyncio.Semaphore) -> dict | None:
+    """
+    Fetch a DocumentReference and cache it, or wait on the fetch another job already started for the same one. Every caller gets its own copy. A
+    fetch that fails or is cancelled resolves to None for the callers waiting on it.
+    """
+    key = (external_fhir_server_url, report_id)
+    # Another job may have finished fetching it since the caller checked the cache
+    cached_document = document_reference_cache.get(key)
+    if cached_document is not None:
+        return deepcopy(cached_document)
+    pending_fetch = pending_document_fetches.get(key)
+    if pending_fetch is not None:
+        # Shielded so a waiting job that is cancelled does not cancel the fetch for the others
+        shared_document = await asyncio.shield(pending_fetch)
+        return deepcopy(shared_document) if shared_document is not None else None
+
+    pending_fetch = asyncio.get_running_loop().create_future()
+    pending_document_fetches[key] = pending_fetch
+    try:
+        document = await fetch_document_reference(report_id, semaphore)
+        if document is not None:
+            shared_document = deepcopy(document)
+            document_reference_cache.set(key, shared_document)
+            pending_fetch.set_result(shared_document)
+        return document
+    finally:
+        if not pending_fetch.done():
+            pending_fetch.set_result(None)
+        del pending_document_fetches[key]
+
+
+async def fetch_document_reference(report_id: str, semaphore: asyncio.Semaphore) -> dict | None:
+    """Fetch a single DocumentReference, returning None when the server does not return one"""
+    client = get_async_client("external_fhir")
+    headers = {"Authorization": external_fhir_server_auth} if external_fhir_server_auth else None
+    async with semaphore:
+        try:
+            req: httpx.Response = await client.get(external_fhir_server_url + f"DocumentReference/{report_id}", headers=headers, timeout=document_fetch_timeout)
+        except httpx.HTTPError as error:
+            logger.debug(f"Trying to find supporting resource with id DocumentReference/{report_id} failed with {error!r}")
+            return None
+    if req.status_code != 200:
+        logger.debug(f"Trying to find supporting resource with id DocumentReference/{report_id} failed with status code {req.status_code}")
+        return None
+    try:
+        document_reference: dict = req.json()
+        document_reference["content"] = [content for content in document_reference["content"] if content["attachment"].get("contentType") == "text/plain"]
+    except (ValueError, KeyError, TypeError) as error:
+        logger.debug(f"DocumentReference/{report_id} returned by the external FHIR server could not be read: {error!r}")
+        return None
+    return document_reference
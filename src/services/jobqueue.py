@@ -0,0 +1,157 @@
+"""Durable job queue backed by the job_queue table, used when JOB_EXECUTION_MODE is "queue" so jobs run in worker.py processes instead of the API"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from loguru import logger
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from src.models.functions import start_jobs
+from src.models.models import StartJobsParameters
+from src.services.errorhandler import make_operation_outcome
+from src.services.jobstate import library_result_recorder, update_job_to_complete
+from src.util.databaseclient import JobQueue, db_engine
+from src.util.settings import job_lease_seconds, job_queue_max_attempts
+
+
+def enqueue_job(job_id: str, start_body: StartJobsParameters) -> bool:
+    """Queue a job whose row already exists in the jobs table"""
+    return enqueue_jobs([(job_id, start_body)])
+
+
+def make_queue_row(job_id: str, start_body: StartJobsParameters, enqueued_datetime: datetime | None = None) -> dict:
+    """Column values for one row of the job_queue table"""
+    return {
+        "job_id": job_id,
+        "start_body": start_body.model_dump(mode="json", exclude_none=True),
+        "queue_status": "queued",
+        "attempts": 0,
+        "enqueued_datetime": enqueued_datetime or datetime.now(),
+    }
+
+
+def enqueue_jobs(jobs: list[tuple[str, StartJobsParameters]]) -> bool:
+    """Queue several jobs with a single multi-row insert"""
+    if not jobs:
+        return True
+    now = datetime.now()
+    queue_rows = [make_queue_row(job_id, start_body, now) for job_id, start_body in jobs]
+    try:
+        with Session(db_engine) as session:
+            session.execute(insert(JobQueue).values(queue_rows))
+            session.commit()
+    except SQLAlchemyError as error:
+        logger.error(f"There was an issue adding jobs {[job_id for job_id, _ in jobs]} to the job queue")
+        logger.error(error)
+        return False
+    logger.info(f"Queued jobs {[job_id for job_id, _ in jobs]}")
+    return True
+
+
+def claim_next_job(worker_id: str) -> dict | None:
+    """
+    Lease the oldest queued job, or a running job whose lease has expired because its worker stopped and that has attempts left. Rows are locked with
+    SKIP LOCKED so concurrent workers never claim the same job.
+    """
+    now = datetime.now()
+    claimable = or_(
+        JobQueue.queue_status == "queued",
+        and_(JobQueue.queue_status == "running", JobQueue.lease_expires_datetime < now, JobQueue.attempts < job_queue_max_attempts),
+    )
+    with Session(db_engine) as session:
+        queued_job = session.scalars(select(JobQueue).where(claimable).order_by(JobQueue.enqueued_datetime).limit(1).with_for_update(skip_locked=True)).first()
+        if queued_job is None:
+            return None
+        queued_job.queue_status = "running"
+        queued_job.lease_owner = worker_id
+        queued_job.lease_expires_datetime = now + timedelta(seconds=job_lease_seconds)
+        queued_job.attempts += 1
+        session.commit()
+        return {"job_id": queued_job.job_id, "start_body": queued_job.start_body, "attempts": queued_job.attempts}
+
+
+def fail_exhausted_jobs() -> list[str]:
+    """
+    Mark running jobs whose lease expired on their last allowed attempt as failed, e.g. when every worker that claimed the job ran out of memory, and
+    complete their job rows with an OperationOutcome. Returns the ids of the failed jobs.
+    """
+    exhausted = and_(JobQueue.queue_status == "running", JobQueue.lease_expires_datetime < datetime.now(), JobQueue.attempts >= job_queue_max_attempts)
+    with Session(db_engine) as session:
+        exhausted_jobs = session.scalars(select(JobQueue).where(exhausted).with_for_update(skip_locked=True)).all()
+        failed_jobs = {queued_job.job_id: queued_job.attempts for queued_job in exhausted_jobs}
+        for queued_job in exhausted_jobs:
+            queued_job.queue_status = "failed"
+            queued_job.lease_owner = None
+            queued_job.lease_expires_datetime = None
+            queued_job.last_error = "Lease expired before the job finished"
+        session.commit()
+    for job_id, attempts in failed_jobs.items():
+        logger.error(f"Job {job_id} failed, its lease expired on attempt {attempts} of {job_queue_max_attempts}")
+        update_job_to_complete(job_id, make_operation_outcome("exception", f"Job failed after {attempts} attempts: the worker running it stopped before it finished"))
+    return list(failed_jobs)
+
+
+def renew_lease(job_id: str, worker_id: str) -> bool:
+    try:
+        with Session(db_engine) as session:
+            session.execute(update(JobQueue).where(JobQueue.job_id == job_id, JobQueue.lease_owner == worker_id).values(lease_expires_datetime=datetime.now() + timedelta(seconds=job_lease_seconds)))
+            session.commit()
+    except SQLAlchemyError as error:
+        logger.error(f"Could not renew the lease of job {job_id}, trying again on the next renewal: {error}")
+        return False
+    return True
+
+
+def finish_queued_job(job_id: str, worker_id: str, error: str | None = None, requeue: bool = False) -> bool:
+    """Mark a leased job complete or failed, or put it back in the queue for another attempt"""
+    queue_status = "queued" if requeue else ("failed" if error else "complete")
+    try:
+        with Session(db_engine) as session:
+            session.execute(
+                update(JobQueue).where(JobQueue.job_id == job_id, JobQueue.lease_owner == worker_id).values(queue_status=queue_status, lease_owner=None, lease_expires_datetime=None, last_error=error)
+            )
+            session.commit()
+    except SQLAlchemyError as sql_error:
+        logger.error(f"Could not mark job {job_id} as {queue_status} in the job queue, it is claimable again once its lease expires: {sql_error}")
+        return False
+    return True
+
+
+async def run_queued_job(queued_job: dict, worker_id: str) -> None:
+    """Run a claimed job, renewing its lease until start_jobs returns, and record the result on the job row"""
+    job_id: str = queued_job["job_id"]
+
+    async def keep_lease():
+        # renew_lease logs and returns False on a database error, so one failed renewal does not end the loop while the lease still has time left
+        while True:
+            await asyncio.sleep(job_lease_seconds / 3)
+            await asyncio.to_thread(renew_lease, job_id, worker_id)
+
+    lease_task = asyncio.create_task(keep_lease())
+    try:
+        job_result = await start_jobs(StartJobsParameters(**queued_job["start_body"]), on_library_result=library_result_recorder(job_id))
+    except Exception as error:
+        logger.exception(f"Job {job_id} failed on attempt {queued_job['attempts']}")
+        requeue = queued_job["attempts"] < job_queue_max_attempts
+        if not requeue:
+            await asyncio.to_thread(update_job_to_complete, job_id, make_operation_outcome("exception", f"Job failed after {queued_job['attempts']} attempts: {error}"))
+        await asyncio.to_thread(finish_queued_job, job_id, worker_id, str(error), requeue)
+        return
+    finally:
+        lease_task.cancel()
+
+    await asyncio.to_thread(update_job_to_complete, job_id, job_result)
+    await asyncio.to_thread(finish_queued_job, job_id, worker_id)
+    logger.info(f"Job {job_id} complete")
+
+
+def get_queue_depth() -> dict[str, int]:
+    """Number of queue rows per status"""
+    try:
+        with Session(db_engine) as session:
+            return {queue_status: count for queue_status, count in session.execute(select(JobQueue.queue_status, func.count()).group_by(JobQueue.queue_status))}
+    except SQLAlchemyError as error:
+        logger.error(f"Could not read job queue depth: {error}")
+        return {}
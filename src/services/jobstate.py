@@ -1,60 +1,104 @@
 """TODO: Potentially Temporary Abstraction of Job Management, separated for use for Batch Jobs testing"""
 
+import asyncio
 import json
 from collections import OrderedDict
+from collections.abc import Awaitable, Callable
 from datetime import datetime
 from uuid import UUID
 
 from fastapi.responses import JSONResponse
 from loguru import logger
-from sqlalchemy import delete, select, update
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
 
 from src.models.batchjob import BatchParametersJob
 from src.models.models import ParametersJob
 from src.services.errorhandler import make_operation_outcome
-from src.util.databaseclient import BatchJobs, Jobs, db_engine, execute_orm_no_return, execute_orm_query, save_object
-
-
-def add_to_jobs(new_job_body: ParametersJob, job_id, patient_id_type, patient_id, job_package, job_package_job, parent_batch_job_id, job_start_datetime, job_status) -> bool:
-    current_job_id_list: list[str] = execute_orm_query(db_engine, select(Jobs.job_id))
-
-    if job_id not in current_job_id_list:
-        new_job_instance = Jobs(
-            job_id=job_id,
-            job=new_job_body.model_dump(exclude_none=True),
-            patient_id_type=patient_id_type,
-            patient_id=patient_id,
-            job_package=job_package,
-            job_package_job=job_package_job,
-            parent_batch_job_id=parent_batch_job_id,
-            job_start_datetime=job_start_datetime,
-            job_status=job_status,
-        )
-        insert: str | None = save_object(db_engine, new_job_instance)
-        if insert:
-            logger.error("There was an issue inserting a new job into the database")
-            logger.error(insert)
-            return False
-        logger.info(f"Created job {job_id} in jobs table.")
+from src.util.cache import TTLCache
+from src.util.databaseclient import BatchJobs, JobQueue, Jobs, db_engine, execute_orm_no_return, execute_orm_query
+from src.util.settings import job_status_cache_ttl
+
+# Completed jobs no longer change, so status polls for them are served from memory
+completed_job_cache = TTLCache("completed_job", ttl=job_status_cache_ttl)
+
+
+def make_job_row(new_job_body: ParametersJob, job_id, patient_id_type, patient_id, job_package, job_package_job, parent_batch_job_id, job_start_datetime, job_status) -> dict:
+    """Column values for one row of the jobs table"""
+    if isinstance(job_start_datetime, str):
+        job_start_datetime = datetime.strptime(job_start_datetime, "%Y-%m-%dT%H:%M:%SZ")
+    return {
+        "job_id": job_id,
+        "job": new_job_body.model_dump(exclude_none=True),
+        "patient_id_type": patient_id_type,
+        "patient_id": patient_id,
+        "job_package": job_package,
+        "job_package_job": job_package_job,
+        "parent_batch_job_id": parent_batch_job_id,
+        "job_start_datetime": job_start_datetime,
+        "job_status": job_status,
+    }
+
+
+def add_to_jobs(
+    new_job_body: ParametersJob, job_id, patient_id_type, patient_id, job_package, job_package_job, parent_batch_job_id, job_start_datetime, job_status, queue_rows: list[dict] | None = None
+) -> bool:
+    return add_many_to_jobs([make_job_row(new_job_body, job_id, patient_id_type, patient_id, job_package, job_package_job, parent_batch_job_id, job_start_datetime, job_status)], queue_rows)
+
+
+def add_many_to_jobs(job_rows: list[dict], queue_rows: list[dict] | None = None) -> bool:
+    """
+    Insert job rows built with make_job_row in a single multi-row INSERT, with their job_queue rows (built with jobqueue.make_queue_row) in the same
+    transaction in queue mode so no job is stored that no worker will run. The primary key rejects ids that already exist, in which case nothing is
+    inserted and False is returned.
+    """
+    if not job_rows:
         return True
-    else:
+    try:
+        with Session(db_engine) as session:
+            session.execute(insert(Jobs).values(job_rows))
+            if queue_rows:
+                session.execute(insert(JobQueue).values(queue_rows))
+            session.commit()
+    except IntegrityError as error:
+        logger.error(f"A job with one of the ids {[row['job_id'] for row in job_rows]} already exists or references a missing batch job: {error.orig}")
         return False
-
-
-def add_to_batch_jobs(new_batch_job: ParametersJob | BatchParametersJob, index: str) -> bool:
-    current_job_id_list: list[str] = execute_orm_query(db_engine, select(BatchJobs.batch_job_id))
-
-    if index not in current_job_id_list:
-        new_batch_job_instance = BatchJobs(batch_job_id=index, batch_job=new_batch_job.model_dump(exclude_none=True))
-        insert: str | None = save_object(db_engine, new_batch_job_instance)
-        if insert:
-            logger.error("There was an issue inserting a new batch job into the database")
-            logger.error(insert)
-            return False
-        logger.info(f"Created batch job {index} in jobs table.")
-        return True
-    else:
+    except SQLAlchemyError as error:
+        logger.error("There was an issue inserting new jobs into the database")
+        logger.error(error)
         return False
+    logger.info(f"Created jobs {[row['job_id'] for row in job_rows]} in jobs table.")
+    return True
+
+
+def add_to_batch_jobs(new_batch_job: ParametersJob | BatchParametersJob, index: str, child_job_rows: list[dict] | None = None, queue_rows: list[dict] | None = None) -> bool:
+    """
+    Insert a batch job together with its child job rows (built with make_job_row) and, in queue mode, their job_queue rows (built with
+    jobqueue.make_queue_row) in one transaction, so the batch never references child jobs that do not exist yet or that no worker will run. Either
+    everything is stored or nothing is.
+    """
+    child_job_rows = child_job_rows or []
+    batch_job = new_batch_job.model_dump(exclude_none=True)
+    start_datetime = next((param.get("valueDateTime") for param in batch_job["parameter"] if param["name"] == "jobStartDateTime"), None)
+    batch_job_start_datetime = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%SZ") if start_datetime else datetime.now()
+    try:
+        with Session(db_engine) as session:
+            session.execute(insert(BatchJobs).values(batch_job_id=index, batch_job=batch_job, batch_job_start_datetime=batch_job_start_datetime))
+            if child_job_rows:
+                session.execute(insert(Jobs).values(child_job_rows))
+            if queue_rows:
+                session.execute(insert(JobQueue).values(queue_rows))
+            session.commit()
+    except IntegrityError as error:
+        logger.error(f"Batch job {index} or one of its child jobs already exists: {error.orig}")
+        return False
+    except SQLAlchemyError as error:
+        logger.error("There was an issue inserting a new batch job into the database")
+        logger.error(error)
+        return False
+    logger.info(f"Created batch job {index} with {len(child_job_rows)} child jobs in jobs table.")
+    return True
 
 
 def get_job(index: str) -> dict | None:
@@ -62,8 +106,39 @@ def get_job(index: str) -> dict | None:
     return result[0] if result else None
 
 
-def get_all_batch_jobs() -> list[dict]:
-    return execute_orm_query(db_engine, select(BatchJobs.batch_job))
+def get_job_with_cache(index: str) -> dict | None:
+    """Read-through version of get_job that keeps completed jobs in the completed job cache"""
+    cached_job: dict | None = completed_job_cache.get(index)
+    if cached_job is not None:
+        return cached_job
+    job = get_job(index)
+    if job and any(param["name"] == "jobStatus" and param.get("valueString") == "complete" for param in job["parameter"]):
+        completed_job_cache.set(index, job)
+    return job
+
+
+def get_all_form_jobs() -> dict[str, dict]:
+    """All jobs started through /forms/start, keyed by job id"""
+    form_jobs: list[Jobs] = execute_orm_query(db_engine, select(Jobs).where(Jobs.parent_batch_job_id.is_(None)))
+    return {form_job.job_id: form_job.job for form_job in form_jobs}
+
+
+def get_batch_jobs_with_counts(count: int | None = None, cursor: str | None = None) -> list[tuple[str, dict, int, int]]:
+    """
+    Batch jobs as (batch id, batch job, completed child jobs, total child jobs), oldest first with the batch id breaking ties, and starting after the
+    cursor batch id. The counts are correlated subqueries answered from the ix_jobs_parent_batch_job_id_job_status index, so the whole page is one query
+    that never reads child job results. A cursor whose batch job has since been deleted returns an empty page.
+    """
+    total_jobs = select(func.count()).where(Jobs.parent_batch_job_id == BatchJobs.batch_job_id).correlate(BatchJobs).scalar_subquery()
+    completed_jobs = select(func.count()).where(Jobs.parent_batch_job_id == BatchJobs.batch_job_id, Jobs.job_status == "complete").correlate(BatchJobs).scalar_subquery()
+    stmt = select(BatchJobs.batch_job_id, BatchJobs.batch_job, completed_jobs, total_jobs).order_by(BatchJobs.batch_job_start_datetime, BatchJobs.batch_job_id)
+    if cursor:
+        cursor_start = select(BatchJobs.batch_job_start_datetime).where(BatchJobs.batch_job_id == cursor).scalar_subquery()
+        stmt = stmt.where(or_(BatchJobs.batch_job_start_datetime > cursor_start, and_(BatchJobs.batch_job_start_datetime == cursor_start, BatchJobs.batch_job_id > cursor)))
+    if count:
+        stmt = stmt.limit(count)
+    with Session(db_engine) as session:
+        return [(batch_job_id, batch_job, completed, total) for batch_job_id, batch_job, completed, total in session.execute(stmt)]
 
 
 def get_batch_job(index: str) -> dict | None:
@@ -113,10 +188,61 @@ def update_job_to_complete(job_id: str, job_result) -> None:
         logger.info(f"Updated job {job_id} in jobs table.")
 
 
-def get_child_job_statuses(batch_job_id: str) -> dict:
-    child_job_statuses: list[Jobs] = execute_orm_query(db_engine, select(Jobs).where(Jobs.parent_batch_job_id == batch_job_id))
+def record_library_result(job_id: str, library_name: str, library_result: dict) -> None:
+    """
+    Merge the linked results of one library into a job that is still running, so status requests return them before the job completes. Entries replace
+    earlier entries with the same fullUrl, and the libraryStatus parameter records which libraries are done. The final result written by
+    update_job_to_complete replaces the merged Bundle.
+    """
+    job = get_job(job_id)
+    if not job:
+        logger.error(f"Job {job_id} was not found in the database, could not record results for {library_name}")
+        return None
+    if any(param["name"] == "jobStatus" and param.get("valueString") == "complete" for param in job["parameter"]):
+        return None
+
+    library_status = "complete" if library_result.get("resourceType") == "Bundle" else "error"
+    for param in job["parameter"]:
+        if param["name"] == "result":
+            result_bundle = param.get("resource") or {}
+            if result_bundle.get("resourceType") != "Bundle":
+                result_bundle = {"resourceType": "Bundle", "type": "collection"}
+            entries = {entry["fullUrl"]: entry for entry in result_bundle.get("entry", [])}
+            if library_status == "complete":
+                entries.update({entry["fullUrl"]: entry for entry in library_result.get("entry", [])})
+            result_bundle["entry"] = list(entries.values())
+            result_bundle["total"] = len(result_bundle["entry"])
+            param["resource"] = result_bundle
+
+    status_param = next((param for param in job["parameter"] if param["name"] == "libraryStatus"), None)
+    if status_param is None:
+        status_param = {"name": "libraryStatus", "part": []}
+        job["parameter"].append(status_param)
+    status_param["part"] = [part for part in status_param["part"] if part["name"] != library_name] + [{"name": library_name, "valueString": library_status}]
+
+    update_out = execute_orm_no_return(db_engine, update(Jobs).where(Jobs.job_id == job_id, Jobs.job_status != "complete").values(job=job))
+    if update_out:
+        logger.error(f"There was an issue recording results for {library_name} on job {job_id}")
+        logger.error(update_out)
+    else:
+        logger.info(f"Recorded {library_status} results for {library_name} on job {job_id}")
+
+
+def library_result_recorder(job_id: str) -> Callable[[str, dict], Awaitable[None]]:
+    """on_library_result callback for start_jobs that records each library's results on the job row, one library at a time"""
+    lock = asyncio.Lock()
+
+    async def record(library_name: str, library_result: dict) -> None:
+        async with lock:
+            await asyncio.to_thread(record_library_result, job_id, library_name, library_result)
+
+    return record
+
 
-    return {item.job_id: item.job_status for item in child_job_statuses}
+def get_child_jobs(batch_job_id: str) -> dict[str, dict]:
+    """Every child job of a batch keyed by job id, read with one query on the parent_batch_job_id index"""
+    with Session(db_engine) as session:
+        return {job_id: job for job_id, job in session.execute(select(Jobs.job_id, Jobs.job).where(Jobs.parent_batch_job_id == batch_job_id))}
 
 
 class UUIDEncoder(json.JSONEncoder):
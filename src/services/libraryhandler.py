@@ -1,14 +1,91 @@
 """Module for handling Libraries"""
 
+import asyncio
 import base64
+import hashlib
 from typing import Literal
 
+import httpx
 from fhir.resources.R4B.library import Library
 from loguru import logger
 
-from src.models.functions import make_operation_outcome, validate_cql, validate_nlpql
-from src.services.errorhandler import error_to_operation_outcome
-from src.util.settings import cqfr4_fhir, httpx_client, nlpaas_url
+from src.services.errorhandler import error_to_operation_outcome, make_operation_outcome
+from src.util.cache import TTLCache
+from src.util.cachesync import publish_cache_invalidation
+from src.util.httpclients import get_async_client
+from src.util.settings import cqfr4_fhir, httpx_client, library_index_ttl, library_resolution_concurrency, nlpaas_registration_ttl, nlpaas_url
+
+# Maps (library name, content type) to the id, name, version, and content type of the newest matching Library on CQF Ruler
+library_index = TTLCache("library_index", ttl=library_index_ttl, shared=True)
+
+# Maps NLPQL Library server ids to the content hash and NLPaaS job location they were last registered with
+nlpql_registration_cache = TTLCache("nlpql_registration", ttl=nlpaas_registration_ttl)
+
+
+def validate_cql(code: str):
+    """Validates CQL using CQF Ruler before persisting as a Library resource"""
+    escaped_string_code = code.replace('"', '"')
+    cql_operation_data = {
+        "resourceType": "Parameters",
+        "parameter": [{"name": "patientId", "valueString": "1"}, {"name": "context", "valueString": "Patient"}, {"name": "code", "valueString": escaped_string_code}],
+    }
+    req: httpx.Response = httpx_client.post(cqfr4_fhir + "$cql", json=cql_operation_data)
+    if req.status_code != 200:
+        logger.error(f"Trying to validate the CQL before creating library failed with status code {req.status_code}")
+        return make_operation_outcome("transient", f"Trying to validate the CQL before creating library failed with status code {req.status_code}")
+    validation_results = req.json()
+    first_full_url = validation_results["entry"][0]["fullUrl"]
+    if first_full_url == "Error":
+        logger.error("There were errors in CQL validation. Compiling errors into an OperationOutcome")
+        num_errors = len(validation_results["entry"])
+        diagnostics_list = []
+        combined_oo = {"resourceType": "OperationOutcome", "issue": []}
+        for i in range(0, num_errors):
+            diagnostics = ": ".join([item["name"] + " " + item["valueString"] for item in validation_results["entry"][i]["resource"]["parameter"]])
+            diagnostics_list.append(diagnostics)
+        for diagnostic in diagnostics_list:
+            oo_item = {
+                "severity": "error",
+                "code": "invalid",
+                "diagnostics": diagnostic,
+            }
+            combined_oo["issue"].append(oo_item)
+        logger.error(f"There were a total of {num_errors} errors. The OperationOutcome will be returned to the client as well as logged below.")
+        logger.error(combined_oo)
+        return combined_oo
+    else:
+        logger.info("CQL successfully validated!")
+        return True
+
+
+def validate_nlpql(code_in: str):
+    """Validates NLPQL using NLPaaS before persisting in CQF Ruler as a Library resource"""
+    code = code_in.encode(encoding="utf-8")
+    try:
+        req: httpx.Response = httpx_client.post(nlpaas_url + "job/validate_nlpql", content=code, headers={"Content-Type": "text/plain"})
+    except ConnectionError as error:
+        logger.error(f"Error when trying to connect to NLPaaS {error}")
+        return make_operation_outcome("transient", "Error when connecting to NLPaaS, see full error in logs. This normally happens due to a DNS name issue.")
+
+    if req.status_code != 200:
+        logger.error(f"Trying to validate NLPQL against NLPAAS failed with status code {req.status_code}")
+        return make_operation_outcome("transient", f"Trying to validate NLPQL against NLPAAS failed with status code {req.status_code}")
+    validation_results = req.json()
+    try:
+        valid = validation_results["valid"]
+    except KeyError:
+        logger.error("valid key not found in NLPAAS validation results, see NLPAAS response below to investigate any errors.")
+        logger.error(validation_results)
+        return make_operation_outcome("transient", "Valid key not found in the NLPAAS validation results, see logs for full dump of NLPAAS validation response.")
+    if valid:
+        return True
+    else:
+        try:
+            return make_operation_outcome("invalid", validation_results["reason"])
+        except KeyError:
+            logger.error("NLPQL validation did not succeed but there was no reason given in the response. See dump below of NLPAAS response.")
+            logger.error(validation_results)
+            return make_operation_outcome("invalid", "Validation results were invalid but the reason was not given, see logs for full dump of NLPAAS response.")
 
 
 def create_cql(cql):
@@ -69,6 +146,7 @@ def create_cql(cql):
         resource_id = req.json()["id"]
         if isinstance(resource_id, str | int):
             logger.info(f"Created Library Object on Server with Resource ID {resource_id}")
+            index_saved_library(name, version, "text/cql", str(resource_id))
         return resource_id
 
     cql_library["id"] = existing_cql_library["id"]
@@ -76,6 +154,7 @@ def create_cql(cql):
     resource_id = req.json()["id"]
     if isinstance(resource_id, str | int):
         logger.info(f"Updated Library Object on Server with Resource ID {resource_id}")
+        index_saved_library(name, version, "text/cql", str(resource_id))
     return resource_id
 
 
@@ -134,6 +213,8 @@ def create_nlpql(nlpql):
             logger.error(f"Posting Library {name} to server failed with status code {req.status_code}")
             return make_operation_outcome("transient", f"Posting Library to server failed with code {req.status_code}")
         resource_id = req.json()["id"]
+        index_saved_library(name, version, "text/nlpql", str(resource_id))
+        invalidate_nlpql_registration(str(resource_id), nlpql)
         return resource_id
     else:
         nlpql_library["id"] = existing_nlpql_library["id"]
@@ -142,6 +223,8 @@ def create_nlpql(nlpql):
             logger.error(f"Putting Library {name} to server failed with status code {req.status_code}")
             return make_operation_outcome("transient", f"Putting Library to server failed with code {req.status_code}")
         resource_id = req.json()["id"]
+        index_saved_library(name, version, "text/nlpql", str(resource_id))
+        invalidate_nlpql_registration(str(resource_id), nlpql)
         return resource_id
 
 
@@ -174,3 +257,128 @@ def get_library(library_name: str, library_type: Literal["cql", "nlpql"]) -> str
     encoded_bytes = base64.b64decode(base64_string)
     decoded_string = encoded_bytes.decode("ascii")
     return decoded_string
+
+
+async def resolve_libraries(library_names: list[str]) -> list[dict] | dict:
+    """
+    Resolve a list of library file names (e.g. demographics.cql) to their CQF Ruler server id and content type. Searches run concurrently, bounded by
+    LIBRARY_RESOLUTION_CONCURRENCY. Returns a list of dicts with name, id, and contentType in the order given, or an OperationOutcome for the first
+    library that could not be resolved.
+    """
+    semaphore = asyncio.Semaphore(library_resolution_concurrency)
+    resolved = await asyncio.gather(*[resolve_library(library_name_full, semaphore) for library_name_full in library_names])
+    for library in resolved:
+        if library.get("resourceType") == "OperationOutcome":
+            return library
+    return resolved
+
+
+async def resolve_library(library_name_full: str, semaphore: asyncio.Semaphore) -> dict:
+    """Search CQF Ruler for a single library by name and content type"""
+    library_name, library_name_ext = library_name_full.rsplit(".", 1) if "." in library_name_full else (library_name_full, "cql")
+    indexed_library: dict | None = library_index.get((library_name, f"text/{library_name_ext.lower()}"))
+    if indexed_library is not None:
+        logger.info(f"Found {library_name_ext.upper()} Library with name {library_name} and server id {indexed_library['id']} in the library index")
+        return indexed_library
+
+    async with semaphore:
+        req: httpx.Response = await get_async_client("cqf_ruler").get(cqfr4_fhir + f"Library?name={library_name}&content-type=text/{library_name_ext.lower()}")
+    if req.status_code != 200:
+        logger.error(f"Getting library from server failed with status code {req.status_code}")
+        return make_operation_outcome("transient", f"Getting library from server failed with status code {req.status_code}")
+
+    search_bundle = req.json()
+    try:
+        library = search_bundle["entry"][0]["resource"]
+    except (KeyError, IndexError):
+        logger.error(f"Library with name {library_name} not found")
+        return make_operation_outcome("not-found", f"Library with name {library_name} not found")
+    logger.info(f"Found {library_name_ext.upper()} Library with name {library_name} and server id {library['id']}")
+
+    try:
+        library_type = library["content"][0]["contentType"]
+    except (KeyError, IndexError):
+        return make_operation_outcome(
+            "invalid",
+            (
+                f"Library with name {library_name} does not contain a content type in content[0].contentType. "
+                "Because of this, the API is unable to process the library. Please update the Library to include a content type."
+            ),
+        )
+    if library_type not in ("text/cql", "text/nlpql"):
+        logger.error(f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
+        return make_operation_outcome("invalid", f"Library with name {library_name} was found but content[0].contentType was not found to be text/cql or text/nlpql.")
+
+    return index_library(library.get("name", library_name), library.get("version"), library_type, library["id"])
+
+
+def index_library(name: str, version: str | None, content_type: str, resource_id: str) -> dict:
+    """Record the newest known server id for a library name and content type"""
+    indexed_library = {"name": name, "id": resource_id, "version": version, "contentType": content_type}
+    library_index.set((name, content_type), indexed_library)
+    return indexed_library
+
+
+def index_saved_library(name: str, version: str | None, content_type: str, resource_id: str) -> dict:
+    """Index a Library this process just saved to CQF Ruler, and have other processes drop their index so they find it too"""
+    publish_cache_invalidation(library_index.name)
+    return index_library(name, version, content_type, resource_id)
+
+
+async def warm_library_index() -> None:
+    """Load the id, name, version, and content type of every Library on CQF Ruler into the library index, following search paging"""
+    logger.info("Warming library index from CQF Ruler...")
+    client = get_async_client("cqf_ruler")
+    # Ascending _lastUpdated order means the newest Library with a given name is indexed last and wins. _elements only accepts top-level elements, so
+    # the whole content element is returned to read its contentType.
+    next_url: str | None = cqfr4_fhir + "Library?_elements=id,name,version,content&_sort=_lastUpdated&_count=200"
+    indexed_count = 0
+    try:
+        while next_url:
+            req: httpx.Response = await client.get(next_url)
+            if req.status_code != 200:
+                logger.warning(f"Warming library index stopped after {indexed_count} libraries, CQF Ruler returned status code {req.status_code}")
+                return
+            search_bundle = req.json()
+            for entry in search_bundle.get("entry", []):
+                library = entry.get("resource", {})
+                try:
+                    index_library(library["name"], library.get("version"), library["content"][0]["contentType"], library["id"])
+                    indexed_count += 1
+                except (KeyError, IndexError):
+                    continue
+            next_url = next((link["url"] for link in search_bundle.get("link", []) if link.get("relation") == "next"), None)
+    except httpx.HTTPError as error:
+        logger.warning(f"Warming library index stopped after {indexed_count} libraries, libraries will be searched for on demand: {error}")
+        return
+    logger.info(f"Indexed {indexed_count} libraries from CQF Ruler")
+
+
+def nlpql_content_hash(nlpql: str) -> str:
+    return hashlib.sha256(nlpql.encode("utf-8")).hexdigest()
+
+
+def get_nlpql_registration(library_id: str, nlpql: str) -> str | None:
+    """
+    Return the NLPaaS job location a Library was last registered with, if it is still cached and was registered with the same NLPQL. Callers pass the
+    NLPQL they just fetched, so a Library edited on CQF Ruler or by another process is never executed with its old registration.
+    """
+    registration: dict | None = nlpql_registration_cache.get(library_id)
+    if registration is None or registration["contentHash"] != nlpql_content_hash(nlpql):
+        return None
+    return registration["jobUrl"]
+
+
+def cache_nlpql_registration(library_id: str, nlpql: str, job_url: str) -> None:
+    nlpql_registration_cache.set(library_id, {"contentHash": nlpql_content_hash(nlpql), "jobUrl": job_url})
+
+
+def invalidate_nlpql_registration(library_id: str, nlpql: str | None = None) -> None:
+    """Drop the cached registration for a Library, unless the NLPQL given is identical to what was registered"""
+    registration: dict | None = nlpql_registration_cache.get(library_id)
+    if registration is None:
+        return
+    if nlpql is not None and registration["contentHash"] == nlpql_content_hash(nlpql):
+        return
+    nlpql_registration_cache.invalidate(library_id)
+    logger.info(f"Dropped cached NLPaaS registration for Library/{library_id}")
@@ -0,0 +1,154 @@
+"""Module for reading Patients from the external FHIR server through a shared cache, used by the SmartChart UI endpoints"""
+
+import asyncio
+from collections.abc import Iterable
+from copy import deepcopy
+
+import httpx
+from loguru import logger
+
+from src.util.cache import TTLCache
+from src.util.httpclients import get_async_client
+from src.util.settings import (
+    external_fhir_server_auth,
+    external_fhir_server_url,
+    patient_cache_ttl,
+    patient_fetch_batch_size,
+    patient_fetch_concurrency,
+    patient_not_found_ttl,
+)
+
+# Patients keyed by (server url, id). Ids the server does not know are cached as PATIENT_NOT_FOUND for PATIENT_NOT_FOUND_TTL seconds.
+patient_cache = TTLCache("patient", ttl=patient_cache_ttl)
+PATIENT_NOT_FOUND = "not-found"
+
+
+def get_cached_patient(patient_id: str) -> dict | str | None:
+    """The cached Patient, PATIENT_NOT_FOUND for a cached miss, or None when the id is not cached"""
+    cached_patient = patient_cache.get((external_fhir_server_url, patient_id))
+    return deepcopy(cached_patient) if isinstance(cached_patient, dict) else cached_patient
+
+
+def cache_patient(patient_id: str, patient: dict | None) -> None:
+    """Cache a Patient, or a miss when patient is None"""
+    if patient is None:
+        patient_cache.set((external_fhir_server_url, patient_id), PATIENT_NOT_FOUND, ttl=patient_not_found_ttl)
+    else:
+        patient_cache.set((external_fhir_server_url, patient_id), deepcopy(patient))
+
+
+def purge_patient_cache(patient_id: str | None = None) -> int:
+    """Remove one Patient, or every Patient, from the cache, returning how many entries were removed"""
+    if patient_id:
+        return patient_cache.invalidate_where(lambda key: key == (external_fhir_server_url, patient_id))
+    return patient_cache.invalidate_where(lambda key: True)
+
+
+async def fetch_patient(patient_id: str) -> dict | None:
+    """Read a single Patient, returning None when the server does not have it or could not be reached"""
+    if "/" in patient_id:
+        patient_id = patient_id.split("/")[-1]
+    cached_patient = get_cached_patient(patient_id)
+    if cached_patient is not None:
+        return None if cached_patient == PATIENT_NOT_FOUND else cached_patient  # type: ignore
+
+    headers = {"Authorization": external_fhir_server_auth} if external_fhir_server_auth else None
+    try:
+        req: httpx.Response = await get_async_client("external_fhir").get(external_fhir_server_url + f"Patient/{patient_id}", headers=headers)
+    except httpx.HTTPError as error:
+        logger.error(f"Reading Patient/{patient_id} from the external FHIR server failed with {error!r}")
+        return None
+    if req.status_code in (404, 410):
+        cache_patient(patient_id, None)
+        return None
+    if req.status_code != 200:
+        logger.error(f"Reading Patient/{patient_id} from the external FHIR server failed with status code {req.status_code}")
+        return None
+    patient: dict = req.json()
+    cache_patient(patient_id, patient)
+    return patient
+
+
+async def fetch_patients(patient_ids: Iterable[str], semaphore: asyncio.Semaphore | None = None) -> dict[str, dict]:
+    """
+    Fetch every distinct Patient, keyed by id. Cache misses are requested in batches of PATIENT_FETCH_BATCH_SIZE ids per _id search, with the searches
+    run concurrently under the semaphore (PATIENT_FETCH_CONCURRENCY by default). Ids a successful search did not return are cached as misses. Ids that
+    could not be fetched are left out.
+    """
+    distinct_patient_ids = sorted({patient_id.split("/")[-1] for patient_id in patient_ids if patient_id})
+    patients: dict[str, dict] = {}
+    patient_ids_to_fetch: list[str] = []
+    for patient_id in distinct_patient_ids:
+        cached_patient = get_cached_patient(patient_id)
+        if isinstance(cached_patient, dict):
+            patients[patient_id] = cached_patient
+        elif cached_patient is None:
+            patient_ids_to_fetch.append(patient_id)
+    if not patient_ids_to_fetch:
+        return patients
+
+    semaphore = semaphore or asyncio.Semaphore(patient_fetch_concurrency)
+    batches = [patient_ids_to_fetch[i : i + patient_fetch_batch_size] for i in range(0, len(patient_ids_to_fetch), patient_fetch_batch_size)]
+    for batch, found_patients in zip(batches, await asyncio.gather(*[search_patients(batch, semaphore) for batch in batches])):
+        if found_patients is None:
+            continue
+        for patient_id in batch:
+            cache_patient(patient_id, found_patients.get(patient_id))
+        patients.update(found_patients)
+    logger.info(f"Fetched {len(patients)}/{len(distinct_patient_ids)} Patients, {len(distinct_patient_ids) - len(patient_ids_to_fetch)} were already cached")
+    return patients
+
+
+async def search_patients(patient_ids: list[str], semaphore: asyncio.Semaphore) -> dict[str, dict] | None:
+    """Search for a batch of Patients by _id, returning None when the search fails"""
+    headers = {"Authorization": external_fhir_server_auth} if external_fhir_server_auth else None
+    params = {"_id": ",".join(patient_ids), "_count": str(len(patient_ids))}
+    async with semaphore:
+        try:
+            req: httpx.Response = await get_async_client("external_fhir").get(external_fhir_server_url + "Patient", params=params, headers=headers)
+        except httpx.HTTPError as error:
+            logger.error(f"Searching for {len(patient_ids)} Patients on the external FHIR server failed with {error!r}")
+            return None
+    if req.status_code != 200:
+        logger.error(f"Searching for {len(patient_ids)} Patients on the external FHIR server failed with status code {req.status_code}")
+        return None
+    searchset: dict = req.json()
+    return {entry["resource"]["id"]: entry["resource"] for entry in searchset.get("entry", []) if entry.get("resource", {}).get("resourceType") == "Patient"}
+
+
+async def resolve_patient_references(references: list[str], semaphore: asyncio.Semaphore | None = None) -> tuple[dict[str, dict], list[str]]:
+    """
+    Resolve Patient references such as Group members. Relative references and references to the external FHIR server are read through the Patient
+    cache, any other absolute URL is read directly. Returns the Patients keyed by reference and the references that could not be resolved.
+    """
+    semaphore = semaphore or asyncio.Semaphore(patient_fetch_concurrency)
+    distinct_references = list(dict.fromkeys(references))
+    cached_references: dict[str, str] = {}
+    remote_references: list[str] = []
+    for reference in distinct_references:
+        if reference.startswith(external_fhir_server_url) or not reference.startswith(("http://", "https://")):
+            cached_references[reference] = reference.split("/")[-1]
+        else:
+            remote_references.append(reference)
+
+    patients_by_id, remote_patients = await asyncio.gather(
+        fetch_patients(cached_references.values(), semaphore), asyncio.gather(*[fetch_patient_url(reference, semaphore) for reference in remote_references])
+    )
+    patients = {reference: patients_by_id[patient_id] for reference, patient_id in cached_references.items() if patient_id in patients_by_id}
+    patients.update({reference: patient for reference, patient in zip(remote_references, remote_patients) if patient is not None})
+    return patients, [reference for reference in distinct_references if reference not in patients]
+
+
+async def fetch_patient_url(url: str, semaphore: asyncio.Semaphore) -> dict | None:
+    """Read a Patient from an absolute URL that is not on the external FHIR server, returning None when it could not be read"""
+    async with semaphore:
+        try:
+            req: httpx.Response = await get_async_client("external_fhir").get(url)
+        except httpx.HTTPError as error:
+            logger.error(f"Reading the Patient at {url} failed with {error!r}")
+            return None
+    if req.status_code != 200:
+        logger.error(f"Reading the Patient at {url} failed with status code {req.status_code}")
+        return None
+    patient: dict = req.json()
+    return patient if patient.get("resourceType") == "Patient" else None
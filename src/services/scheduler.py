@@ -0,0 +1,84 @@
+"""Process-wide limits on how many jobs and upstream evaluations run at once, so concurrent batches queue instead of overwhelming CQF Ruler and NLPaaS"""
+
+import asyncio
+from collections import deque
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
+from loguru import logger
+
+from src.util.settings import cqfr4_max_inflight_evaluations, max_inflight_jobs, nlpaas_max_inflight_evaluations
+
+
+class FIFOLimiter:
+    """
+    Async concurrency limit that hands free slots to waiters strictly in arrival order, so the child jobs of one batch cannot starve a batch submitted
+    after it indefinitely
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.completed = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just before cancellation, pass it on
+                self.release()
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        self.completed += 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next waiter, in_flight stays the same
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "inFlight": self.in_flight, "queued": len(self.waiters), "completed": self.completed}
+
+
+class JobScheduler:
+    """Global scheduler with one limit on in-flight jobs and one limit on in-flight evaluations per upstream backend"""
+
+    def __init__(self, max_jobs: int, max_evaluations: dict[str, int]):
+        self.jobs = FIFOLimiter("jobs", max_jobs)
+        self.evaluations = {backend: FIFOLimiter(backend, limit) for backend, limit in max_evaluations.items()}
+        logger.info(f"Job scheduler allows {max_jobs} jobs and {max_evaluations} evaluations in flight")
+
+    def job_slot(self):
+        """Held for the whole of a job, from library resolution to the linked results"""
+        return self.jobs.slot()
+
+    def evaluation_slot(self, backend: str):
+        """Held for a single $evaluate or NLPaaS execution request"""
+        return self.evaluations[backend].slot()
+
+    def stats(self) -> dict:
+        return {"jobs": self.jobs.stats(), "evaluations": {backend: limiter.stats() for backend, limiter in self.evaluations.items()}}
+
+
+job_scheduler = JobScheduler(max_inflight_jobs, {"cqf_ruler": cqfr4_max_inflight_evaluations, "nlpaas": nlpaas_max_inflight_evaluations})
@@ -0,0 +1,153 @@
+"""Module for parsing the tuple strings returned in NLPaaS and CQF Ruler results without evaluating them as Python code"""
+
+import ast
+import re
+
+from src.models.models import CQLTupleResult
+
+# One "key": "value" pair with no quotes or escapes inside either string, followed by a comma or the end of the tuple. Covers the common generic shape.
+simple_pair_pattern = re.compile(r'\s*"([^"\\]*)"\s*:\s*"([^"\\]*)"\s*(?:,|$)')
+
+# Start of each tuple in a CQF Ruler list of tuples, e.g. '[Tuple {\n\t"fhirField": "value"\n\t"answerValue": "..."\n}, Tuple {...}]'
+cql_tuple_start_pattern = re.compile(r"Tuple\s*\{")
+# One field line of a CQF Ruler tuple, the key may be quoted and the raw value runs to the end of the line
+cql_field_pattern = re.compile(r'\t"?([A-Za-z_]\w*)"?[ \t]*:[ \t]*(.*)')
+# Backslash escapes in quoted CQL strings
+cql_escape_pattern = re.compile(r"\\(u[0-9A-Fa-f]{4}|.)", re.DOTALL)
+cql_escapes = {"n": "\n", "t": "\t", "r": "\r", "f": "\f"}
+cql_tuple_fields = tuple(CQLTupleResult.model_fields)
+# Fast path for a whole tuple in the usual shape: every field on its own line in model order, values without quotes or escapes inside them
+cql_simple_tuple_pattern = re.compile(r"[\s\[,]*Tuple \{\n" + "".join(rf'\t"?{field}"?: "?([^"\\\n]*)"?\n' for field in cql_tuple_fields) + r"\}")
+
+
+class TupleParseError(ValueError):
+    """Raised when an NLPaaS or CQF Ruler tuple string cannot be parsed, with the position of the problem when it is known"""
+
+    def __init__(self, message: str, tuple_string: str, position: int | None = None):
+        self.reason = message
+        self.tuple_string = tuple_string
+        self.position = position
+        location = f" at position {position}" if position is not None else ""
+        excerpt = tuple_string[max(position - 20, 0) : position + 20] if position is not None else tuple_string[:40]
+        super().__init__(f"{message}{location} near {excerpt!r}")
+
+
+def parse_nlpql_tuple(tuple_string: str) -> dict:
+    """
+    Parses the body of an NLPaaS tuple, e.g. '"sourceNote": "...", "answerValue": "...", "answerType": "Generic"', into a dict. Tuples made only of
+    plain quoted strings are read with a single regex pass, anything else (escaped quotes, numbers, nested literals) goes through ast.literal_eval.
+    """
+    tuple_dict = parse_simple_tuple(tuple_string)
+    if tuple_dict is not None:
+        return tuple_dict
+    try:
+        tuple_dict = ast.literal_eval(f"{{{tuple_string}}}")
+    except SyntaxError as error:
+        # Offsets count the opening brace added above
+        raise TupleParseError(f"Invalid tuple syntax ({error.msg})", tuple_string, max((error.offset or 1) - 2, 0)) from error
+    except (ValueError, TypeError, MemoryError, RecursionError) as error:
+        raise TupleParseError(f"Tuple contains a value that is not a literal ({error})", tuple_string) from error
+    if not isinstance(tuple_dict, dict) or not all(isinstance(key, str) for key in tuple_dict):
+        raise TupleParseError("Tuple is not a mapping of string keys to values", tuple_string)
+    return tuple_dict
+
+
+def parse_simple_tuple(tuple_string: str) -> dict[str, str] | None:
+    """Fast path for tuples made only of plain quoted strings, returns None when the tuple needs the full parser"""
+    tuple_dict: dict[str, str] = {}
+    position = 0
+    while position < len(tuple_string):
+        pair_match = simple_pair_pattern.match(tuple_string, position)
+        if pair_match is None:
+            return None if tuple_string[position:].strip() else tuple_dict
+        tuple_dict[pair_match.group(1)] = pair_match.group(2)
+        position = pair_match.end()
+    return tuple_dict
+
+
+def parse_nlpql_answer_value(answer_value):
+    """Structured answers such as OpenAI task results arrive as a dict literal inside the answerValue string, everything else is returned unchanged"""
+    if not isinstance(answer_value, str) or not answer_value.lstrip().startswith("{"):
+        return answer_value
+    try:
+        parsed_answer_value = ast.literal_eval(answer_value.strip())
+    except (SyntaxError, ValueError, TypeError, MemoryError, RecursionError) as error:
+        raise TupleParseError("answerValue looks like a dict but could not be parsed", answer_value) from error
+    if not isinstance(parsed_answer_value, dict):
+        raise TupleParseError("answerValue looks like a dict but is not one", answer_value)
+    return parsed_answer_value
+
+
+def parse_cql_tuples(tuple_list_string: str) -> tuple[list[CQLTupleResult], list[TupleParseError]]:
+    """
+    Parses a CQF Ruler list of tuples into a CQLTupleResult per tuple. Tuples in the usual shape are read with one regex match each, from the first
+    tuple that is not the rest go through parse_cql_tuple. A tuple that cannot be parsed is returned as a TupleParseError, with its position in the
+    list, instead of failing the tuples around it.
+    """
+    tuple_results: list[CQLTupleResult] = []
+    tuple_errors: list[TupleParseError] = []
+    position = 0
+    while simple_match := cql_simple_tuple_pattern.match(tuple_list_string, position):
+        tuple_results.append(CQLTupleResult(**dict(zip(cql_tuple_fields, simple_match.groups()))))
+        position = simple_match.end()
+    if position and not tuple_list_string[position:].strip("[], \n\t"):
+        return tuple_results, tuple_errors
+
+    # Anything after the tuples in the usual shape is split on tuple starts and parsed one field line at a time
+    tuple_starts = [(tuple_start.start(), tuple_start.end()) for tuple_start in cql_tuple_start_pattern.finditer(tuple_list_string, position)]
+    if not tuple_starts and tuple_list_string[position:].strip("[], \n\t"):
+        tuple_errors.append(TupleParseError("No CQL tuple found", tuple_list_string, position))
+    for index, (tuple_start, body_start) in enumerate(tuple_starts):
+        body_end = tuple_starts[index + 1][0] if index + 1 < len(tuple_starts) else len(tuple_list_string)
+        # Everything up to the last closing brace before the next tuple is the body, so braces inside values are kept
+        tuple_string = tuple_list_string[body_start:body_end].rstrip().rstrip("]").rstrip().rstrip(",").rstrip()
+        if not tuple_string.endswith("}"):
+            tuple_errors.append(TupleParseError("Unclosed CQL tuple", tuple_list_string, tuple_start))
+            continue
+        try:
+            tuple_results.append(parse_cql_tuple(tuple_string[:-1]))
+        except TupleParseError as error:
+            tuple_errors.append(TupleParseError(error.reason, tuple_list_string, body_start + (error.position or 0)))
+    return tuple_results, tuple_errors
+
+
+def parse_cql_tuple(tuple_string: str) -> CQLTupleResult:
+    """
+    Parses the body of one CQF Ruler tuple, one tab-indented field per line. Lines that do not start a field continue the value above them, as CQF
+    Ruler wraps long values. A value wrapped in quotes has them removed and its backslash escapes resolved, and quotes inside it are kept whether or not
+    they are escaped. Raises TupleParseError when the tuple is missing a field.
+    """
+    raw_fields: dict[str, str] = {}
+    key = None
+    position = 0
+    for line in tuple_string.split("\n"):
+        field_match = cql_field_pattern.match(line)
+        if field_match:
+            key = field_match[1]
+            raw_fields[key] = field_match[2]
+        elif key is not None:
+            raw_fields[key] += line
+        elif line.strip():
+            raise TupleParseError("Text before the first field of a CQL tuple", tuple_string, position)
+        position += len(line) + 1
+
+    tuple_fields: dict[str, str] = {}
+    for field in cql_tuple_fields:
+        value = raw_fields.get(field)
+        if value is None:
+            missing_fields = [field for field in cql_tuple_fields if field not in raw_fields]
+            raise TupleParseError(f"CQL tuple is missing {', '.join(missing_fields)}", tuple_string, 0)
+        value = value.rstrip()
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+            if "\\" in value:
+                value = cql_escape_pattern.sub(unescape_cql_character, value)
+        tuple_fields[field] = value
+    return CQLTupleResult(**tuple_fields)
+
+
+def unescape_cql_character(escape: re.Match) -> str:
+    escaped = escape[1]
+    if len(escaped) == 5:
+        return chr(int(escaped[1:], 16))
+    return cql_escapes.get(escaped, escaped)
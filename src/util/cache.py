@@ -0,0 +1,138 @@
+"""In-process caches with expiry and hit/miss counters, shared by the services that cache upstream FHIR resources"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+cache_registry: dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    """
+    Thread-safe key/value cache where every entry expires ttl seconds after it was set. A ttl of 0 disables caching. Each cache registers itself by name so
+    its counters can be reported by get_cache_stats. Shared caches hold data other processes can change, and are cleared when another process publishes
+    an invalidation for them (see src/util/cachesync.py).
+    """
+
+    def __init__(self, name: str, ttl: float, shared: bool = False):
+        self.name = name
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.entries: dict[Hashable, tuple[float, Any]] = {}
+        self.lock = threading.Lock()
+        cache_registry[name] = self
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self.remove_entry(key)
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+
+    def remove_entry(self, key: Hashable) -> None:
+        """Drop a single entry, callers must hold the lock"""
+        self.entries.pop(key, None)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.remove_entry(key)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Remove every entry whose key matches the predicate, returning how many were removed"""
+        with self.lock:
+            matching_keys = [key for key in self.entries if predicate(key)]
+            for key in matching_keys:
+                self.remove_entry(key)
+        return len(matching_keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "ttlSeconds": self.ttl}
+
+
+class LRUCache(TTLCache):
+    """
+    TTLCache bounded by the approximate serialized size of its values. Once max_bytes is exceeded the least recently used entries are evicted, and values
+    larger than max_bytes are never stored.
+    """
+
+    def __init__(self, name: str, ttl: float, max_bytes: int, shared: bool = False):
+        super().__init__(name, ttl, shared)
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.sizes: dict[Hashable, int] = {}
+        self.total_bytes = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = super().get(key, default)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None, size: int | None = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        size = len(json.dumps(value, default=str)) if size is None else size
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self.lock:
+            self.remove_entry(key)
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.sizes[key] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self.remove_entry(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove_entry(self, key: Hashable) -> None:
+        self.entries.pop(key, None)
+        self.total_bytes -= self.sizes.pop(key, 0)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "ttlSeconds": self.ttl,
+                "bytes": self.total_bytes,
+                "maxBytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
+
+
+def get_cache_stats() -> dict[str, dict]:
+    """Counters for every registered cache, keyed by cache name"""
+    return {name: cache.stats() for name, cache in cache_registry.items()}
+
+
+def clear_all_caches() -> None:
+    for cache in cache_registry.values():
+        cache.clear()
@@ -0,0 +1,106 @@
+"""
+Cross-process invalidation for shared in-process caches. Invalidating a shared cache bumps its counter in the cache_generations table, and every API and
+worker process polls the counters and clears its own copy of any cache whose counter moved, so an update made through one process reaches the others
+within CACHE_SYNC_INTERVAL seconds.
+"""
+
+import asyncio
+
+from loguru import logger
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from src.util.cache import cache_registry
+from src.util.databaseclient import CacheGenerations, db_engine
+from src.util.settings import cache_sync_interval
+
+# Last generation of each shared cache seen by this process, filled by start_cache_sync
+known_generations: dict[str, int] = {}
+cache_sync_state = {"enabled": False}
+
+
+def shared_cache_names() -> list[str]:
+    return [name for name, cache in cache_registry.items() if cache.shared]
+
+
+def publish_cache_invalidation(*cache_names: str) -> None:
+    """
+    Bump the generation of each named cache so other processes clear their copy on their next sync. The caller clears its own entries. Does nothing
+    until start_cache_sync has run, e.g. in tests or when CACHE_SYNC_INTERVAL is 0.
+    """
+    if not cache_sync_state["enabled"]:
+        return
+    try:
+        with Session(db_engine) as session:
+            for cache_name in cache_names:
+                session.execute(update(CacheGenerations).where(CacheGenerations.cache_name == cache_name).values(generation=CacheGenerations.generation + 1))
+                generation = session.scalar(select(CacheGenerations.generation).where(CacheGenerations.cache_name == cache_name))
+                # Only this bump happened since the last sync, so the next sync does not need to clear this process's copy
+                if generation is not None and generation == known_generations.get(cache_name, 0) + 1:
+                    known_generations[cache_name] = generation
+            session.commit()
+    except SQLAlchemyError as error:
+        logger.error(f"Could not publish invalidation of caches {list(cache_names)}, other processes keep them until they expire: {error}")
+
+
+def sync_cache_generations() -> list[str]:
+    """Clear every shared cache whose generation changed since the last sync, returning the names of the cleared caches"""
+    with Session(db_engine) as session:
+        generations: dict[str, int] = {cache_name: generation for cache_name, generation in session.execute(select(CacheGenerations.cache_name, CacheGenerations.generation))}
+    cleared_caches = []
+    for cache_name in shared_cache_names():
+        generation = generations.get(cache_name)
+        if generation is None:
+            continue
+        if cache_name in known_generations and known_generations[cache_name] != generation:
+            cache_registry[cache_name].clear()
+            cleared_caches.append(cache_name)
+        known_generations[cache_name] = generation
+    return cleared_caches
+
+
+def register_shared_caches() -> None:
+    """Create the generation row of every shared cache that does not have one yet"""
+    with Session(db_engine) as session:
+        existing_names = set(session.scalars(select(CacheGenerations.cache_name)))
+    for cache_name in shared_cache_names():
+        if cache_name in existing_names:
+            continue
+        try:
+            with Session(db_engine) as session:
+                session.execute(insert(CacheGenerations).values(cache_name=cache_name, generation=0))
+                session.commit()
+        except IntegrityError:
+            # Another process registered it first
+            pass
+
+
+async def run_cache_sync() -> None:
+    while True:
+        await asyncio.sleep(cache_sync_interval)
+        try:
+            cleared_caches = await asyncio.to_thread(sync_cache_generations)
+        except SQLAlchemyError as error:
+            logger.warning(f"Could not read cache generations, shared caches may be stale until the next sync: {error}")
+            continue
+        if cleared_caches:
+            logger.info(f"Cleared caches {cleared_caches} invalidated by another process")
+
+
+async def start_cache_sync() -> asyncio.Task | None:
+    """Record the current generation of every shared cache and start polling for invalidations, returning the polling task to cancel on shutdown"""
+    if cache_sync_interval <= 0:
+        logger.info("Cross-process cache invalidation is disabled")
+        return None
+    await asyncio.to_thread(register_shared_caches)
+    await asyncio.to_thread(sync_cache_generations)
+    cache_sync_state["enabled"] = True
+    logger.info(f"Checking for cache invalidations from other processes every {cache_sync_interval} seconds")
+    return asyncio.create_task(run_cache_sync())
+
+
+async def stop_cache_sync(sync_task: asyncio.Task | None) -> None:
+    cache_sync_state["enabled"] = False
+    if sync_task is not None:
+        sync_task.cancel()
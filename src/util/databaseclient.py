@@ -3,8 +3,7 @@
 from datetime import datetime
 
 from loguru import logger
-from psycopg import DataError
-from sqlalchemy import JSON, Connection, Executable, ForeignKey, Inspector, MetaData, Row, create_engine, inspect, text
+from sqlalchemy import JSON, Connection, Executable, ForeignKey, Index, Inspector, MetaData, Row, create_engine, inspect, text
 from sqlalchemy.engine import Compiled, Engine
 from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
 from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
@@ -33,6 +32,8 @@ def startup_connect() -> None:
         missing_tables = [pair[0] for pair in list(existence.items()) if not pair[1]]
         logger.error(f"The following required tables are missing from your database: {missing_tables}")
         raise Exception(f"Missing required database tables {missing_tables}")
+    ensure_columns(conn=conn)
+    ensure_indexes(conn=conn)
     conn.close()
 
 
@@ -60,16 +61,6 @@ def get_next_id_from_table(engine: Engine, table: str, column: str) -> int:
     return last_id + 1
 
 
-def save_object(engine: Engine, object) -> str | None:
-    try:
-        with Session(engine) as session:
-            session.add(object)
-            session.commit()
-    except (Exception, DataError) as e:
-        return str(e)
-    return None
-
-
 def execute_orm_query(engine: Engine, stmt: Executable) -> list:
     """Execute an ORM SQLAlchemy Query to return a list of objects versus a list of Rows"""
     results: list = []
@@ -111,13 +102,25 @@ class BaseRCAPI(DeclarativeBase):
 
 class BatchJobs(BaseRCAPI):
     __tablename__ = "batch_jobs"
+    __table_args__ = (
+        # Batch job pages are read in creation order, with the id breaking ties between batches started in the same second
+        Index("ix_batch_jobs_batch_job_start_datetime_batch_job_id", "batch_job_start_datetime", "batch_job_id"),
+    )
 
     batch_job_id: Mapped[str] = mapped_column(primary_key=True)
     batch_job: Mapped[dict]
+    batch_job_start_datetime: Mapped[datetime | None]
 
 
 class Jobs(BaseRCAPI):
     __tablename__ = "jobs"
+    __table_args__ = (
+        # Child job statuses of a batch are read from this index alone, it also serves lookups by parent_batch_job_id
+        Index("ix_jobs_parent_batch_job_id_job_status", "parent_batch_job_id", "job_status"),
+        Index("ix_jobs_patient_id", "patient_id"),
+        Index("ix_jobs_job_status", "job_status"),
+        Index("ix_jobs_job_start_datetime", "job_start_datetime"),
+    )
 
     job_id: Mapped[str] = mapped_column(primary_key=True)
     patient_id_type: Mapped[str]
@@ -130,12 +133,36 @@ class Jobs(BaseRCAPI):
     parent_batch_job_id: Mapped[str | None] = mapped_column(ForeignKey("batch_jobs.batch_job_id", ondelete="CASCADE", onupdate="CASCADE"))
 
 
+class JobQueue(BaseRCAPI):
+    """Jobs waiting for or leased by a worker process, see src/services/jobqueue.py"""
+
+    __tablename__ = "job_queue"
+
+    job_id: Mapped[str] = mapped_column(ForeignKey("jobs.job_id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
+    start_body: Mapped[dict]
+    queue_status: Mapped[str]
+    attempts: Mapped[int] = mapped_column(default=0)
+    enqueued_datetime: Mapped[datetime]
+    lease_owner: Mapped[str | None]
+    lease_expires_datetime: Mapped[datetime | None]
+    last_error: Mapped[str | None]
+
+
+class CacheGenerations(BaseRCAPI):
+    """Invalidation counter per shared in-process cache, see src/util/cachesync.py"""
+
+    __tablename__ = "cache_generations"
+
+    cache_name: Mapped[str] = mapped_column(primary_key=True)
+    generation: Mapped[int] = mapped_column(default=0)
+
+
 def check_existence_of_tables(conn: Connection) -> dict[str, bool]:
     """
     Uses a list of classes defined in this file to determine that all required tables exist in the target database
     """
 
-    table_list: list[type[BaseRCAPI]] = [BatchJobs, Jobs]
+    table_list: list[type[BaseRCAPI]] = [BatchJobs, Jobs, JobQueue, CacheGenerations]
     output_dict: dict[str, bool] = {}
 
     insp: Inspector = inspect(conn)
@@ -153,3 +180,45 @@ def check_existence_of_tables(conn: Connection) -> dict[str, bool]:
             output_dict[tablename] = True
 
     return output_dict
+
+
+# Values for rows that existed before a column was added, keyed by (table, column). Batch jobs take the start time of their earliest child job.
+column_backfills: dict[tuple[str, str], str] = {
+    ("batch_jobs", "batch_job_start_datetime"): (
+        "UPDATE {schema}.batch_jobs SET batch_job_start_datetime = COALESCE("
+        "(SELECT MIN(jobs.job_start_datetime) FROM {schema}.jobs WHERE jobs.parent_batch_job_id = batch_jobs.batch_job_id), CURRENT_TIMESTAMP)"
+    ),
+}
+
+
+def ensure_columns(conn: Connection) -> None:
+    """
+    Adds any column declared on the models that is missing from an existing table, since create_all does not alter tables that already exist. Added
+    columns are nullable and are filled in for existing rows from column_backfills.
+    """
+    insp: Inspector = inspect(conn)
+    for table in [BatchJobs, Jobs, JobQueue, CacheGenerations]:
+        tablename = table.__tablename__
+        if not insp.has_table(table_name=tablename, schema=db_schema):
+            continue
+        existing_columns = {column["name"] for column in insp.get_columns(tablename, schema=db_schema)}
+        for column in table.__table__.columns:
+            if column.name in existing_columns:
+                continue
+            conn.execute(text(f"ALTER TABLE {db_schema}.{tablename} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"))
+            backfill = column_backfills.get((tablename, column.name))
+            if backfill:
+                conn.execute(text(backfill.format(schema=db_schema)))
+            logger.info(f"Added missing column {column.name} to table {tablename}")
+    conn.commit()
+
+
+def ensure_indexes(conn: Connection) -> None:
+    """
+    Creates any index declared on the models that is missing, since create_all only adds indexes for tables it creates. This is the migration path for
+    databases whose tables were created by an earlier version.
+    """
+    for table in [BatchJobs, Jobs, JobQueue, CacheGenerations]:
+        for index in table.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    conn.commit()
@@ -0,0 +1,57 @@
+"""Application-scoped async HTTP clients, one connection pool per upstream service"""
+
+from importlib.util import find_spec
+from typing import Literal
+
+import httpx
+from loguru import logger
+
+from src.util.settings import cqfr4_max_connections, external_fhir_max_connections, http2_enabled, http_keepalive_expiry, nlpaas_max_connections
+
+Upstream = Literal["cqf_ruler", "nlpaas", "external_fhir"]
+
+# NLPaaS is served over HTTP/1.1, the FHIR servers negotiate HTTP/2 through ALPN when they support it
+upstream_pool_config: dict[str, dict] = {
+    "cqf_ruler": {"max_connections": cqfr4_max_connections, "http2": True},
+    "nlpaas": {"max_connections": nlpaas_max_connections, "http2": False},
+    "external_fhir": {"max_connections": external_fhir_max_connections, "http2": True},
+}
+
+async_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def http2_available() -> bool:
+    """HTTP/2 support in httpx requires the optional h2 package"""
+    return http2_enabled.lower() == "true" and find_spec("h2") is not None
+
+
+def build_async_client(upstream: Upstream) -> httpx.AsyncClient:
+    """Create a pooled async client for a single upstream with keep-alive and retry settings"""
+    config = upstream_pool_config[upstream]
+    limits = httpx.Limits(max_connections=config["max_connections"], max_keepalive_connections=config["max_connections"], keepalive_expiry=http_keepalive_expiry)
+    transport = httpx.AsyncHTTPTransport(retries=5, limits=limits, http2=config["http2"] and http2_available())
+    return httpx.AsyncClient(timeout=300, transport=transport)
+
+
+def get_async_client(upstream: Upstream) -> httpx.AsyncClient:
+    """Return the shared client for an upstream, creating it if the lifespan hook has not done so yet"""
+    client = async_clients.get(upstream)
+    if client is None or client.is_closed:
+        client = build_async_client(upstream)
+        async_clients[upstream] = client
+    return client
+
+
+async def startup_async_clients() -> None:
+    """Create the shared async clients for every upstream"""
+    for upstream in upstream_pool_config:
+        get_async_client(upstream)  # type: ignore
+    logger.info(f"Created shared async HTTP clients for {list(async_clients.keys())} (HTTP/2 {'enabled' if http2_available() else 'disabled'})")
+
+
+async def close_async_clients() -> None:
+    """Close every shared async client and drop its pooled connections"""
+    for upstream, client in list(async_clients.items()):
+        await client.aclose()
+        del async_clients[upstream]
+    logger.info("Closed shared async HTTP clients")
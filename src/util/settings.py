@@ -33,6 +33,41 @@ db_schema = os.environ.get("DB_SCHEMA", "rcapi")
 primary_identifier_system = os.environ.get("PRIMARYIDENTIFIER_SYSTEM")
 primary_identifier_label = os.environ.get("PRIMARYIDENTIFIER_LABEL")
 
+# Tuning for upstream requests, pool sizes apply to the shared async clients in src/util/httpclients.py
+http2_enabled = os.environ.get("HTTP2_ENABLED", "true")
+http_keepalive_expiry = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))
+cqfr4_max_connections = int(os.environ.get("CQF_RULER_MAX_CONNECTIONS", "50"))
+nlpaas_max_connections = int(os.environ.get("NLPAAS_MAX_CONNECTIONS", "20"))
+external_fhir_max_connections = int(os.environ.get("EXTERNAL_FHIR_MAX_CONNECTIONS", "50"))
+library_resolution_concurrency = int(os.environ.get("LIBRARY_RESOLUTION_CONCURRENCY", "8"))
+document_fetch_concurrency = int(os.environ.get("DOCUMENT_FETCH_CONCURRENCY", "10"))
+document_fetch_timeout = float(os.environ.get("DOCUMENT_FETCH_TIMEOUT", "30"))
+patient_fetch_concurrency = int(os.environ.get("PATIENT_FETCH_CONCURRENCY", "10"))
+patient_fetch_batch_size = int(os.environ.get("PATIENT_FETCH_BATCH_SIZE", "50"))
+
+# Limits enforced by the job scheduler in src/services/scheduler.py
+max_inflight_jobs = int(os.environ.get("MAX_INFLIGHT_JOBS", "16"))
+cqfr4_max_inflight_evaluations = int(os.environ.get("CQF_RULER_MAX_INFLIGHT_EVALUATIONS", "32"))
+nlpaas_max_inflight_evaluations = int(os.environ.get("NLPAAS_MAX_INFLIGHT_EVALUATIONS", "8"))
+
+# "background" runs async jobs inside the API process, "queue" persists them to the job_queue table for worker.py processes to claim
+job_execution_mode = os.environ.get("JOB_EXECUTION_MODE", "background").lower()
+job_lease_seconds = float(os.environ.get("JOB_LEASE_SECONDS", "300"))
+job_queue_poll_interval = float(os.environ.get("JOB_QUEUE_POLL_INTERVAL", "2"))
+job_queue_max_attempts = int(os.environ.get("JOB_QUEUE_MAX_ATTEMPTS", "3"))
+
+# In-process cache lifetimes in seconds, 0 disables the cache
+questionnaire_cache_ttl = float(os.environ.get("QUESTIONNAIRE_CACHE_TTL", "300"))
+library_index_ttl = float(os.environ.get("LIBRARY_INDEX_TTL", "3600"))
+nlpaas_registration_ttl = float(os.environ.get("NLPAAS_REGISTRATION_TTL", "3600"))
+job_status_cache_ttl = float(os.environ.get("JOB_STATUS_CACHE_TTL", "60"))
+document_cache_ttl = float(os.environ.get("DOCUMENT_CACHE_TTL", "3600"))
+document_cache_max_bytes = int(os.environ.get("DOCUMENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+patient_cache_ttl = float(os.environ.get("PATIENT_CACHE_TTL", "900"))
+patient_not_found_ttl = float(os.environ.get("PATIENT_NOT_FOUND_TTL", "60"))
+# Seconds between checks for cache invalidations published by other API or worker processes, 0 disables cross-process invalidation
+cache_sync_interval = float(os.environ.get("CACHE_SYNC_INTERVAL", "5"))
+
 if cqfr4_fhir[-1] != "/":
     cqfr4_fhir += "/"
 
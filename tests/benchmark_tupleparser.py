@@ -0,0 +1,56 @@
+"""
+Micro-benchmarks for src/services/tupleparser.py against the parsing it replaced: eval for NLPaaS tuples, and the inline strip/split parser for
+CQF Ruler tuple lists. Not collected by pytest, run from the repository root with: python -m tests.benchmark_tupleparser
+"""
+
+import json
+import timeit
+from pathlib import Path
+
+from src.services.tupleparser import parse_cql_tuples, parse_nlpql_tuple
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+TUPLES: list[str] = json.loads((FIXTURES_DIR / "nlpaas_tuples.json").read_text())
+# A CQL task returning a long list of tuples, built from the golden CQF Ruler outputs
+CQL_TUPLE_LIST: str = "[" + ", ".join(golden["tuples"].strip("[]") for golden in json.loads((FIXTURES_DIR / "cql_tuples.json").read_text()) * 100) + "]"
+NUMBER = 20000
+CQL_NUMBER = 50
+
+
+def parse_with_eval():
+    for tuple_string in TUPLES:
+        eval(f"{{{tuple_string}}}")
+
+
+def parse_with_parser():
+    for tuple_string in TUPLES:
+        parse_nlpql_tuple(tuple_string)
+
+
+def parse_cql_with_splits():
+    tuple_strings = CQL_TUPLE_LIST.strip("[]").split("Tuple ")
+    tuple_strings.remove("")
+    tuple_dict_list = []
+    for item in tuple_strings:
+        new_item = item.strip(", ").replace("\n", "").strip("{ }").replace('"', "")
+        new_item_list = new_item.split("\t")
+        new_item_list.remove("")
+        tuple_dict = {}
+        for field in new_item_list:
+            field_split = field.split(": ")
+            tuple_dict[field_split[0]] = ": ".join(field_split[1:])
+        tuple_dict_list.append(tuple_dict)
+
+
+def parse_cql_with_parser():
+    parse_cql_tuples(CQL_TUPLE_LIST)
+
+
+if __name__ == "__main__":
+    for name, parse in (("eval", parse_with_eval), ("parse_nlpql_tuple", parse_with_parser)):
+        seconds = min(timeit.repeat(parse, number=NUMBER, repeat=3))
+        print(f"{name:>18}: {seconds / (NUMBER * len(TUPLES)) * 1e6:.2f} us per NLPaaS tuple")
+    cql_tuple_count = CQL_TUPLE_LIST.count("Tuple {")
+    for name, parse in (("split parser", parse_cql_with_splits), ("parse_cql_tuples", parse_cql_with_parser)):
+        seconds = min(timeit.repeat(parse, number=CQL_NUMBER, repeat=3))
+        print(f"{name:>18}: {seconds / (CQL_NUMBER * cql_tuple_count) * 1e6:.2f} us per CQL tuple")
@@ -69,7 +69,8 @@ def app():
     with (
         patch("src.util.databaseclient.startup_connect"),
         patch("src.util.git.clone_repo_to_temp_folder"),
-        patch("src.routers.forms_router.init_jobs_array"),
+        patch("src.services.libraryhandler.warm_library_index"),
+        patch("src.util.cachesync.start_cache_sync", return_value=None),
     ):
         from main import app as _app
 
@@ -83,6 +84,18 @@ def client(app):
         yield c
 
 
+# ---------------------------------------------------------------------------
+# In-process caches are module-level, so empty them between tests
+# ---------------------------------------------------------------------------
+@pytest.fixture(autouse=True)
+def clear_caches():
+    from src.util.cache import clear_all_caches
+
+    clear_all_caches()
+    yield
+    clear_all_caches()
+
+
 # ---------------------------------------------------------------------------
 # httpx mock — replaces the global httpx_client used across all routers
 # ---------------------------------------------------------------------------
@@ -102,7 +115,6 @@ def mock_httpx(monkeypatch):
         "src.routers.cql_router.httpx_client",
         "src.routers.nlpql_router.httpx_client",
         "src.routers.forms_router.httpx_client",
-        "src.routers.smartchartui.httpx_client",
         "src.services.libraryhandler.httpx_client",
         "src.models.functions.httpx_client",
         "src.models.forms.httpx_client",  # get_form / save_form_questionnaire
@@ -113,6 +125,33 @@ def mock_httpx(monkeypatch):
     yield mock
 
 
+# ---------------------------------------------------------------------------
+# Async httpx mock — replaces the shared upstream clients from httpclients.py
+# ---------------------------------------------------------------------------
+@pytest.fixture
+def mock_async_httpx(monkeypatch):
+    """
+    Patches `get_async_client` in every module that imports it so all upstreams
+    share one MagicMock. Its request methods are AsyncMocks because the spec is
+    httpx.AsyncClient.
+
+    Usage in tests:
+        async def fake_get(url, **kwargs): ...
+        mock_async_httpx.get.side_effect = fake_get
+    """
+    mock = MagicMock(spec=httpx.AsyncClient)
+    targets = [
+        "src.models.forms.get_async_client",
+        "src.models.functions.get_async_client",
+        "src.services.documenthandler.get_async_client",
+        "src.services.patienthandler.get_async_client",
+        "src.services.libraryhandler.get_async_client",
+    ]
+    for t in targets:
+        monkeypatch.setattr(t, lambda upstream: mock)
+    yield mock
+
+
 # ---------------------------------------------------------------------------
 # FhirClient mock — patches the two FhirClient instances in smartchartui
 # ---------------------------------------------------------------------------
@@ -142,13 +181,12 @@ def mock_jobstate(monkeypatch):
     mocks = {}
     for fn in [
         "get_job",
-        "get_all_batch_jobs",
+        "get_child_jobs",
+        "get_batch_jobs_with_counts",
         "get_batch_job",
         "delete_batch_job",
         "add_to_batch_jobs",
-        "add_to_jobs",
         "update_job_to_complete",
-        "get_child_job_statuses",
     ]:
         m = MagicMock()
         monkeypatch.setattr(f"src.routers.smartchartui.{fn}", m)
@@ -156,6 +194,35 @@ def mock_jobstate(monkeypatch):
     return mocks
 
 
+# ---------------------------------------------------------------------------
+# In-memory database — for code that needs real tables (e.g. the job queue)
+# ---------------------------------------------------------------------------
+@pytest.fixture
+def memory_db(monkeypatch):
+    """
+    Creates every RC-API table in an in-memory SQLite database, attaching a
+    second in-memory database under DB_SCHEMA so schema-qualified table names
+    resolve, and points jobstate, jobqueue, and cachesync at it.
+    """
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.pool import StaticPool
+
+    from src.util.databaseclient import BaseRCAPI
+    from src.util.settings import db_schema
+
+    engine = create_engine("sqlite+pysqlite:///:memory:", poolclass=StaticPool, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def attach_schema(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE ':memory:' AS {db_schema}")
+
+    BaseRCAPI.metadata.create_all(engine)
+    for target in ["src.services.jobstate.db_engine", "src.services.jobqueue.db_engine", "src.util.cachesync.db_engine"]:
+        monkeypatch.setattr(target, engine)
+    yield engine
+    engine.dispose()
+
+
 # ---------------------------------------------------------------------------
 # Helpers: build mock httpx.Response objects
 # ---------------------------------------------------------------------------
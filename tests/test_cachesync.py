@@ -0,0 +1,69 @@
+"""
+Tests for src/util/cachesync.py
+Covers shared caches being cleared when another process publishes an invalidation, against an in-memory database (see the memory_db fixture).
+"""
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from src.models.forms import invalidate_cached_questionnaire, questionnaire_cache
+from src.services.libraryhandler import library_index, nlpql_registration_cache
+from src.util import cachesync
+from src.util.cachesync import publish_cache_invalidation, register_shared_caches, sync_cache_generations
+from src.util.databaseclient import CacheGenerations
+
+
+@pytest.fixture
+def cache_sync(memory_db, monkeypatch):
+    """Cache sync started against memory_db, with generations this test process has not seen yet"""
+    monkeypatch.setattr(cachesync, "known_generations", {})
+    register_shared_caches()
+    sync_cache_generations()
+    monkeypatch.setitem(cachesync.cache_sync_state, "enabled", True)
+    return memory_db
+
+
+def bump_generation(engine, cache_name: str) -> None:
+    """What publish_cache_invalidation does in another process"""
+    with Session(engine) as session:
+        session.execute(update(CacheGenerations).where(CacheGenerations.cache_name == cache_name).values(generation=CacheGenerations.generation + 1))
+        session.commit()
+
+
+class TestSyncCacheGenerations:
+    def test_invalidation_from_another_process_clears_cache(self, cache_sync):
+        """sync_cache_generations → a shared cache invalidated by another process is cleared, other caches keep their entries."""
+        questionnaire_cache.set(("TestQuestionnaire", None), {"resourceType": "Questionnaire"})
+        library_index.set(("TestLibrary", "text/cql"), {"id": "lib-1"})
+        nlpql_registration_cache.set("lib-2", {"contentHash": "hash", "jobUrl": "job/1"})
+
+        assert sync_cache_generations() == []
+        bump_generation(cache_sync, "questionnaire")
+
+        assert sync_cache_generations() == ["questionnaire"]
+        # Entries are read directly so the hit counters other tests assert on are left alone
+        assert ("TestQuestionnaire", None) not in questionnaire_cache.entries
+        assert ("TestLibrary", "text/cql") in library_index.entries
+        assert "lib-2" in nlpql_registration_cache.entries
+        assert sync_cache_generations() == []
+
+    def test_own_invalidation_keeps_other_entries(self, cache_sync):
+        """invalidate_cached_questionnaire → other processes are signalled, this process only drops the named Questionnaire."""
+        questionnaire_cache.set(("TestQuestionnaire", None), {"resourceType": "Questionnaire"})
+        questionnaire_cache.set(("OtherQuestionnaire", None), {"resourceType": "Questionnaire"})
+
+        invalidate_cached_questionnaire("TestQuestionnaire")
+
+        assert sync_cache_generations() == []
+        assert ("OtherQuestionnaire", None) in questionnaire_cache.entries
+        assert ("TestQuestionnaire", None) not in questionnaire_cache.entries
+        with Session(cache_sync) as session:
+            assert session.get(CacheGenerations, "questionnaire").generation == 1
+
+    def test_publish_without_sync_does_nothing(self, memory_db):
+        """publish_cache_invalidation → no database access until start_cache_sync has run."""
+        publish_cache_invalidation("questionnaire")
+
+        with Session(memory_db) as session:
+            assert session.get(CacheGenerations, "questionnaire") is None
@@ -11,6 +11,7 @@ Endpoints covered:
   POST /forms/jobPackageToQuestionnaire
 """
 
+import base64
 import uuid
 
 import pytest
@@ -80,6 +81,29 @@ class TestGetFormByName:
         assert body["resourceType"] == "OperationOutcome"
         assert body["issue"][0]["code"] == "not-found"
 
+    def test_get_form_by_name_is_cached(self, client, mock_httpx):
+        """GET /forms/{name} twice → CQF Ruler is only searched once and the hit is counted in /metrics."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        mock_httpx.get.return_value = make_response(200, make_fhir_searchset([questionnaire]))
+
+        client.get("/forms/TestQuestionnaire")
+        response = client.get("/forms/TestQuestionnaire")
+        assert response.json()["name"] == "TestQuestionnaire"
+        assert mock_httpx.get.call_count == 1
+        assert client.get("/metrics").json()["caches"]["questionnaire"]["hits"] == 1
+
+    def test_update_form_invalidates_cached_form(self, client, mock_httpx):
+        """PUT /forms/{name} → the next GET /forms/{name} searches CQF Ruler again."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        mock_httpx.get.return_value = make_response(200, make_fhir_searchset([questionnaire]))
+        mock_httpx.put.return_value = make_response(200, {"id": questionnaire["id"]})
+
+        client.get("/forms/TestQuestionnaire")
+        client.put("/forms/TestQuestionnaire", json=questionnaire)
+        client.get("/forms/TestQuestionnaire")
+        # GET form, GET during the update, GET form again after invalidation
+        assert mock_httpx.get.call_count == 3
+
 
 class TestSaveForm:
     def test_save_form_success(self, client, mock_httpx):
@@ -144,7 +168,7 @@ class TestStartJobs:
         """POST /forms/start (sync) → calls start_jobs and returns its result."""
         mock_result = {"resourceType": "Bundle", "type": "collection", "entry": []}
 
-        async def mock_start_jobs(post_body):
+        async def mock_start_jobs(post_body, on_library_result=None):
             return mock_result
 
         monkeypatch.setattr("src.routers.forms_router.start_jobs", mock_start_jobs)
@@ -154,13 +178,188 @@ class TestStartJobs:
         body = response.json()
         assert body["resourceType"] == "Bundle"
 
+    def test_start_jobs_sync_links_cql_results(self, client, mock_async_httpx):
+        """POST /forms/start (sync) → resolves form and library asynchronously and links the CQL results."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        library = load_fixture("fhir_library_cql")
+        patient = load_fixture("fhir_patient")
+
+        async def fake_get(url, **kwargs):
+            if "Questionnaire?" in url:
+                return make_response(200, make_fhir_searchset([questionnaire]))
+            return make_response(200, make_fhir_searchset([library]))
+
+        evaluate_result = {
+            "resourceType": "Bundle",
+            "entry": [
+                {"fullUrl": "Patient", "resource": {"resourceType": "Parameters", "parameter": [{"name": "value", "resource": patient}]}},
+                {"fullUrl": "PatientName", "resource": {"resourceType": "Parameters", "parameter": [{"name": "value", "valueString": "John Doe"}]}},
+            ],
+        }
+        mock_async_httpx.get.side_effect = fake_get
+        mock_async_httpx.post.return_value = make_response(200, evaluate_result)
+
+        response = client.post("/forms/start", json=START_JOBS_BODY)
+        assert response.status_code == 200
+        body = response.json()
+        assert body["resourceType"] == "Bundle"
+        assert body["entry"][0]["fullUrl"] == "Patient/test-patient-001"
+        assert [entry["resource"]["valueString"] for entry in body["entry"][1:]] == ["John Doe"]
+        mock_async_httpx.post.assert_called_once()
+        assert mock_async_httpx.post.call_args[0][0].endswith("Library/test-cql-library-001/$evaluate")
+
+    def test_start_jobs_run_all_resolves_every_library(self, client, mock_async_httpx):
+        """POST /forms/start without a job → every library in the jobPackage is resolved before evaluation."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        questionnaire["extension"][0]["extension"].append({"url": "form-job", "valueString": "OtherLibrary.cql"})
+        library = load_fixture("fhir_library_cql")
+        other_library = {**library, "id": "test-cql-library-002", "name": "OtherLibrary"}
+
+        async def fake_get(url, **kwargs):
+            if "Questionnaire?" in url:
+                return make_response(200, make_fhir_searchset([questionnaire]))
+            return make_response(200, make_fhir_searchset([other_library if "name=OtherLibrary" in url else library]))
+
+        mock_async_httpx.get.side_effect = fake_get
+        mock_async_httpx.post.return_value = make_response(200, {"resourceType": "Bundle", "entry": []})
+
+        body = {"resourceType": "Parameters", "parameter": START_JOBS_BODY["parameter"][:2]}
+        client.post("/forms/start", json=body)
+        evaluated = sorted(call[0][0] for call in mock_async_httpx.post.call_args_list)
+        assert evaluated == sorted(f"http://localhost:8080/fhir/Library/{library_id}/$evaluate" for library_id in ["test-cql-library-001", "test-cql-library-002"])
+
+    def test_start_jobs_reports_each_library_result(self, client, mock_async_httpx):
+        """start_jobs with on_library_result → each library's linked Bundle is passed on as soon as its evaluation returns."""
+        import asyncio
+
+        from src.models.functions import start_jobs
+        from src.models.models import StartJobsParameters
+
+        questionnaire = load_fixture("fhir_questionnaire")
+        questionnaire["extension"][0]["extension"].append({"url": "form-job", "valueString": "OtherLibrary.cql"})
+        library = load_fixture("fhir_library_cql")
+        other_library = {**library, "id": "test-cql-library-002", "name": "OtherLibrary"}
+        patient = load_fixture("fhir_patient")
+
+        async def fake_get(url, **kwargs):
+            if "Questionnaire?" in url:
+                return make_response(200, make_fhir_searchset([questionnaire]))
+            return make_response(200, make_fhir_searchset([other_library if "name=OtherLibrary" in url else library]))
+
+        patient_entry = {"fullUrl": "Patient", "resource": {"resourceType": "Parameters", "parameter": [{"name": "value", "resource": patient}]}}
+        mock_async_httpx.get.side_effect = fake_get
+        mock_async_httpx.post.return_value = make_response(200, {"resourceType": "Bundle", "entry": [patient_entry]})
+        library_results: dict[str, dict] = {}
+
+        async def record(library_name, library_result):
+            library_results[library_name] = library_result
+
+        post_body = StartJobsParameters(**{"resourceType": "Parameters", "parameter": START_JOBS_BODY["parameter"][:2]})
+        job_result = asyncio.run(start_jobs(post_body, on_library_result=record))
+        assert job_result["resourceType"] == "Bundle"
+        assert sorted(library_results) == ["OtherLibrary.cql", "TestLibrary.cql"]
+        assert all(result["entry"][0]["fullUrl"] == "Patient/test-patient-001" for result in library_results.values())
+        assert [entry["fullUrl"] for entry in job_result["entry"]].count("Patient/test-patient-001") == 1
+
+    def test_start_jobs_links_each_nlpql_library_once(self, client, mock_async_httpx, monkeypatch):
+        """start_jobs with on_library_result → the job Bundle merges the per-library Bundles, each library is linked once and the Patient read once."""
+        import asyncio
+        from unittest.mock import AsyncMock
+
+        from src.models import functions
+        from src.models.functions import start_jobs
+        from src.models.models import StartJobsParameters
+        from src.services.libraryhandler import index_library
+
+        questionnaire = {
+            **NLPQL_QUESTIONNAIRE,
+            "id": "nlpql-questionnaire",
+            "version": "1.0.0",
+            "extension": [
+                {"url": "http://gtri.gatech.edu/fakeFormIg/cql-form-job-list", "extension": []},
+                {"url": "http://gtri.gatech.edu/fakeFormIg/nlpql-form-job-list", "extension": [{"url": "form-job", "valueString": f"{name}.nlpql"} for name in ("TestNLPQL", "OtherNLPQL")]},
+            ],
+        }
+        index_library("TestNLPQL", "1.0.0", "text/nlpql", "nlpql-library-001")
+        index_library("OtherNLPQL", "1.0.0", "text/nlpql", "nlpql-library-002")
+
+        async def fake_get(url, **kwargs):
+            if "Questionnaire?" in url:
+                return make_response(200, make_fhir_searchset([questionnaire]))
+            if "DocumentReference/" in url:
+                return make_response(404, {"resourceType": "OperationOutcome"})
+            return make_response(200, load_fixture("fhir_patient"))
+
+        async def fake_run_nlpql(library_ids, patient_id, external_fhir_server_url, external_fhir_server_auth, on_response=None):
+            responses = [make_response(200, [make_nlpql_result(f"doc-{index}", "yes")]) for index, _ in enumerate(library_ids)]
+            for index, response in enumerate(responses):
+                await on_response(index, response)
+            return responses
+
+        mock_async_httpx.get.side_effect = fake_get
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        monkeypatch.setattr("src.models.functions.run_nlpql", fake_run_nlpql)
+        create_linked_results = AsyncMock(wraps=functions.create_linked_results)
+        monkeypatch.setattr("src.models.functions.create_linked_results", create_linked_results)
+        library_results: dict[str, dict] = {}
+
+        async def record(library_name, library_result):
+            library_results[library_name] = library_result
+
+        post_body = StartJobsParameters(**{"resourceType": "Parameters", "parameter": [START_JOBS_BODY["parameter"][0], {"name": "jobPackage", "valueString": "TestQuestionnaire"}]})
+        job_result = asyncio.run(start_jobs(post_body, on_library_result=record))
+
+        assert sorted(library_results) == ["OtherNLPQL.nlpql", "TestNLPQL.nlpql"]
+        assert create_linked_results.await_count == 2
+        assert [call[0][0] for call in mock_async_httpx.get.call_args_list].count("http://localhost:9090/fhir/Patient/test-patient-001") == 1
+        full_urls = [entry["fullUrl"] for entry in job_result["entry"]]
+        assert full_urls.count("Patient/test-patient-001") == 1
+        assert {"DocumentReference/doc-0", "DocumentReference/doc-1"} <= set(full_urls)
+        assert job_result["total"] == len(full_urls)
+
+    def test_start_jobs_library_not_found(self, client, mock_async_httpx):
+        """POST /forms/start → not-found OperationOutcome when a library in the jobPackage does not exist."""
+        questionnaire = load_fixture("fhir_questionnaire")
+
+        async def fake_get(url, **kwargs):
+            if "Questionnaire?" in url:
+                return make_response(200, make_fhir_searchset([questionnaire]))
+            return make_response(200, load_fixture("fhir_bundle_empty"))
+
+        mock_async_httpx.get.side_effect = fake_get
+
+        response = client.post("/forms/start", json=START_JOBS_BODY)
+        body = response.json()
+        assert body["resourceType"] == "OperationOutcome"
+        assert body["issue"][0]["code"] == "not-found"
+        mock_async_httpx.post.assert_not_called()
+
+    def test_start_jobs_uses_library_index(self, client, mock_async_httpx):
+        """POST /forms/start → an indexed library is evaluated by its server id without searching CQF Ruler for it."""
+        from src.services.libraryhandler import index_library
+
+        index_library("TestLibrary", "1.0.0", "text/cql", "indexed-library-id")
+        questionnaire = load_fixture("fhir_questionnaire")
+        mock_async_httpx.get.return_value = make_response(200, make_fhir_searchset([questionnaire]))
+        mock_async_httpx.post.return_value = make_response(200, {"resourceType": "Bundle", "entry": []})
+
+        client.post("/forms/start", json=START_JOBS_BODY)
+        assert not any("Library?" in call[0][0] for call in mock_async_httpx.get.call_args_list)
+        mock_async_httpx.post.assert_called_once()
+        assert mock_async_httpx.post.call_args[0][0] == "http://localhost:8080/fhir/Library/indexed-library-id/$evaluate"
+
     def test_start_jobs_async_creates_job_entry(self, client, monkeypatch):
-        """POST /forms/start?asyncFlag=true → returns ParametersJob with jobId and Location header."""
+        """POST /forms/start?asyncFlag=true → stores the job, returns ParametersJob with jobId and Location header, and records the result when done."""
+        from unittest.mock import MagicMock
 
-        async def mock_start_jobs(post_body):
+        async def mock_start_jobs(post_body, on_library_result=None):
             return {"resourceType": "Bundle"}
 
+        add_to_jobs = MagicMock(return_value=True)
+        update_job_to_complete = MagicMock()
         monkeypatch.setattr("src.routers.forms_router.start_jobs", mock_start_jobs)
+        monkeypatch.setattr("src.routers.forms_router.add_to_jobs", add_to_jobs)
+        monkeypatch.setattr("src.routers.forms_router.update_job_to_complete", update_job_to_complete)
 
         response = client.post("/forms/start?asyncFlag=true", json=START_JOBS_BODY)
         assert response.status_code == 200
@@ -170,6 +369,51 @@ class TestStartJobs:
         param_names = [p["name"] for p in body["parameter"]]
         assert "jobId" in param_names
         assert "Location" in response.headers
+        job_id = [p["valueString"] for p in body["parameter"] if p["name"] == "jobId"][0]
+        assert add_to_jobs.call_args.kwargs["parent_batch_job_id"] is None
+        update_job_to_complete.assert_called_once_with(job_id, {"resourceType": "Bundle"})
+
+    def test_start_jobs_async_failure_completes_job(self, client, monkeypatch):
+        """POST /forms/start?asyncFlag=true → a job whose start_jobs raises is completed with an exception OperationOutcome instead of staying inProgress."""
+        from unittest.mock import MagicMock
+
+        async def failing_start_jobs(post_body, on_library_result=None):
+            raise RuntimeError("CQF Ruler unavailable")
+
+        update_job_to_complete = MagicMock()
+        monkeypatch.setattr("src.routers.forms_router.start_jobs", failing_start_jobs)
+        monkeypatch.setattr("src.routers.forms_router.add_to_jobs", MagicMock(return_value=True))
+        monkeypatch.setattr("src.routers.forms_router.update_job_to_complete", update_job_to_complete)
+
+        response = client.post("/forms/start?asyncFlag=true", json=START_JOBS_BODY)
+        job_id = [p["valueString"] for p in response.json()["parameter"] if p["name"] == "jobId"][0]
+        assert update_job_to_complete.call_args[0][0] == job_id
+        assert update_job_to_complete.call_args[0][1]["issue"][0]["code"] == "exception"
+
+    def test_start_jobs_async_db_failure_returns_500(self, client, monkeypatch):
+        """POST /forms/start?asyncFlag=true → 500 OperationOutcome when the job cannot be stored."""
+        from unittest.mock import MagicMock
+
+        monkeypatch.setattr("src.routers.forms_router.add_to_jobs", MagicMock(return_value=False))
+        response = client.post("/forms/start?asyncFlag=true", json=START_JOBS_BODY)
+        assert response.status_code == 500
+        assert response.json()["resourceType"] == "OperationOutcome"
+
+    def test_start_jobs_async_queue_mode_enqueues_job(self, client, monkeypatch):
+        """POST /forms/start?asyncFlag=true with JOB_EXECUTION_MODE=queue → job is stored in the jobs table and queued for a worker."""
+        from unittest.mock import MagicMock
+
+        add_to_jobs = MagicMock(return_value=True)
+        monkeypatch.setattr("src.routers.forms_router.job_execution_mode", "queue")
+        monkeypatch.setattr("src.routers.forms_router.add_to_jobs", add_to_jobs)
+
+        response = client.post("/forms/start?asyncFlag=true", json=START_JOBS_BODY)
+        assert response.status_code == 200
+        job_id = [p["valueString"] for p in response.json()["parameter"] if p["name"] == "jobId"][0]
+        assert add_to_jobs.call_args.kwargs["job_id"] == job_id
+        assert add_to_jobs.call_args.kwargs["patient_id"] == "test-patient-001"
+        assert add_to_jobs.call_args.kwargs["job_package_job"] == "TestLibrary.cql"
+        assert [queue_row["job_id"] for queue_row in add_to_jobs.call_args.kwargs["queue_rows"]] == [job_id]
 
     def test_start_jobs_missing_required_fields(self, client):
         """POST /forms/start with incomplete body → 400 or 422 validation error."""
@@ -178,22 +422,442 @@ class TestStartJobs:
         assert response.status_code in (400, 422)
 
 
+class TestRunNLPQL:
+    def test_execution_starts_before_other_registrations_finish(self, mock_async_httpx, monkeypatch):
+        """run_nlpql → a library is executed as soon as its own registration completes, without waiting on the other libraries."""
+        import asyncio
+
+        from src.models.functions import run_nlpql
+
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        nlpql_library = load_fixture("fhir_library_nlpql")
+
+        async def fake_get(url, **kwargs):
+            return make_response(200, nlpql_library)
+
+        async def run():
+            first_execution_started = asyncio.Event()
+            registrations = []
+
+            async def fake_post(url, **kwargs):
+                if url.endswith("job/register_nlpql"):
+                    registrations.append(url)
+                    if len(registrations) == 2:
+                        await first_execution_started.wait()
+                    return make_response(200, {"location": f"/job/{len(registrations)}"})
+                first_execution_started.set()
+                return make_response(200, [])
+
+            mock_async_httpx.get.side_effect = fake_get
+            mock_async_httpx.post.side_effect = fake_post
+            return await asyncio.wait_for(run_nlpql(["lib-1", "lib-2"], "test-patient-001", "http://localhost:9090/fhir/", ""), timeout=5)
+
+        responses = asyncio.run(run())
+        assert len(responses) == 2
+        executed = sorted(call[0][0] for call in mock_async_httpx.post.call_args_list if "register_nlpql" not in call[0][0])
+        assert executed == ["http://nlpaas/job/1", "http://nlpaas/job/2"]
+
+    def test_registration_failure_returns_operation_outcome(self, mock_async_httpx, monkeypatch):
+        """run_nlpql → OperationOutcome when NLPaaS rejects a registration."""
+        import asyncio
+
+        from src.models.functions import run_nlpql
+
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_library_nlpql"))
+        mock_async_httpx.post.return_value = make_response(500, text="error")
+
+        result = asyncio.run(run_nlpql(["lib-1"], "test-patient-001", "http://localhost:9090/fhir/", ""))
+        assert result["resourceType"] == "OperationOutcome"
+        assert result["issue"][0]["code"] == "transient"
+
+    def test_registration_reused_across_jobs(self, mock_async_httpx, monkeypatch):
+        """run_nlpql twice → the library is fetched for each job but registered once, then executed with the cached job location."""
+        import asyncio
+
+        from src.models.functions import run_nlpql
+
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_library_nlpql"))
+
+        async def fake_post(url, **kwargs):
+            if url.endswith("job/register_nlpql"):
+                return make_response(200, {"location": "/job/1"})
+            return make_response(200, [])
+
+        mock_async_httpx.post.side_effect = fake_post
+        for _ in range(2):
+            asyncio.run(run_nlpql(["lib-1"], "test-patient-001", "http://localhost:9090/fhir/", ""))
+
+        assert mock_async_httpx.get.call_count == 2
+        posted = [call[0][0] for call in mock_async_httpx.post.call_args_list]
+        assert posted == ["http://nlpaas/job/register_nlpql", "http://nlpaas/job/1", "http://nlpaas/job/1"]
+
+    def test_edited_library_is_registered_again(self, mock_async_httpx, monkeypatch):
+        """run_nlpql → a cached registration made with different NLPQL, e.g. before the Library was edited on CQF Ruler, is not reused."""
+        import asyncio
+
+        from src.models.functions import run_nlpql
+        from src.services.libraryhandler import cache_nlpql_registration
+
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        cache_nlpql_registration("lib-1", "nlpql before the edit", "job/old")
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_library_nlpql"))
+
+        async def fake_post(url, **kwargs):
+            if url.endswith("job/register_nlpql"):
+                return make_response(200, {"location": "/job/new"})
+            return make_response(200, [])
+
+        mock_async_httpx.post.side_effect = fake_post
+        asyncio.run(run_nlpql(["lib-1"], "test-patient-001", "http://localhost:9090/fhir/", ""))
+
+        posted = [call[0][0] for call in mock_async_httpx.post.call_args_list]
+        assert posted == ["http://nlpaas/job/register_nlpql", "http://nlpaas/job/new"]
+
+    def test_unknown_job_is_registered_again(self, mock_async_httpx, monkeypatch):
+        """run_nlpql → when NLPaaS no longer knows a cached job location, the library is registered again and executed once more."""
+        import asyncio
+
+        from src.models.functions import run_nlpql
+        from src.services.libraryhandler import cache_nlpql_registration, get_nlpql_registration
+
+        monkeypatch.setattr("src.models.functions.nlpaas_url", "http://nlpaas/")
+        nlpql_library = load_fixture("fhir_library_nlpql")
+        nlpql = base64.b64decode(nlpql_library["content"][0]["data"]).decode("utf-8")
+        cache_nlpql_registration("lib-1", nlpql, "job/stale")
+        mock_async_httpx.get.return_value = make_response(200, nlpql_library)
+
+        async def fake_post(url, **kwargs):
+            if url.endswith("job/register_nlpql"):
+                return make_response(200, {"location": "/job/new"})
+            if url.endswith("job/stale"):
+                return make_response(404, text="Unknown job")
+            return make_response(200, [])
+
+        mock_async_httpx.post.side_effect = fake_post
+        responses = asyncio.run(run_nlpql(["lib-1"], "test-patient-001", "http://localhost:9090/fhir/", ""))
+
+        assert responses[0].status_code == 200
+        assert get_nlpql_registration("lib-1", nlpql) == "job/new"
+
+
+NLPQL_QUESTIONNAIRE = {
+    "resourceType": "Questionnaire",
+    "name": "TestQuestionnaire",
+    "item": [
+        {
+            "linkId": "group-1",
+            "text": "Social History",
+            "type": "group",
+            "item": [
+                {
+                    "linkId": "2.1",
+                    "text": "Smoking Status",
+                    "type": "string",
+                    "extension": [{"url": "http://gtri.gatech.edu/fakeFormIg/nlpqlTask", "valueString": "TestNLPQL.Smoking"}],
+                }
+            ],
+        }
+    ],
+}
+
+
+def make_nlpql_result(report_id: str, answer_value: str) -> dict:
+    return {
+        "nlpql_feature": "Smoking",
+        "report_id": report_id,
+        "report_date": "2024-01-01",
+        "report_text": "Patient is a smoker.",
+        "result_display": {},
+        "tuple": f'"sourceNote": "Patient is a smoker.", "answerValue": "{answer_value}", "answerType": "Generic"',
+    }
+
+
+class TestNLPQLResultLinking:
+    def test_document_references_fetched_once_each(self, client, mock_async_httpx):
+        """NLPQL linking → each distinct DocumentReference is fetched once, missing ones are built from the NLPaaS report text."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        document_reference = {
+            "resourceType": "DocumentReference",
+            "id": "doc-1",
+            "status": "current",
+            "content": [{"attachment": {"contentType": "text/plain", "data": "UGF0aWVudA=="}}, {"attachment": {"contentType": "text/html", "data": "PHA+"}}],
+        }
+
+        async def fake_get(url, **kwargs):
+            if url.endswith("DocumentReference/doc-1"):
+                return make_response(200, document_reference)
+            if "DocumentReference/" in url:
+                return make_response(404, {"resourceType": "OperationOutcome"})
+            return make_response(200, load_fixture("fhir_patient"))
+
+        mock_async_httpx.get.side_effect = fake_get
+        results_nlpql = [
+            {
+                "libraryName": "TestNLPQL",
+                "patientId": "test-patient-001",
+                "results": [make_nlpql_result("doc-1", "yes"), make_nlpql_result("doc-1", "current"), make_nlpql_result("doc-2", "yes")],
+            }
+        ]
+
+        nlpql_bundle = asyncio.run(create_linked_results([[], results_nlpql], "TestQuestionnaire", "test-patient-001", form=NLPQL_QUESTIONNAIRE))
+        fetched = [call[0][0] for call in mock_async_httpx.get.call_args_list if "DocumentReference/" in call[0][0]]
+        assert sorted(fetched) == ["http://localhost:9090/fhir/DocumentReference/doc-1", "http://localhost:9090/fhir/DocumentReference/doc-2"]
+
+        document_references = {entry["resource"]["id"]: entry["resource"] for entry in nlpql_bundle["entry"] if entry["resource"]["resourceType"] == "DocumentReference"}
+        assert set(document_references) == {"doc-1", "doc-2"}
+        assert [content["attachment"]["contentType"] for content in document_references["doc-1"]["content"]] == ["text/plain"]
+        assert document_references["doc-2"]["identifier"][0]["value"] == "DocumentReference/doc-2"
+
+    def test_duplicate_answers_linked_once(self, client, mock_async_httpx):
+        """NLPQL linking → repeated answers from the same report differing only in case or spacing become one Observation."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_patient"))
+        results = [make_nlpql_result("doc-1", "Yes"), make_nlpql_result("doc-1", " yes "), make_nlpql_result("doc-1", "no"), make_nlpql_result("doc-2", "yes")]
+        results_nlpql = [{"libraryName": "TestNLPQL", "patientId": "test-patient-001", "results": results}]
+
+        bundle = asyncio.run(create_linked_results([[], results_nlpql], "TestQuestionnaire", "test-patient-001", form=NLPQL_QUESTIONNAIRE))
+        observations = [entry["resource"] for entry in bundle["entry"] if entry["resource"]["resourceType"] == "Observation"]
+        answers = [(observation["focus"][0]["reference"], observation["component"][1]["valueString"]) for observation in observations]
+        assert answers == [("DocumentReference/doc-1", "Yes"), ("DocumentReference/doc-1", "no"), ("DocumentReference/doc-2", "yes")]
+        assert len([entry for entry in bundle["entry"] if entry["resource"]["resourceType"] == "DocumentReference"]) == 2
+
+    def test_malformed_tuple_is_skipped(self, client, mock_async_httpx):
+        """NLPQL linking → a tuple that does not parse is skipped and the other results are still linked."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_patient"))
+        malformed_result = make_nlpql_result("doc-1", "yes")
+        malformed_result["tuple"] = '"sourceNote": "Patient is a smoker.", "answerValue" "yes"'
+        results_nlpql = [{"libraryName": "TestNLPQL", "patientId": "test-patient-001", "results": [malformed_result, make_nlpql_result("doc-2", "yes")]}]
+
+        bundle = asyncio.run(create_linked_results([[], results_nlpql], "TestQuestionnaire", "test-patient-001", form=NLPQL_QUESTIONNAIRE))
+        observations = [entry["resource"] for entry in bundle["entry"] if entry["resource"]["resourceType"] == "Observation"]
+        assert [observation["focus"][0]["reference"] for observation in observations] == ["DocumentReference/doc-2"]
+
+    def test_document_references_cached_across_jobs(self, client, mock_async_httpx):
+        """NLPQL linking twice for one patient → each DocumentReference is fetched from the external FHIR server only once."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        document_reference = {"resourceType": "DocumentReference", "id": "doc-1", "status": "current", "content": [{"attachment": {"contentType": "text/plain", "data": "UGF0aWVudA=="}}]}
+
+        async def fake_get(url, **kwargs):
+            if "DocumentReference/" in url:
+                return make_response(200, document_reference)
+            return make_response(200, load_fixture("fhir_patient"))
+
+        mock_async_httpx.get.side_effect = fake_get
+        results_nlpql = [{"libraryName": "TestNLPQL", "patientId": "test-patient-001", "results": [make_nlpql_result("doc-1", "yes")]}]
+
+        for _ in range(2):
+            bundle = asyncio.run(create_linked_results([[], results_nlpql], "TestQuestionnaire", "test-patient-001", form=NLPQL_QUESTIONNAIRE))
+            assert any(entry["resource"]["resourceType"] == "DocumentReference" for entry in bundle["entry"])
+        fetched = [call[0][0] for call in mock_async_httpx.get.call_args_list if "DocumentReference/" in call[0][0]]
+        assert fetched == ["http://localhost:9090/fhir/DocumentReference/doc-1"]
+
+    def test_concurrent_jobs_share_document_fetch(self, mock_async_httpx):
+        """fetch_document_references from concurrent jobs → a DocumentReference missing from the cache is requested once, every job gets its own copy."""
+        import asyncio
+
+        from src.services.documenthandler import fetch_document_references, pending_document_fetches
+
+        document_reference = {"resourceType": "DocumentReference", "id": "doc-1", "status": "current", "content": [{"attachment": {"contentType": "text/plain", "data": "UGF0aWVudA=="}}]}
+
+        async def run_jobs():
+            release_fetch = asyncio.Event()
+
+            async def fake_get(url, **kwargs):
+                await release_fetch.wait()
+                return make_response(200, document_reference)
+
+            mock_async_httpx.get.side_effect = fake_get
+            jobs = [asyncio.create_task(fetch_document_references(["doc-1"])) for _ in range(3)]
+            # Let every job miss the cache and reach the pending fetch before the request returns
+            for _ in range(5):
+                await asyncio.sleep(0)
+            assert list(pending_document_fetches) == [("http://localhost:9090/fhir/", "doc-1")]
+            release_fetch.set()
+            return await asyncio.gather(*jobs)
+
+        results = asyncio.run(run_jobs())
+        assert mock_async_httpx.get.call_count == 1
+        assert [result["doc-1"]["id"] for result in results] == ["doc-1", "doc-1", "doc-1"]
+        assert len({id(result["doc-1"]) for result in results}) == 3
+        assert pending_document_fetches == {}
+
+
+LINKING_PLAN_QUESTIONNAIRE = {
+    "resourceType": "Questionnaire",
+    "name": "PlanQuestionnaire",
+    "version": "1.0.0",
+    "item": [
+        {
+            "linkId": "group-1",
+            "item": [
+                {
+                    "linkId": "1.1",
+                    "text": "Patient Name",
+                    "type": "string",
+                    "extension": [
+                        {"url": "http://gtri.gatech.edu/fakeFormIg/cqlTask", "valueString": "LibraryA.PatientName"},
+                        {"url": "http://gtri.gatech.edu/fakeFormIg/cardinality", "valueString": "single"},
+                    ],
+                },
+                {"linkId": "1.2", "text": "Free text", "type": "string"},
+                {"linkId": "1.3", "text": "Smoking Status", "type": "string", "extension": [{"url": "http://gtri.gatech.edu/fakeFormIg/nlpqlTask", "valueString": "TestNLPQL.Smoking"}]},
+            ],
+        },
+        {
+            "linkId": "group-2",
+            "item": [{"linkId": "2.1", "text": "Medications", "type": "string", "extension": [{"url": "http://gtri.gatech.edu/fakeFormIg/cqlTask", "valueString": "LibraryB.Meds"}]}],
+        },
+    ],
+}
+
+
+class TestLinkingPlan:
+    def test_plan_lists_task_questions_by_library(self):
+        """build_linking_plan → only questions with a task, in form order, indexed by library."""
+        from src.models.forms import build_linking_plan
+
+        linking_plan = build_linking_plan(LINKING_PLAN_QUESTIONNAIRE)
+        assert linking_plan.question_count == 4
+        assert [(question.linkId, question.library, question.task, question.cardinality) for question in linking_plan.cql_questions] == [
+            ("1.1", "LibraryA", "PatientName", "single"),
+            ("2.1", "LibraryB", "Meds", ""),
+        ]
+        assert [question.position for question in linking_plan.cql_questions] == [1, 4]
+        assert [question.linkId for question in linking_plan.nlpql_questions] == ["1.3"]
+        assert {library: [question.linkId for question in questions] for library, questions in linking_plan.cql_questions_by_library.items()} == {"LibraryA": ["1.1"], "LibraryB": ["2.1"]}
+
+    def test_library_questions_in_form_order(self):
+        """get_library_questions → questions of the requested libraries only, merged back into form order."""
+        from src.models.forms import build_linking_plan, get_library_questions
+
+        questions_by_library = build_linking_plan(LINKING_PLAN_QUESTIONNAIRE).cql_questions_by_library
+        assert [question.linkId for question in get_library_questions(questions_by_library, ["LibraryB", "LibraryA", "Unknown"])] == ["1.1", "2.1"]
+        assert [question.linkId for question in get_library_questions(questions_by_library, ["LibraryB"])] == ["2.1"]
+
+    def test_single_library_links_only_its_questions(self, client):
+        """CQL linking for one library → questions mapped to other libraries are skipped even when a task name matches."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        def cql_result(library_name: str) -> dict:
+            entries = [{"fullUrl": "Patient", "resource": {"parameter": [{"name": "value", "resource": load_fixture("fhir_patient")}]}}]
+            entries += [{"fullUrl": task, "resource": {"parameter": [{"name": "value", "valueString": value}]}} for task, value in (("PatientName", "Jane Doe"), ("Meds", "aspirin"))]
+            return {"libraryName": library_name, "patientId": "test-patient-001", "results": {"resourceType": "Bundle", "entry": entries}}
+
+        def linked_questions(library_names: list[str]) -> list[str]:
+            bundle = asyncio.run(create_linked_results([[cql_result(name) for name in library_names], []], "PlanQuestionnaire", "test-patient-001", form=LINKING_PLAN_QUESTIONNAIRE))
+            return [entry["resource"]["code"]["coding"][0]["code"] for entry in bundle["entry"] if entry["resource"]["resourceType"] == "Observation"]
+
+        assert linked_questions(["LibraryB"]) == ["2.1"]
+        assert linked_questions(["LibraryB", "LibraryA"]) == ["1.1", "2.1"]
+        # A library whose server name differs from the cqlTask prefix has no mapped questions, so every CQL question is matched by task name
+        assert linked_questions(["LibraryB", "RenamedLibraryA"]) == ["1.1", "2.1"]
+
+    def test_unmapped_nlpql_library_falls_back_to_every_question(self, client, mock_async_httpx):
+        """NLPQL linking → a library with no questions mapped to its name still has its results linked when another evaluated library is mapped."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        questionnaire = {**NLPQL_QUESTIONNAIRE, "item": [{**NLPQL_QUESTIONNAIRE["item"][0], "item": [*NLPQL_QUESTIONNAIRE["item"][0]["item"]]}]}
+        questionnaire["item"][0]["item"].append(
+            {"linkId": "2.2", "text": "Alcohol Use", "type": "string", "extension": [{"url": "http://gtri.gatech.edu/fakeFormIg/nlpqlTask", "valueString": "RenamedNLPQL.Alcohol"}]}
+        )
+        mock_async_httpx.get.return_value = make_response(200, load_fixture("fhir_patient"))
+        alcohol_result = {**make_nlpql_result("doc-2", "yes"), "nlpql_feature": "Alcohol"}
+        results_nlpql = [
+            {"libraryName": "TestNLPQL", "patientId": "test-patient-001", "results": [make_nlpql_result("doc-1", "yes")]},
+            {"libraryName": "OtherNLPQL", "patientId": "test-patient-001", "results": [alcohol_result]},
+        ]
+
+        bundle = asyncio.run(create_linked_results([[], results_nlpql], "TestQuestionnaire", "test-patient-001", form=questionnaire))
+        observations = [entry["resource"] for entry in bundle["entry"] if entry["resource"]["resourceType"] == "Observation"]
+        assert [observation["code"]["coding"][0]["code"] for observation in observations] == ["2.1", "2.2"]
+
+    def test_plan_cached_per_version(self):
+        """get_linking_plan → one plan per Questionnaire version, dropped when the Questionnaire is invalidated."""
+        from src.models.forms import get_linking_plan, invalidate_cached_questionnaire
+
+        linking_plan = get_linking_plan(LINKING_PLAN_QUESTIONNAIRE)
+        assert get_linking_plan(LINKING_PLAN_QUESTIONNAIRE) is linking_plan
+        assert get_linking_plan({**LINKING_PLAN_QUESTIONNAIRE, "version": "2.0.0"}) is not linking_plan
+
+        invalidate_cached_questionnaire("PlanQuestionnaire")
+        assert get_linking_plan(LINKING_PLAN_QUESTIONNAIRE) is not linking_plan
+
+
+class TestCQLTupleLinking:
+    def test_tuple_results_link_supporting_resources(self, client):
+        """CQL linking of a [Tuple {...}] result → an answer Observation per tuple plus the supporting resource built from its answerValue."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        golden = load_fixture("cql_tuples")[0]
+        entries = [
+            {"fullUrl": "Patient", "resource": {"parameter": [{"name": "value", "resource": load_fixture("fhir_patient")}]}},
+            {"fullUrl": "Meds", "resource": {"parameter": [{"name": "value", "valueString": golden["tuples"]}]}},
+        ]
+        results_cql = [{"libraryName": "LibraryB", "patientId": "test-patient-001", "results": {"resourceType": "Bundle", "entry": entries}}]
+
+        bundle = asyncio.run(create_linked_results([results_cql, []], "PlanQuestionnaire", "test-patient-001", form=LINKING_PLAN_QUESTIONNAIRE))
+        supporting = {entry["fullUrl"]: entry["resource"] for entry in bundle["entry"] if entry["resource"].get("code", {}).get("coding", [{}])[0].get("system") == "http://loinc.org"}
+        assert supporting["Observation/obs-1"]["valueQuantity"] == {"value": "70.5", "unit": "kg"}
+        assert supporting["Observation/obs-2"]["valueString"] == "Former smoker"
+        answers = [entry["resource"] for entry in bundle["entry"] if entry["resource"].get("focus") and entry["resource"]["code"]["coding"][0]["code"] == "2.1"]
+        assert [answer["focus"][0]["reference"] for answer in answers] == ["Observation/obs-1", "Observation/obs-2"]
+
+    def test_malformed_tuple_skipped_alone(self, client):
+        """CQL linking → a tuple missing a field is skipped, the other tuples of the question are still linked."""
+        import asyncio
+
+        from src.models.functions import create_linked_results
+
+        tuples = load_fixture("cql_tuples")[0]["tuples"]
+        broken_tuple = 'Tuple {\n\t"fhirResourceId": "Observation/obs-9"\n\t"fhirField": "value"\n}'
+        entries = [
+            {"fullUrl": "Patient", "resource": {"parameter": [{"name": "value", "resource": load_fixture("fhir_patient")}]}},
+            {"fullUrl": "Meds", "resource": {"parameter": [{"name": "value", "valueString": f"[{broken_tuple}, {tuples.strip('[]')}]"}]}},
+        ]
+        results_cql = [{"libraryName": "LibraryB", "patientId": "test-patient-001", "results": {"resourceType": "Bundle", "entry": entries}}]
+
+        bundle = asyncio.run(create_linked_results([results_cql, []], "PlanQuestionnaire", "test-patient-001", form=LINKING_PLAN_QUESTIONNAIRE))
+        answers = [entry["resource"] for entry in bundle["entry"] if entry["resource"].get("focus") and entry["resource"]["code"]["coding"][0]["code"] == "2.1"]
+        assert [answer["focus"][0]["reference"] for answer in answers] == ["Observation/obs-1", "Observation/obs-2"]
+
+
+def make_stored_job(job_id: str, status: str = "inProgress", result: dict | None = None) -> dict:
+    result_param = {"name": "result", "resource": result} if result else {"name": "result"}
+    return {"resourceType": "Parameters", "parameter": [{"name": "jobId", "valueString": job_id}, {"name": "jobStatus", "valueString": status}, result_param]}
+
+
 class TestJobStatus:
     def test_get_all_jobs_empty(self, client, monkeypatch):
-        """GET /forms/status/all → empty dict when no jobs are running."""
-        # The jobs dict in forms_router is module-level; reset it
-        import src.routers.forms_router as forms_router
-
-        monkeypatch.setattr(forms_router, "jobs", {})
+        """GET /forms/status/all → empty dict when no jobs have been started."""
+        monkeypatch.setattr("src.routers.forms_router.get_all_form_jobs", lambda: {})
         response = client.get("/forms/status/all")
         assert response.status_code == 200
         assert response.json() == {}
 
     def test_get_job_status_not_found(self, client, monkeypatch):
-        """GET /forms/status/{uid} → 404 OperationOutcome when uid not in jobs."""
-        import src.routers.forms_router as forms_router
-
-        monkeypatch.setattr(forms_router, "jobs", {})
+        """GET /forms/status/{uid} → 404 OperationOutcome when uid is not in the jobs table."""
+        monkeypatch.setattr("src.services.jobstate.get_job", lambda index: None)
         response = client.get("/forms/status/nonexistent-uid")
         assert response.status_code == 404
         body = response.json()
@@ -201,21 +865,41 @@ class TestJobStatus:
         assert body["issue"][0]["code"] == "code-invalid"
 
     def test_get_job_status_found_in_progress(self, client, monkeypatch):
-        """GET /forms/status/{uid} → returns ParametersJob dict for known uid."""
-        import src.routers.forms_router as forms_router
-        from src.models.models import ParametersJob
+        """GET /forms/status/{uid} → returns the stored job, re-read on every poll while it is in progress."""
+        from unittest.mock import MagicMock
+
+        job_id = str(uuid.uuid4())
+        get_job = MagicMock(return_value=make_stored_job(job_id))
+        monkeypatch.setattr("src.services.jobstate.get_job", get_job)
+
+        for _ in range(2):
+            response = client.get(f"/forms/status/{job_id}")
+            assert response.status_code == 200
+            assert response.json()["resourceType"] == "Parameters"
+        assert get_job.call_count == 2
 
+    def test_get_job_status_complete_is_cached(self, client, monkeypatch):
+        """GET /forms/status/{uid} → a completed job is read from the database once, then served from the completed job cache."""
+        from unittest.mock import MagicMock
+
+        job_id = str(uuid.uuid4())
+        get_job = MagicMock(return_value=make_stored_job(job_id, "complete", {"resourceType": "Bundle", "type": "collection"}))
+        monkeypatch.setattr("src.services.jobstate.get_job", get_job)
+
+        for _ in range(2):
+            response = client.get(f"/forms/status/{job_id}")
+            assert response.status_code == 200
+        get_job.assert_called_once_with(job_id)
+
+    def test_get_job_status_error_result_returns_500(self, client, monkeypatch):
+        """GET /forms/status/{uid} → 500 with the OperationOutcome when the job finished with an error."""
         job_id = str(uuid.uuid4())
-        test_job = ParametersJob()
-        for param in test_job.parameter:
-            if param.name == "jobId":
-                param.valueString = job_id
+        error = {"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "transient", "diagnostics": "CQF Ruler failed"}]}
+        monkeypatch.setattr("src.services.jobstate.get_job", lambda index: make_stored_job(job_id, "complete", error))
 
-        monkeypatch.setattr(forms_router, "jobs", {job_id: test_job})
         response = client.get(f"/forms/status/{job_id}")
-        assert response.status_code == 200
-        body = response.json()
-        assert body["resourceType"] == "Parameters"
+        assert response.status_code == 500
+        assert response.json() == error
 
 
 class TestJobPackageToQuestionnaire:
@@ -278,7 +962,7 @@ class TestStartJobsUserData:
         expected = scenario.get("expected_output", {})
         expected_resource_type = expected.get("resourceType", "Bundle")
 
-        async def mock_start_jobs(post_body):
+        async def mock_start_jobs(post_body, on_library_result=None):
             return expected
 
         monkeypatch.setattr("src.routers.forms_router.start_jobs", mock_start_jobs)
@@ -0,0 +1,63 @@
+"""
+Tests for src/util/httpclients.py
+Covers the shared async client per upstream, the HTTP/2 setting of each pool, and closing the clients on shutdown.
+"""
+
+import asyncio
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from src.util import httpclients
+from src.util.httpclients import close_async_clients, get_async_client, startup_async_clients
+
+
+@pytest.fixture
+def async_clients(monkeypatch):
+    """An empty client registry for the test, so clients created here are never shared with other tests"""
+    clients: dict[str, httpx.AsyncClient] = {}
+    monkeypatch.setattr(httpclients, "async_clients", clients)
+    yield clients
+    for client in clients.values():
+        asyncio.run(client.aclose())
+
+
+class TestGetAsyncClient:
+    def test_same_client_per_upstream(self, async_clients):
+        """get_async_client → one client per upstream, returned again on every call."""
+        cqf_ruler_client = get_async_client("cqf_ruler")
+
+        assert get_async_client("cqf_ruler") is cqf_ruler_client
+        assert get_async_client("nlpaas") is not cqf_ruler_client
+        assert set(async_clients) == {"cqf_ruler", "nlpaas"}
+
+    def test_closed_client_is_replaced(self, async_clients):
+        """get_async_client → a new client when the shared one was closed."""
+        closed_client = get_async_client("external_fhir")
+        asyncio.run(closed_client.aclose())
+
+        assert get_async_client("external_fhir") is not closed_client
+        assert not async_clients["external_fhir"].is_closed
+
+    def test_http2_disabled_for_nlpaas(self, async_clients):
+        """build_async_client → HTTP/2 for the FHIR servers when h2 is available, never for NLPaaS."""
+        with patch("src.util.httpclients.http2_available", return_value=True), patch("src.util.httpclients.httpx.AsyncHTTPTransport", wraps=httpx.AsyncHTTPTransport) as transport:
+            for upstream in ("cqf_ruler", "nlpaas", "external_fhir"):
+                get_async_client(upstream)
+
+        assert [call.kwargs["http2"] for call in transport.call_args_list] == [True, False, True]
+
+
+class TestCloseAsyncClients:
+    def test_clients_closed_and_reset(self, async_clients):
+        """close_async_clients → every shared client is closed and dropped, the next get_async_client creates a new one."""
+        asyncio.run(startup_async_clients())
+        clients = dict(async_clients)
+        assert set(clients) == {"cqf_ruler", "nlpaas", "external_fhir"}
+
+        asyncio.run(close_async_clients())
+
+        assert async_clients == {}
+        assert all(client.is_closed for client in clients.values())
+        assert get_async_client("cqf_ruler") is not clients["cqf_ruler"]
@@ -60,11 +60,15 @@ _CQFR4_TARGETS = [
 _FHIR_SERVER_TARGETS = [
     "src.util.settings.external_fhir_server_url",
     "src.models.functions.external_fhir_server_url",
+    "src.services.documenthandler.external_fhir_server_url",
+    "src.services.patienthandler.external_fhir_server_url",
     "src.routers.smartchartui.external_fhir_client.server_base",
 ]
 _FHIR_AUTH_TARGETS = [
     "src.util.settings.external_fhir_server_auth",
     "src.models.functions.external_fhir_server_auth",
+    "src.services.documenthandler.external_fhir_server_auth",
+    "src.services.patienthandler.external_fhir_server_auth",
 ]
 _NLPAAS_TARGETS = [
     "src.util.settings.nlpaas_url",
@@ -179,7 +183,6 @@ def integration_client():
         + [patch(t, fhir_auth) for t in _FHIR_AUTH_TARGETS]
         + [patch(t, nlpaas_url) for t in _NLPAAS_TARGETS]
         + [patch("src.util.git.clone_repo_to_temp_folder")]
-        + [patch("src.routers.forms_router.init_jobs_array")]
     )
 
     if db_conn and "REPLACE_ME" not in db_conn:
@@ -190,6 +193,7 @@ def integration_client():
         url_patches += [
             patch("src.util.databaseclient.db_engine", real_engine),
             patch("src.services.jobstate.db_engine", real_engine),
+            patch("src.services.jobqueue.db_engine", real_engine),
         ]
     else:
         logger.info("[INTEGRATION] DB: SQLite fallback (rcapi_test.sqlite)")
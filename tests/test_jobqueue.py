@@ -0,0 +1,165 @@
+"""
+Tests for src/services/jobqueue.py
+Covers enqueueing, claiming with leases, lease expiry, and running claimed jobs
+against an in-memory database (see the memory_db fixture).
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.orm import Session
+
+from src.models.models import StartJobsParameters
+from src.services.jobqueue import claim_next_job, enqueue_job, fail_exhausted_jobs, finish_queued_job, renew_lease, run_queued_job
+from src.services.jobstate import get_job
+from src.util.databaseclient import JobQueue, Jobs
+
+START_BODY = StartJobsParameters.model_validate(
+    {
+        "resourceType": "Parameters",
+        "parameter": [
+            {"name": "patientId", "valueString": "test-patient-001"},
+            {"name": "jobPackage", "valueString": "TestQuestionnaire"},
+            {"name": "job", "valueString": "TestLibrary.cql"},
+        ],
+    }
+)
+
+
+def add_queued_job(engine, job_id: str) -> None:
+    with Session(engine) as session:
+        session.add(
+            Jobs(
+                job_id=job_id,
+                job={"resourceType": "Parameters", "parameter": [{"name": "jobId", "valueString": job_id}, {"name": "jobStatus", "valueString": "inProgress"}, {"name": "result"}]},
+                patient_id_type="patientId",
+                patient_id="test-patient-001",
+                job_package="TestQuestionnaire",
+                job_package_job="TestLibrary.cql",
+                job_start_datetime=datetime.now(),
+                job_status="inProgress",
+            )
+        )
+        session.commit()
+    assert enqueue_job(job_id, START_BODY)
+
+
+def get_queue_row(engine, job_id: str) -> JobQueue:
+    with Session(engine) as session:
+        return session.scalars(select(JobQueue).where(JobQueue.job_id == job_id)).one()
+
+
+class TestClaimNextJob:
+    def test_claims_oldest_job_once(self, memory_db):
+        """claim_next_job → the oldest queued job is leased to one worker and not handed out again."""
+        add_queued_job(memory_db, "job-1")
+        add_queued_job(memory_db, "job-2")
+
+        first = claim_next_job("worker-a")
+        second = claim_next_job("worker-b")
+        assert first["job_id"] == "job-1"
+        assert first["attempts"] == 1
+        assert second["job_id"] == "job-2"
+        assert claim_next_job("worker-c") is None
+        assert get_queue_row(memory_db, "job-1").lease_owner == "worker-a"
+
+    def test_expired_lease_is_reclaimed(self, memory_db):
+        """claim_next_job → a running job whose lease expired is claimed by another worker."""
+        add_queued_job(memory_db, "job-1")
+        claim_next_job("worker-a")
+        with Session(memory_db) as session:
+            session.execute(update(JobQueue).values(lease_expires_datetime=datetime.now() - timedelta(seconds=1)))
+            session.commit()
+
+        reclaimed = claim_next_job("worker-b")
+        assert reclaimed["job_id"] == "job-1"
+        assert reclaimed["attempts"] == 2
+        assert get_queue_row(memory_db, "job-1").lease_owner == "worker-b"
+
+    def test_expired_lease_on_last_attempt_is_failed(self, memory_db, monkeypatch):
+        """claim_next_job / fail_exhausted_jobs → a job whose worker keeps dying is not reclaimed past JOB_QUEUE_MAX_ATTEMPTS, it is marked failed."""
+        monkeypatch.setattr("src.services.jobqueue.job_queue_max_attempts", 1)
+        add_queued_job(memory_db, "job-1")
+        claim_next_job("worker-a")
+        with Session(memory_db) as session:
+            session.execute(update(JobQueue).values(lease_expires_datetime=datetime.now() - timedelta(seconds=1)))
+            session.commit()
+
+        assert claim_next_job("worker-b") is None
+        assert fail_exhausted_jobs() == ["job-1"]
+        assert fail_exhausted_jobs() == []
+        queue_row = get_queue_row(memory_db, "job-1")
+        assert queue_row.queue_status == "failed"
+        assert queue_row.lease_owner is None
+        result = [param["resource"] for param in get_job("job-1")["parameter"] if param["name"] == "result"][0]
+        assert result["resourceType"] == "OperationOutcome"
+
+
+class TestRunQueuedJob:
+    def test_successful_job_completes_row(self, memory_db, monkeypatch):
+        """run_queued_job → the job result is stored on the job row and the queue row is marked complete."""
+
+        async def fake_start_jobs(post_body, on_library_result=None):
+            return {"resourceType": "Bundle", "type": "collection", "entry": []}
+
+        monkeypatch.setattr("src.services.jobqueue.start_jobs", fake_start_jobs)
+        add_queued_job(memory_db, "job-1")
+
+        asyncio.run(run_queued_job(claim_next_job("worker-a"), "worker-a"))
+        job = get_job("job-1")
+        assert [param["valueString"] for param in job["parameter"] if param["name"] == "jobStatus"] == ["complete"]
+        queue_row = get_queue_row(memory_db, "job-1")
+        assert queue_row.queue_status == "complete"
+        assert queue_row.lease_owner is None
+
+    def test_failed_job_is_retried_then_marked_failed(self, memory_db, monkeypatch):
+        """run_queued_job → an exception requeues the job until JOB_QUEUE_MAX_ATTEMPTS, then the job completes with an OperationOutcome."""
+
+        async def failing_start_jobs(post_body, on_library_result=None):
+            raise RuntimeError("CQF Ruler unavailable")
+
+        monkeypatch.setattr("src.services.jobqueue.start_jobs", failing_start_jobs)
+        monkeypatch.setattr("src.services.jobqueue.job_queue_max_attempts", 2)
+        add_queued_job(memory_db, "job-1")
+
+        asyncio.run(run_queued_job(claim_next_job("worker-a"), "worker-a"))
+        assert get_queue_row(memory_db, "job-1").queue_status == "queued"
+
+        asyncio.run(run_queued_job(claim_next_job("worker-a"), "worker-a"))
+        queue_row = get_queue_row(memory_db, "job-1")
+        assert queue_row.queue_status == "failed"
+        assert queue_row.last_error == "CQF Ruler unavailable"
+        result = [param["resource"] for param in get_job("job-1")["parameter"] if param["name"] == "result"][0]
+        assert result["resourceType"] == "OperationOutcome"
+
+    def test_lease_renewal_survives_database_errors(self, memory_db, monkeypatch):
+        """run_queued_job → a failed lease renewal is logged and renewal carries on until the job finishes."""
+        renewals = []
+
+        def failing_renew_lease(job_id, worker_id):
+            renewals.append(job_id)
+            return False
+
+        async def slow_start_jobs(post_body, on_library_result=None):
+            await asyncio.sleep(0.1)
+            return {"resourceType": "Bundle", "type": "collection", "entry": []}
+
+        monkeypatch.setattr("src.services.jobqueue.start_jobs", slow_start_jobs)
+        monkeypatch.setattr("src.services.jobqueue.renew_lease", failing_renew_lease)
+        monkeypatch.setattr("src.services.jobqueue.job_lease_seconds", 0.06)
+        add_queued_job(memory_db, "job-1")
+
+        asyncio.run(run_queued_job(claim_next_job("worker-a"), "worker-a"))
+        assert len(renewals) >= 2
+        assert get_queue_row(memory_db, "job-1").queue_status == "complete"
+
+
+class TestQueueErrors:
+    def test_lease_helpers_return_false_on_database_error(self, monkeypatch):
+        """renew_lease / finish_queued_job → a database error is logged and reported as False instead of raised."""
+        # A database without the rcapi schema, so every statement fails
+        monkeypatch.setattr("src.services.jobqueue.db_engine", create_engine("sqlite://"))
+
+        assert renew_lease("job-1", "worker-a") is False
+        assert finish_queued_job("job-1", "worker-a") is False
@@ -0,0 +1,196 @@
+"""
+Tests for src/services/jobstate.py
+Covers inserting jobs and batch jobs against an in-memory database (see the memory_db fixture).
+"""
+
+from datetime import datetime
+
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.orm import Session
+
+from src.models.batchjob import BatchParametersJob
+from src.models.models import ParametersJob, StartJobsParameters
+from src.services.jobqueue import make_queue_row
+from src.services.jobstate import (
+    add_many_to_jobs,
+    add_to_batch_jobs,
+    add_to_jobs,
+    get_batch_job,
+    get_batch_jobs_with_counts,
+    get_child_jobs,
+    get_job,
+    make_job_row,
+    record_library_result,
+    update_job_to_complete,
+)
+from src.util.databaseclient import BatchJobs, JobQueue, Jobs, ensure_columns, ensure_indexes
+from src.util.settings import db_schema
+
+START_BODY = StartJobsParameters.model_validate(
+    {"resourceType": "Parameters", "parameter": [{"name": "patientId", "valueString": "test-patient-001"}, {"name": "jobPackage", "valueString": "TestQuestionnaire"}]}
+)
+
+
+def new_job(job_id: str) -> ParametersJob:
+    job = ParametersJob()
+    job.parameter[0].valueString = job_id
+    return job
+
+
+def new_batch_job(batch_id: str) -> BatchParametersJob:
+    batch_job = BatchParametersJob()
+    batch_job.parameter[0].valueString = batch_id
+    return batch_job
+
+
+def job_row(job_id: str, parent_batch_job_id: str | None = None) -> dict:
+    return make_job_row(new_job(job_id), job_id, "patientId", "test-patient-001", "TestQuestionnaire", "TestLibrary.cql", parent_batch_job_id, "2026-01-01T00:00:00Z", "inProgress")
+
+
+def count_jobs(engine) -> int:
+    with Session(engine) as session:
+        return session.scalar(select(func.count()).select_from(Jobs))
+
+
+class TestAddToJobs:
+    def test_insert_and_duplicate(self, memory_db):
+        """add_to_jobs → True for a new job id, False for an id already in the table."""
+        assert add_to_jobs(new_job("job-1"), "job-1", "patientId", "test-patient-001", "TestQuestionnaire", "TestLibrary.cql", None, "2026-01-01T00:00:00Z", "inProgress")
+        assert not add_to_jobs(new_job("job-1"), "job-1", "patientId", "test-patient-001", "TestQuestionnaire", "TestLibrary.cql", None, "2026-01-01T00:00:00Z", "inProgress")
+        assert count_jobs(memory_db) == 1
+        assert get_job("job-1")["resourceType"] == "Parameters"
+
+    def test_bulk_insert_is_all_or_nothing(self, memory_db):
+        """add_many_to_jobs → inserts every row, or none of them when one id already exists."""
+        assert add_many_to_jobs([job_row(f"job-{i}") for i in range(30)])
+        assert count_jobs(memory_db) == 30
+
+        assert not add_many_to_jobs([job_row("job-new"), job_row("job-0")])
+        assert count_jobs(memory_db) == 30
+
+    def test_queue_row_in_same_transaction(self, memory_db):
+        """add_many_to_jobs → a job's queue row is stored with it, and a failed queue insert leaves no job row behind."""
+        assert add_many_to_jobs([job_row("job-1")], [make_queue_row("job-1", START_BODY)])
+        assert not add_many_to_jobs([job_row("job-2")], [make_queue_row("job-1", START_BODY)])
+        assert get_job("job-2") is None
+        with Session(memory_db) as session:
+            assert list(session.scalars(select(JobQueue.job_id))) == ["job-1"]
+
+
+class TestAddToBatchJobs:
+    def test_batch_and_children_in_one_transaction(self, memory_db):
+        """add_to_batch_jobs → the batch row and all child rows are stored together."""
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", [job_row(f"child-{i}", "batch-1") for i in range(30)])
+        assert count_jobs(memory_db) == 30
+        assert get_batch_job("batch-1")["resourceType"] == "Parameters"
+
+    def test_failed_child_insert_rolls_back_batch(self, memory_db):
+        """add_to_batch_jobs → a duplicate child id stores neither the batch nor any of its children."""
+        assert add_to_jobs(new_job("child-0"), "child-0", "patientId", "test-patient-001", "TestQuestionnaire", "TestLibrary.cql", None, "2026-01-01T00:00:00Z", "inProgress")
+
+        assert not add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", [job_row("child-1", "batch-1"), job_row("child-0", "batch-1")])
+        assert count_jobs(memory_db) == 1
+        assert get_batch_job("batch-1") is None
+
+    def test_queue_rows_in_same_transaction(self, memory_db):
+        """add_to_batch_jobs → queue rows are stored with the batch, and a failed queue insert stores neither the batch nor its children."""
+        child_job_rows = [job_row("child-1", "batch-1"), job_row("child-2", "batch-1")]
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", child_job_rows, [make_queue_row(row["job_id"], START_BODY) for row in child_job_rows])
+        with Session(memory_db) as session:
+            assert sorted(session.scalars(select(JobQueue.job_id))) == ["child-1", "child-2"]
+
+        child_job_rows = [job_row("child-3", "batch-2")]
+        assert not add_to_batch_jobs(new_batch_job("batch-2"), "batch-2", child_job_rows, [make_queue_row("child-3", START_BODY), make_queue_row("child-3", START_BODY)])
+        assert get_batch_job("batch-2") is None
+        assert count_jobs(memory_db) == 2
+
+    def test_duplicate_batch_job(self, memory_db):
+        """add_to_batch_jobs → False when the batch id already exists."""
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1")
+        assert not add_to_batch_jobs(new_batch_job("batch-1"), "batch-1")
+
+
+class TestRecordLibraryResult:
+    def test_partial_results_are_merged(self, memory_db):
+        """record_library_result → each library's entries are added to the running job's result and its status is recorded."""
+        assert add_many_to_jobs([job_row("job-1")])
+        patient_entry = {"fullUrl": "Patient/test-patient-001", "resource": {"resourceType": "Patient"}}
+        record_library_result("job-1", "LibraryA.cql", {"resourceType": "Bundle", "entry": [patient_entry, {"fullUrl": "Observation/a", "resource": {}}]})
+        record_library_result("job-1", "LibraryB.cql", {"resourceType": "Bundle", "entry": [patient_entry, {"fullUrl": "Observation/b", "resource": {}}]})
+        record_library_result("job-1", "LibraryC.nlpql", {"resourceType": "OperationOutcome", "issue": []})
+
+        job = get_job("job-1")
+        result = [param["resource"] for param in job["parameter"] if param["name"] == "result"][0]
+        assert [entry["fullUrl"] for entry in result["entry"]] == ["Patient/test-patient-001", "Observation/a", "Observation/b"]
+        assert result["total"] == 3
+        library_status = [param["part"] for param in job["parameter"] if param["name"] == "libraryStatus"][0]
+        assert library_status == [
+            {"name": "LibraryA.cql", "valueString": "complete"},
+            {"name": "LibraryB.cql", "valueString": "complete"},
+            {"name": "LibraryC.nlpql", "valueString": "error"},
+        ]
+
+    def test_completed_job_is_not_changed(self, memory_db):
+        """record_library_result → a job that already completed keeps its final result."""
+        assert add_many_to_jobs([job_row("job-1")])
+        update_job_to_complete("job-1", {"resourceType": "Bundle", "type": "collection", "entry": []})
+        record_library_result("job-1", "LibraryA.cql", {"resourceType": "Bundle", "entry": [{"fullUrl": "Observation/a", "resource": {}}]})
+
+        result = [param["resource"] for param in get_job("job-1")["parameter"] if param["name"] == "result"][0]
+        assert result["entry"] == []
+
+
+class TestJobIndexes:
+    def test_child_jobs(self, memory_db):
+        """get_child_jobs → each child job of the batch only, keyed by job id."""
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", [job_row("child-1", "batch-1"), job_row("child-2", "batch-1")])
+        assert add_many_to_jobs([job_row("other-job")])
+
+        assert sorted(get_child_jobs("batch-1")) == ["child-1", "child-2"]
+
+    def test_batch_jobs_with_counts(self, memory_db):
+        """get_batch_jobs_with_counts → each batch with its completed and total child job counts, paged by cursor."""
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", [job_row("child-1", "batch-1"), job_row("child-2", "batch-1")])
+        assert add_to_batch_jobs(new_batch_job("batch-2"), "batch-2", [job_row("child-3", "batch-2")])
+        assert add_to_batch_jobs(new_batch_job("batch-3"), "batch-3")
+        update_job_to_complete("child-2", {"resourceType": "Bundle", "type": "collection"})
+
+        assert [(batch_id, completed, total) for batch_id, _, completed, total in get_batch_jobs_with_counts()] == [("batch-1", 1, 2), ("batch-2", 0, 1), ("batch-3", 0, 0)]
+        page = get_batch_jobs_with_counts(count=1, cursor="batch-1")
+        assert [batch_id for batch_id, *_ in page] == ["batch-2"]
+        assert page[0][1]["parameter"][0]["valueString"] == "batch-2"
+
+    def test_batch_jobs_in_creation_order(self, memory_db):
+        """get_batch_jobs_with_counts → batches oldest first whatever their ids, with the id breaking ties and the cursor resuming after its batch."""
+        for batch_id, start_datetime in (("batch-b", "2026-01-01T10:00:00Z"), ("batch-c", "2026-01-01T11:00:00Z"), ("batch-a", "2026-01-01T11:00:00Z")):
+            batch_job = new_batch_job(batch_id)
+            batch_job.parameter[3].valueDateTime = start_datetime
+            assert add_to_batch_jobs(batch_job, batch_id)
+
+        assert [batch_id for batch_id, *_ in get_batch_jobs_with_counts()] == ["batch-b", "batch-a", "batch-c"]
+        assert [batch_id for batch_id, *_ in get_batch_jobs_with_counts(count=1, cursor="batch-b")] == ["batch-a"]
+        assert [batch_id for batch_id, *_ in get_batch_jobs_with_counts(cursor="batch-a")] == ["batch-c"]
+
+    def test_missing_columns_are_added(self, memory_db):
+        """ensure_columns → a batch_jobs table from an earlier version gets its start time column, filled from the earliest child job."""
+        assert add_to_batch_jobs(new_batch_job("batch-1"), "batch-1", [job_row("child-1", "batch-1")])
+        with memory_db.connect() as conn:
+            conn.execute(text(f"DROP INDEX {db_schema}.ix_batch_jobs_batch_job_start_datetime_batch_job_id"))
+            conn.execute(text(f"ALTER TABLE {db_schema}.batch_jobs DROP COLUMN batch_job_start_datetime"))
+            ensure_columns(conn)
+            ensure_columns(conn)
+            ensure_indexes(conn)
+
+        with Session(memory_db) as session:
+            assert session.scalar(select(BatchJobs.batch_job_start_datetime)) == datetime(2026, 1, 1)
+        assert [batch_id for batch_id, *_ in get_batch_jobs_with_counts()] == ["batch-1"]
+
+    def test_missing_indexes_are_created(self, memory_db):
+        """ensure_indexes → indexes missing from an existing jobs table are created, and running it again is harmless."""
+        with memory_db.connect() as conn:
+            conn.execute(text(f"DROP INDEX {db_schema}.ix_jobs_parent_batch_job_id_job_status"))
+            ensure_indexes(conn)
+            ensure_indexes(conn)
+            index_names = {index["name"] for index in inspect(conn).get_indexes("jobs", schema=db_schema)}
+
+        assert index_names == {"ix_jobs_parent_batch_job_id_job_status", "ix_jobs_patient_id", "ix_jobs_job_status", "ix_jobs_job_start_datetime"}
@@ -4,6 +4,7 @@ Endpoints covered:
   GET /
   GET /health
   GET /config
+  GET /metrics
 """
 
 
@@ -68,3 +69,19 @@ class TestConfigEndpoint:
         assert "primaryIdentifier" in body
         assert body["primaryIdentifier"]["system"] == "http://example.org/pid"
         assert body["primaryIdentifier"]["label"] == "MRN"
+
+
+class TestMetricsEndpoint:
+    def test_metrics_reports_cache_counters(self, client):
+        """GET /metrics should report counters for every in-process cache, including the byte budget of the DocumentReference cache."""
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        caches = response.json()["caches"]
+        assert {"questionnaire", "library_index", "document_reference"} <= set(caches)
+        assert {"bytes", "maxBytes", "evictions"} <= set(caches["document_reference"])
+
+    def test_metrics_reports_scheduler_queues(self, client):
+        """GET /metrics should report in-flight and queued counts for jobs and each evaluation backend."""
+        scheduler = client.get("/metrics").json()["scheduler"]
+        assert {"limit", "inFlight", "queued", "completed"} <= set(scheduler["jobs"])
+        assert set(scheduler["evaluations"]) == {"cqf_ruler", "nlpaas"}
@@ -198,6 +198,22 @@ class TestUpdateNlpql:
         assert body["resourceType"] == "OperationOutcome"
         assert body["issue"][0]["severity"] == "information"
 
+    def test_update_nlpql_drops_changed_registration(self, client, mock_httpx):
+        """PUT /forms/nlpql/{name} with new content → the cached NLPaaS registration for that library is dropped."""
+        from src.services.libraryhandler import cache_nlpql_registration, nlpql_registration_cache
+
+        cache_nlpql_registration("test-nlpql-library-001", "previous nlpql", "job/1")
+        mock_httpx.get.return_value = make_response(200, make_fhir_searchset([load_fixture("fhir_library_nlpql")]))
+        mock_httpx.put.return_value = make_response(200, {"id": "test-nlpql-library-001"})
+
+        with (
+            patch("src.services.libraryhandler.nlpaas_url", "http://nlpaas.example.org/"),
+            patch("src.services.libraryhandler.validate_nlpql", return_value=True),
+        ):
+            response = client.put("/forms/nlpql/TestNLPQLLibrary", content=VALID_NLPQL, headers={"Content-Type": "text/plain"})
+        assert response.status_code == 201
+        assert nlpql_registration_cache.get("test-nlpql-library-001") is None
+
     def test_update_nlpql_empty_body_rejected(self, client):
         """PUT /forms/nlpql/{name} with empty body → 400 (custom validation handler)."""
         response = client.put("/forms/nlpql/TestNLPQLLibrary", content="", headers={"Content-Type": "text/plain"})
@@ -13,11 +13,15 @@ Endpoints covered:
   GET    /smartchartui/results/{id}
 """
 
+import json
 import uuid
+from copy import deepcopy
 from unittest.mock import MagicMock, patch
 
 import pytest
 
+from src.models.models import ParametersJob
+from src.services.jobhandler import get_job_list_from_form
 from tests.conftest import load_fixture, load_user_data, make_fhir_searchset, make_response
 
 
@@ -72,32 +76,42 @@ BATCH_JOB_BODY = {
 # Patient endpoints
 # ===========================================================================
 class TestReadPatient:
-    def test_read_patient_success(self, client, mock_fhir_clients):
+    def test_read_patient_success(self, client, mock_async_httpx):
         """GET /smartchartui/Patient/{id} → Patient resource JSON."""
-        ext_client, _ = mock_fhir_clients
         patient = load_fixture("fhir_patient")
-        mock_resp = MagicMock()
-        mock_resp.json.return_value = patient
-        ext_client.readResource.return_value = mock_resp
+        mock_async_httpx.get.return_value = make_response(200, patient)
 
         response = client.get(f"/smartchartui/Patient/{patient['id']}")
         assert response.status_code == 200
         body = response.json()
         assert body["resourceType"] == "Patient"
         assert body["id"] == patient["id"]
+        assert mock_async_httpx.get.call_args[0][0] == f"http://localhost:9090/fhir/Patient/{patient['id']}"
 
-    def test_read_patient_extracts_resource_type_from_response(self, client, mock_fhir_clients):
-        """GET /smartchartui/Patient/{id} → response contains Patient resource type."""
-        ext_client, _ = mock_fhir_clients
+    def test_read_patient_is_cached(self, client, mock_async_httpx):
+        """GET /smartchartui/Patient/{id} twice → the external FHIR server is read once."""
         patient = load_fixture("fhir_patient")
-        mock_resp = MagicMock()
-        mock_resp.json.return_value = patient
-        ext_client.readResource.return_value = mock_resp
+        mock_async_httpx.get.return_value = make_response(200, patient)
 
-        response = client.get(f"/smartchartui/Patient/{patient['id']}")
-        assert response.status_code == 200
-        body = response.json()
-        assert body["resourceType"] == "Patient"
+        assert client.get(f"/smartchartui/Patient/{patient['id']}").json() == patient
+        assert client.get(f"/smartchartui/Patient/{patient['id']}").json() == patient
+        assert mock_async_httpx.get.call_count == 1
+
+    def test_read_patient_not_found_is_cached(self, client, mock_async_httpx):
+        """GET /smartchartui/Patient/{id} → 404 OperationOutcome, and the miss is remembered until purged."""
+        mock_async_httpx.get.return_value = make_response(404, {"resourceType": "OperationOutcome"})
+
+        for _ in range(2):
+            response = client.get("/smartchartui/Patient/missing-patient")
+            assert response.status_code == 404
+            assert response.json()["issue"][0]["code"] == "not-found"
+        assert mock_async_httpx.get.call_count == 1
+
+        purge = client.delete("/smartchartui/Patient/cache", params={"patient_id": "missing-patient"})
+        assert purge.status_code == 200
+        assert purge.json()["issue"][0]["diagnostics"] == "Removed 1 Patient(s) from the Patient cache"
+        client.get("/smartchartui/Patient/missing-patient")
+        assert mock_async_httpx.get.call_count == 2
 
 
 class TestSearchPatient:
@@ -165,31 +179,52 @@ class TestSearchPatient:
 # Group endpoint
 # ===========================================================================
 class TestSearchGroup:
-    def test_search_group_returns_list(self, client, mock_fhir_clients, mock_httpx):
-        """GET /smartchartui/group → list containing Group and Patient resources."""
+    def test_search_group_returns_list(self, client, mock_fhir_clients, mock_async_httpx):
+        """GET /smartchartui/group → list of each Group followed by its Patients, resolved with one _id search."""
         _, internal_client = mock_fhir_clients
         patient = load_fixture("fhir_patient")
-
         group = {
             "resourceType": "Group",
             "id": "test-group-001",
             "type": "person",
             "actual": True,
-            "member": [{"entity": {"reference": "http://localhost:9090/fhir/Patient/test-patient-001"}}],
+            "member": [{"entity": {"reference": f"http://localhost:9090/fhir/Patient/{patient['id']}"}}],
         }
         internal_client.searchResource.return_value = [group]
-
-        mock_patient_resp = MagicMock()
-        mock_patient_resp.json.return_value = patient
-        mock_httpx.get.return_value = mock_patient_resp
+        mock_async_httpx.get.return_value = make_response(200, make_fhir_searchset([patient]))
 
         response = client.get("/smartchartui/group")
         assert response.status_code == 200
         body = response.json()
         assert isinstance(body, list)
-        # Should contain the Group + the Patient from the member reference
-        resource_types = [item.get("resourceType") for item in body]
-        assert "Group" in resource_types
+        assert [item["resourceType"] for item in body] == ["Group", "Patient"]
+        assert mock_async_httpx.get.call_args[1]["params"]["_id"] == patient["id"]
+
+    def test_search_group_reports_unresolved_members(self, client, mock_fhir_clients, mock_async_httpx):
+        """GET /smartchartui/group?_format=ndjson → one resource per line, with members that could not be read listed in a trailing OperationOutcome."""
+        _, internal_client = mock_fhir_clients
+        patient = load_fixture("fhir_patient")
+        groups = [
+            {"resourceType": "Group", "id": "group-a", "member": [{"entity": {"reference": f"Patient/{patient['id']}"}}, {"entity": {"reference": "Patient/missing-patient"}}]},
+            {"resourceType": "Group", "id": "group-b", "member": [{"entity": {"reference": "http://other-server/fhir/Patient/remote-patient"}}]},
+        ]
+        internal_client.searchResource.return_value = groups
+
+        async def fake_get(url, **kwargs):
+            if url == "http://other-server/fhir/Patient/remote-patient":
+                return make_response(500, {"resourceType": "OperationOutcome"})
+            return make_response(200, make_fhir_searchset([patient]))
+
+        mock_async_httpx.get.side_effect = fake_get
+
+        response = client.get("/smartchartui/group", params={"_format": "ndjson"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [(line["resourceType"], line.get("id")) for line in lines] == [("Group", "group-a"), ("Patient", patient["id"]), ("Group", "group-b"), ("OperationOutcome", None)]
+        diagnostics = lines[-1]["issue"][0]["diagnostics"]
+        assert "Patient/missing-patient" in diagnostics
+        assert "http://other-server/fhir/Patient/remote-patient" in diagnostics
 
     def test_search_group_empty(self, client, mock_fhir_clients):
         """GET /smartchartui/group → empty list when no groups exist."""
@@ -259,7 +294,7 @@ class TestGetJob:
 class TestGetAllBatchJobs:
     def test_get_all_batch_jobs_empty(self, client, mock_jobstate):
         """GET /smartchartui/batchjob → empty list when no batch jobs in DB."""
-        mock_jobstate["get_all_batch_jobs"].return_value = []
+        mock_jobstate["get_batch_jobs_with_counts"].return_value = []
 
         response = client.get("/smartchartui/batchjob")
         assert response.status_code == 200
@@ -271,16 +306,49 @@ class TestGetAllBatchJobs:
         child_id = str(uuid.uuid4())
         batch_job = _make_batch_job_dict(batch_id, [child_id])
 
-        mock_jobstate["get_all_batch_jobs"].return_value = [batch_job]
-        mock_jobstate["get_child_job_statuses"].return_value = {child_id: "complete"}
+        mock_jobstate["get_batch_jobs_with_counts"].return_value = [(batch_id, batch_job, 1, 1)]
 
         response = client.get("/smartchartui/batchjob")
         assert response.status_code == 200
         body = response.json()
         assert isinstance(body, list)
         assert len(body) == 1
-        param_names = [p["name"] for p in body[0]["parameter"]]
-        assert "batchJobStatus" in param_names
+        params = {p["name"]: p for p in body[0]["parameter"]}
+        assert params["batchJobStatus"]["valueString"] == "complete"
+        assert params["completedJobCount"]["valueInteger"] == 1
+        assert params["totalJobCount"]["valueInteger"] == 1
+        assert "Link" not in response.headers
+
+    def test_get_all_batch_jobs_paginated(self, client, mock_jobstate):
+        """GET /smartchartui/batchjob?_count=2 → one extra row is read to decide on a Link rel="next" header with the last batch id as cursor."""
+        batch_ids = ["batch-a", "batch-b", "batch-c"]
+        mock_jobstate["get_batch_jobs_with_counts"].return_value = [(batch_id, _make_batch_job_dict(batch_id, ["child"]), 0, 1) for batch_id in batch_ids]
+
+        response = client.get("/smartchartui/batchjob", params={"_count": 2, "cursor": "batch-0"})
+        assert response.status_code == 200
+        mock_jobstate["get_batch_jobs_with_counts"].assert_called_once_with(3, "batch-0")
+        body = response.json()
+        assert [batch_job["parameter"][0]["valueString"] for batch_job in body] == ["batch-a", "batch-b"]
+        assert [p["valueString"] for p in body[0]["parameter"] if p["name"] == "batchJobStatus"] == ["inProgress"]
+        assert response.headers["Link"] == '</smartchartui/batchjob?_count=2&cursor=batch-b&include_patient=false>; rel="next"'
+
+    def test_get_all_batch_jobs_with_patients_batches_reads(self, client, mock_jobstate, mock_async_httpx):
+        """GET /smartchartui/batchjob?include_patient=true → distinct Patients are fetched with one _id search and cached for the next request."""
+        patients = {patient_id: {**load_fixture("fhir_patient"), "id": patient_id} for patient_id in ["p1", "p2"]}
+        batch_jobs = []
+        for index, patient_id in enumerate(["p1", "p2", "p1"]):
+            batch_job = _make_batch_job_dict(f"batch-{index}", ["child"])
+            batch_job["parameter"][2]["valueString"] = patient_id
+            batch_jobs.append((f"batch-{index}", batch_job, 1, 1))
+        mock_jobstate["get_batch_jobs_with_counts"].side_effect = lambda count, cursor: deepcopy(batch_jobs)
+        mock_async_httpx.get.return_value = make_response(200, make_fhir_searchset(list(patients.values())))
+
+        for _ in range(2):
+            response = client.get("/smartchartui/batchjob", params={"include_patient": "true"})
+            assert response.status_code == 200
+            assert len(response.json()) == 3
+        mock_async_httpx.get.assert_called_once()
+        assert mock_async_httpx.get.call_args.kwargs["params"]["_id"] == "p1,p2"
 
 
 class TestGetBatchJobById:
@@ -342,7 +410,7 @@ class TestDeleteBatchJob:
 # POST batch job
 # ===========================================================================
 class TestPostBatchJob:
-    def test_post_batch_job_creates_job(self, client, mock_fhir_clients, mock_jobstate, mock_httpx):
+    def test_post_batch_job_creates_job(self, client, mock_fhir_clients, mock_jobstate, mock_httpx, mock_async_httpx):
         """POST /smartchartui/batchjob → creates batch job and returns it with Location header."""
         questionnaire = load_fixture("fhir_questionnaire")
 
@@ -357,7 +425,7 @@ class TestPostBatchJob:
         assert body["resourceType"] == "Parameters"
         assert "Location" in response.headers
 
-    def test_post_batch_job_db_failure_returns_500(self, client, mock_fhir_clients, mock_jobstate, mock_httpx):
+    def test_post_batch_job_db_failure_returns_500(self, client, mock_fhir_clients, mock_jobstate, mock_httpx, mock_async_httpx):
         """POST /smartchartui/batchjob → 500 OperationOutcome when DB insert fails."""
         questionnaire = load_fixture("fhir_questionnaire")
 
@@ -369,6 +437,93 @@ class TestPostBatchJob:
         body = response.json()
         assert body["resourceType"] == "OperationOutcome"
 
+    def test_post_batch_job_stores_children_with_batch(self, client, mock_fhir_clients, mock_jobstate, mock_async_httpx):
+        """POST /smartchartui/batchjob → the batch job and every child job row are stored by a single add_to_batch_jobs call."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        mock_jobstate["add_to_batch_jobs"].return_value = True
+
+        with patch("src.routers.smartchartui.get_form", return_value=questionnaire):
+            response = client.post("/smartchartui/batchjob", json=BATCH_JOB_BODY)
+
+        assert response.status_code == 200
+        batch_id = [param for param in response.json()["parameter"] if param["name"] == "batchId"][0]["valueString"]
+        mock_jobstate["add_to_batch_jobs"].assert_called_once()
+        _, index, job_rows, queue_rows = mock_jobstate["add_to_batch_jobs"].call_args[0]
+        assert index == batch_id
+        assert queue_rows is None
+        assert len(job_rows) == len(get_job_list_from_form(questionnaire))
+        assert {row["parent_batch_job_id"] for row in job_rows} == {batch_id}
+
+
+class TestChildJobScheduling:
+    def test_child_jobs_limited_and_run_in_submission_order(self, mock_jobstate, monkeypatch):
+        """run_all_child_jobs_concurrently → never more child jobs in flight than the scheduler allows, started first in, first out across batches."""
+        import asyncio
+
+        from src.routers.smartchartui import run_all_child_jobs_concurrently, temp_start_job_body
+        from src.services.scheduler import JobScheduler
+
+        scheduler = JobScheduler(2, {"cqf_ruler": 1, "nlpaas": 1})
+        monkeypatch.setattr("src.routers.smartchartui.job_scheduler", scheduler)
+        started: list[str] = []
+        peak_in_flight = 0
+
+        async def fake_start_jobs(start_body, on_library_result=None):
+            nonlocal peak_in_flight
+            started.append(start_body.parameter[2].valueString)
+            peak_in_flight = max(peak_in_flight, scheduler.jobs.in_flight)
+            await asyncio.sleep(0.01)
+            return {"resourceType": "Bundle"}
+
+        monkeypatch.setattr("src.routers.smartchartui.start_jobs", fake_start_jobs)
+
+        def child_jobs(batch_id: str, count: int) -> list[dict]:
+            return [
+                {"new_job": ParametersJob(), "job_id": str(uuid.uuid4()), "parent_batch_job_id": batch_id, "start_body": temp_start_job_body("p1", "TestQuestionnaire", f"{batch_id}-{i}.cql")}
+                for i in range(count)
+            ]
+
+        async def run_two_batches():
+            await asyncio.gather(run_all_child_jobs_concurrently(child_jobs("a", 3)), run_all_child_jobs_concurrently(child_jobs("b", 3)))
+
+        asyncio.run(run_two_batches())
+        assert peak_in_flight == 2
+        assert started == ["a-0.cql", "a-1.cql", "a-2.cql", "b-0.cql", "b-1.cql", "b-2.cql"]
+        assert scheduler.stats()["jobs"] == {"limit": 2, "inFlight": 0, "queued": 0, "completed": 6}
+        assert mock_jobstate["update_job_to_complete"].call_count == 6
+
+    def test_failed_child_job_is_completed(self, mock_jobstate, monkeypatch):
+        """run_child_job → a child job whose start_jobs raises is completed with an exception OperationOutcome instead of staying inProgress."""
+        import asyncio
+
+        from src.routers.smartchartui import run_child_job, temp_start_job_body
+
+        async def failing_start_jobs(start_body, on_library_result=None):
+            raise RuntimeError("CQF Ruler unavailable")
+
+        monkeypatch.setattr("src.routers.smartchartui.start_jobs", failing_start_jobs)
+
+        asyncio.run(run_child_job(ParametersJob(), "child-1", "batch-1", temp_start_job_body("p1", "TestQuestionnaire", "TestLibrary.cql")))
+        job_id, job_result = mock_jobstate["update_job_to_complete"].call_args[0]
+        assert job_id == "child-1"
+        assert job_result["issue"][0]["code"] == "exception"
+
+    def test_post_batch_job_queue_mode_enqueues_children(self, client, mock_fhir_clients, mock_jobstate, monkeypatch):
+        """POST /smartchartui/batchjob with JOB_EXECUTION_MODE=queue → child jobs are stored and queued in the batch transaction instead of run in the API."""
+        questionnaire = load_fixture("fhir_questionnaire")
+        monkeypatch.setattr("src.routers.smartchartui.job_execution_mode", "queue")
+        mock_jobstate["add_to_batch_jobs"].return_value = True
+
+        with patch("src.routers.smartchartui.get_form", return_value=questionnaire):
+            response = client.post("/smartchartui/batchjob", json=BATCH_JOB_BODY)
+
+        assert response.status_code == 200
+        child_jobs = [param for param in response.json()["parameter"] if param["name"] == "childJobs"][0]["resource"]
+        _, _, child_job_rows, queue_rows = mock_jobstate["add_to_batch_jobs"].call_args[0]
+        assert [row["job_id"] for row in queue_rows] == [row["job_id"] for row in child_job_rows] == [entry["item"]["display"] for entry in child_jobs["entry"]]
+        assert {row["queue_status"] for row in queue_rows} == {"queued"}
+        mock_jobstate["update_job_to_complete"].assert_not_called()
+
 
 # ===========================================================================
 # Results endpoint
@@ -394,7 +549,7 @@ class TestGetBatchJobResults:
         child_job = _make_job_dict(child_id, status="complete")
 
         mock_jobstate["get_batch_job"].return_value = batch_job
-        mock_jobstate["get_job"].return_value = child_job
+        mock_jobstate["get_child_jobs"].return_value = {child_id: child_job}
 
         # external_fhir_client.readResource for the Patient
         mock_patient_response = MagicMock()
@@ -406,6 +561,35 @@ class TestGetBatchJobResults:
         assert response.status_code == 200
         body = response.json()
         assert body["resourceType"] == "Bundle"
+        mock_jobstate["get_child_jobs"].assert_called_once_with(batch_id)
+
+    def test_get_results_dedups_across_jobs(self, client, mock_jobstate, mock_async_httpx):
+        """GET /smartchartui/results/{id} → resources shared by child jobs appear once, result Patients are replaced by the data source Patient."""
+        batch_id = str(uuid.uuid4())
+        child_ids = [str(uuid.uuid4()) for _ in range(3)]
+        patient = load_fixture("fhir_patient")
+        shared_observation = {"resourceType": "Observation", "id": "shared", "status": "final"}
+
+        def job_with_entries(job_id: str, resources: list[dict]) -> dict:
+            job = _make_job_dict(job_id)
+            job["parameter"][3]["resource"]["entry"] = [{"fullUrl": f"{resource['resourceType']}/{resource['id']}", "resource": resource} for resource in resources]
+            return job
+
+        mock_jobstate["get_batch_job"].return_value = _make_batch_job_dict(batch_id, child_ids)
+        mock_jobstate["get_child_jobs"].return_value = {
+            child_ids[0]: job_with_entries(child_ids[0], [{"resourceType": "Patient", "id": patient["id"]}, shared_observation, {"resourceType": "Observation", "id": "first"}]),
+            child_ids[1]: job_with_entries(child_ids[1], [{"resourceType": "Patient", "id": patient["id"]}, shared_observation]),
+        }
+        mock_async_httpx.get.return_value = make_response(200, patient)
+
+        response = client.get(f"/smartchartui/results/{batch_id}")
+        assert response.status_code == 200
+        body = response.json()
+        assert [entry["fullUrl"] for entry in body["entry"]] == ["Observation/status-observation", f"Patient/{patient['id']}", "Observation/shared", "Observation/first"]
+        assert body["entry"][1]["resource"] == patient
+        assert body["total"] == 4
+        assert body["entry"][0]["resource"]["valueCodeableConcept"]["text"] == "Jobs completed: 2/3"
+        assert body["entry"][0]["resource"]["status"] == "preliminary"
 
 
 # ===========================================================================
@@ -413,7 +597,7 @@ class TestGetBatchJobResults:
 # ===========================================================================
 class TestBatchJobUserData:
     @pytest.mark.parametrize("scenario", load_user_data().get("batch_jobs_requests", []))
-    def test_batch_job_with_real_data(self, client, mock_fhir_clients, mock_jobstate, mock_httpx, scenario):
+    def test_batch_job_with_real_data(self, client, mock_fhir_clients, mock_jobstate, mock_httpx, mock_async_httpx, scenario):
         """POST /smartchartui/batchjob with user-provided patient and job package data."""
         patient_param = next((p for p in scenario["parameter"] if p["name"] == "patientId"), None)
         if not patient_param or patient_param["valueString"] == "REPLACE_ME":
@@ -434,18 +618,14 @@ class TestBatchJobUserData:
 
 class TestPatientSearchUserData:
     @pytest.mark.parametrize("patient", load_user_data().get("patients", []))
-    def test_read_patient_with_real_id(self, client, mock_fhir_clients, patient):
+    def test_read_patient_with_real_id(self, client, mock_async_httpx, patient):
         """GET /smartchartui/Patient/{id} with user-provided patient ID."""
         if patient["id"] == "REPLACE_ME":
             pytest.skip("User data not yet populated in tests/fixtures/user_data.json")
 
-        ext_client, _ = mock_fhir_clients
         patient_fixture = load_fixture("fhir_patient")
         patient_fixture["id"] = patient["id"]
-
-        mock_resp = MagicMock()
-        mock_resp.json.return_value = patient_fixture
-        ext_client.readResource.return_value = mock_resp
+        mock_async_httpx.get.return_value = make_response(200, patient_fixture)
 
         response = client.get(f"/smartchartui/Patient/{patient['id']}")
         assert response.status_code == 200
@@ -0,0 +1,120 @@
+"""
+Tests for src/services/tupleparser.py
+Covers parsing NLPaaS tuple strings without eval, using the tuple shapes in tests/fixtures/nlpaas_tuples.json, and parsing CQF Ruler
+tuple lists against the golden outputs in tests/fixtures/cql_tuples.json.
+"""
+
+import ast
+
+import pytest
+
+from src.services.tupleparser import TupleParseError, parse_cql_tuple, parse_cql_tuples, parse_nlpql_answer_value, parse_nlpql_tuple, parse_simple_tuple
+from tests.conftest import load_fixture
+
+
+class TestParseNLPQLTuple:
+    @pytest.mark.parametrize("tuple_string", load_fixture("nlpaas_tuples"))
+    def test_matches_literal_eval(self, tuple_string):
+        """parse_nlpql_tuple → the same dict the old eval of the tuple produced, for every recorded shape."""
+        assert parse_nlpql_tuple(tuple_string) == ast.literal_eval(f"{{{tuple_string}}}")
+
+    def test_plain_strings_use_fast_path(self):
+        """parse_simple_tuple → handles plain quoted strings, defers escaped quotes and non-string values to the full parser."""
+        assert parse_simple_tuple('"sourceNote": "Smoker, 1 ppd.", "answerValue": "yes", "answerType": "Generic"') == {
+            "sourceNote": "Smoker, 1 ppd.",
+            "answerValue": "yes",
+            "answerType": "Generic",
+        }
+        assert parse_simple_tuple('"sourceNote": "She said \\"yes\\"", "answerValue": "yes"') is None
+        assert parse_simple_tuple('"answerValue": "31.2", "confidence": 0.92') is None
+
+    def test_malformed_tuple_reports_position(self):
+        """parse_nlpql_tuple → TupleParseError with the position of the syntax error."""
+        with pytest.raises(TupleParseError) as error:
+            parse_nlpql_tuple('"sourceNote": "Smoker", "answerValue" "yes"')
+        assert error.value.position is not None
+        assert error.value.tuple_string == '"sourceNote": "Smoker", "answerValue" "yes"'
+
+    def test_code_is_not_executed(self):
+        """parse_nlpql_tuple → expressions in upstream data are rejected instead of evaluated."""
+        with pytest.raises(TupleParseError):
+            parse_nlpql_tuple('"sourceNote": __import__("os").getcwd(), "answerValue": "yes", "answerType": "Generic"')
+
+
+class TestParseNLPQLAnswerValue:
+    def test_dict_answer_value(self):
+        """parse_nlpql_answer_value → dict literals are parsed, other strings are returned unchanged."""
+        assert parse_nlpql_answer_value("{'tumor_size': '2.3 cm'}") == {"tumor_size": "2.3 cm"}
+        assert parse_nlpql_answer_value("BP {high}") == "BP {high}"
+        assert parse_nlpql_answer_value("yes") == "yes"
+
+    def test_malformed_dict_answer_value(self):
+        """parse_nlpql_answer_value → TupleParseError when a dict-shaped answerValue cannot be parsed."""
+        with pytest.raises(TupleParseError):
+            parse_nlpql_answer_value("{'tumor_size': }")
+        with pytest.raises(TupleParseError):
+            parse_nlpql_answer_value("{'a', 'b'}")
+
+
+def make_cql_tuple(**fields: str) -> str:
+    tuple_fields = {"fhirResourceId": '"Observation/1"', "fhirField": '"value"', "valueType": '"String"', "answerValue": '"a^b"', "sourceNote": '"note"'} | fields
+    return "Tuple {\n" + "".join(f'\t"{key}": {value}\n' for key, value in tuple_fields.items() if value is not None) + "}"
+
+
+class TestParseCQLTuples:
+    @pytest.mark.parametrize("golden", load_fixture("cql_tuples"), ids=lambda golden: golden["name"])
+    def test_golden_outputs(self, golden):
+        """parse_cql_tuples → one record per tuple with the fields the inline split-based parser produced."""
+        tuple_results, tuple_errors = parse_cql_tuples(golden["tuples"])
+        assert [tuple_result.model_dump() for tuple_result in tuple_results] == golden["expected"]
+        assert tuple_errors == []
+
+    def test_typed_record_helpers(self):
+        """CQLTupleResult → answerValue parts and the resource id from a versioned reference."""
+        tuple_result = parse_cql_tuples(load_fixture("cql_tuples")[0]["tuples"])[0][0]
+        assert tuple_result.supporting_resource_id == "obs-1"
+        assert tuple_result.answer_value_parts == ["2024-01-15T10:30:00", "http://loinc.org", "29463-7", "Body weight", "70.5", "kg"]
+
+    @pytest.mark.parametrize(
+        "source_note, expected",
+        [
+            ('"Said \\"no\\""', 'Said "no"'),
+            ('"Pt said "no" to meds"', 'Pt said "no" to meds'),
+            ('"C:\\\\notes\\ttab"', "C:\\notes\ttab"),
+            ('"Braces {} and Tuple words"', "Braces {} and Tuple words"),
+        ],
+    )
+    def test_quoted_values(self, source_note, expected):
+        """parse_cql_tuple → outer quotes removed, escapes resolved, unescaped inner quotes kept as the split-based parser kept the answer."""
+        assert parse_cql_tuple(make_cql_tuple(sourceNote=source_note)[len("Tuple {") : -1]).sourceNote == expected
+
+    def test_wrapped_value_is_joined(self):
+        """parse_cql_tuple → a line that does not start a field continues the value above it."""
+        tuple_string = make_cql_tuple(sourceNote='"first line\n second line"')
+        assert parse_cql_tuple(tuple_string[len("Tuple {") : -1]).sourceNote == "first line second line"
+
+    def test_bad_tuple_skipped_alone(self):
+        """parse_cql_tuples → a tuple missing a field is reported with its position, the tuples around it are still returned."""
+        tuple_list_string = "[" + ", ".join([make_cql_tuple(fhirResourceId='"Observation/1"'), make_cql_tuple(sourceNote=None), make_cql_tuple(fhirResourceId='"Observation/3"')]) + "]"
+
+        tuple_results, tuple_errors = parse_cql_tuples(tuple_list_string)
+        assert [tuple_result.fhirResourceId for tuple_result in tuple_results] == ["Observation/1", "Observation/3"]
+        assert len(tuple_errors) == 1
+        assert "missing sourceNote" in str(tuple_errors[0])
+        assert tuple_list_string.index("Tuple {", 1) < tuple_errors[0].position < tuple_list_string.rindex("Tuple {")
+
+    @pytest.mark.parametrize(
+        "tuple_list_string, message",
+        [
+            ('[Tuple {\n\t"fhirResourceId": "Observation/1"\n\t"fhirField": "value"\n}]', "missing valueType, answerValue, sourceNote"),
+            ('[Tuple {\n\t"fhirResourceId": "Observation/1"', "Unclosed CQL tuple"),
+            ('[Tuple {\n  stray text\n\t"fhirResourceId": "Observation/1"\n}]', "Text before the first field"),
+            ("not a tuple list", "No CQL tuple found"),
+        ],
+    )
+    def test_malformed_tuples(self, tuple_list_string, message):
+        """parse_cql_tuples → a TupleParseError naming the problem and where it is, instead of a result."""
+        tuple_results, tuple_errors = parse_cql_tuples(tuple_list_string)
+        assert tuple_results == []
+        assert message in str(tuple_errors[0])
+        assert tuple_errors[0].position is not None
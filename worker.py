@@ -0,0 +1,77 @@
+"""
+Job worker process. Claims jobs from the job_queue table and runs them outside the API, so evaluation throughput scales with the number of workers
+instead of the number of hypercorn workers. Run with `python worker.py` next to an API started with JOB_EXECUTION_MODE=queue.
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import uuid
+
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.services.jobqueue import claim_next_job, fail_exhausted_jobs, run_queued_job
+from src.services.libraryhandler import warm_library_index
+from src.util.cachesync import start_cache_sync, stop_cache_sync
+from src.util.databaseclient import startup_connect
+from src.util.httpclients import close_async_clients, startup_async_clients
+from src.util.settings import job_queue_poll_interval, max_inflight_jobs
+
+
+async def run_worker() -> None:
+    """Claim and run queued jobs until SIGINT or SIGTERM, then let the jobs already running finish"""
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    startup_connect()
+    await startup_async_clients()
+    cache_sync_task = await start_cache_sync()
+    await warm_library_index()
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(stop_signal, stopping.set)
+
+    job_slots = asyncio.Semaphore(max_inflight_jobs)
+    running_jobs: set[asyncio.Task] = set()
+    logger.info(f"Worker {worker_id} started, running up to {max_inflight_jobs} jobs at once")
+
+    async def run_and_release(queued_job: dict) -> None:
+        try:
+            await run_queued_job(queued_job, worker_id)
+        finally:
+            job_slots.release()
+
+    while not stopping.is_set():
+        await job_slots.acquire()
+        try:
+            queued_job = await asyncio.to_thread(claim_next_job, worker_id)
+        except SQLAlchemyError as error:
+            logger.error(f"Worker {worker_id} could not claim a job, trying again in {job_queue_poll_interval} seconds: {error}")
+            queued_job = None
+        if queued_job is None:
+            job_slots.release()
+            # Jobs that can no longer be claimed are only failed while the queue is idle, the check never delays claiming work
+            try:
+                await asyncio.to_thread(fail_exhausted_jobs)
+            except SQLAlchemyError as error:
+                logger.error(f"Worker {worker_id} could not fail jobs that used up their attempts: {error}")
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=job_queue_poll_interval)
+            except TimeoutError:
+                pass
+            continue
+        logger.info(f"Worker {worker_id} claimed job {queued_job['job_id']} (attempt {queued_job['attempts']})")
+        job_task = asyncio.create_task(run_and_release(queued_job))
+        running_jobs.add(job_task)
+        job_task.add_done_callback(running_jobs.discard)
+
+    logger.info(f"Worker {worker_id} stopping, waiting on {len(running_jobs)} running jobs")
+    await asyncio.gather(*running_jobs, return_exceptions=True)
+    await stop_cache_sync(cache_sync_task)
+    await close_async_clients()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())